@@ -8,3 +8,6 @@ from django.apps import AppConfig
 class AccountsConfig(AppConfig):
     """Accounts Config"""
     name = 'accounts'
+
+    def ready(self):
+        from . import signals  # noqa
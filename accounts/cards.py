@@ -0,0 +1,175 @@
+"""
+Cache of serialized member cards
+
+Cards are keyed by member id and updated_at, so a saved member gets new keys
+and the old cards simply expire. They embed presigned avatar urls, so they
+expire before the urls do. Changes of the related rows the cards show
+(detail, avatars, class, level, location) touch updated_at of their members,
+see accounts.signals.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import prefetch_related_objects
+from django.utils import timezone
+from rest_framework import serializers
+
+from basics.cache import get_url_timeout
+from chat.presence import get_statuses
+from .serializers.member import GeneralInfoSerializer, MainInfoSerializer
+
+CARD_SERIALIZERS = {
+    "main": MainInfoSerializer,
+    "general": GeneralInfoSerializer,
+}
+
+# relations the serializers read, loaded for the missed cards only
+CARD_PREFETCHES = {
+    "main": ['avatars', 'location'],
+    "general": ['avatars', 'detail', 'guest_level', 'cast_class'],
+}
+
+# request annotations, never cached
+CARD_ANNOTATIONS = {
+    "main": ['overall_points'],
+    "general": [],
+}
+
+# fields read from the presence service on every use
+CARD_PRESENCE_FIELDS = {
+    "main": [],
+    "general": ['status', 'left_at'],
+}
+
+
+def get_cache():
+    return caches[getattr(settings, 'PROFILE_CARD_CACHE', 'default')]
+
+
+def get_timeout():
+    url_timeout = get_url_timeout()
+    timeout = getattr(settings, 'PROFILE_CARD_TIMEOUT', None)
+    return url_timeout if timeout is None else min(timeout, url_timeout)
+
+
+def get_card_key(kind, member):
+    return "profile_card:{0}:{1}:{2}".format(
+        kind, member.id, int(member.updated_at.timestamp() * 1000000))
+
+
+def serialize_card(kind, member):
+    serializer = CARD_SERIALIZERS[kind](member)
+    card = dict(serializer.data)
+    for field in CARD_ANNOTATIONS[kind]:
+        card[field] = serializer.fields[field].default
+    return card
+
+
+def get_cards(kind, members):
+    """
+    Cards of the members in order, with a single multi-get for the cache.
+    """
+    members = list(members)
+    if len(members) == 0:
+        return []
+
+    cache = get_cache()
+    keys = [get_card_key(kind, member) for member in members]
+    cards = cache.get_many(keys)
+
+    missed = {}
+    for key, member in zip(keys, members):
+        if key not in cards:
+            missed[key] = member
+    if len(missed) > 0:
+        prefetch_related_objects(list(missed.values()), *CARD_PREFETCHES[kind])
+        new_cards = {
+            key: serialize_card(kind, member) for key, member in missed.items()}
+        cache.set_many(new_cards, get_timeout())
+        cards.update(new_cards)
+
+    record_stats(kind, len(members) - len(missed), len(missed))
+
+    presence_fields = CARD_PRESENCE_FIELDS[kind]
+    if len(presence_fields) > 0:
+        statuses = get_statuses(members)
+        card_fields = CARD_SERIALIZERS[kind]().fields
+
+    result = []
+    for key, member in zip(keys, members):
+        card = dict(cards[key])
+        for field in CARD_ANNOTATIONS[kind]:
+            if hasattr(member, field):
+                card[field] = getattr(member, field)
+        for field in presence_fields:
+            value = statuses[member.id][field]
+            card[field] = None if value is None else card_fields[field].to_representation(value)
+        result.append(card)
+    return result
+
+
+def get_card(kind, member):
+    return get_cards(kind, [member])[0]
+
+
+def touch_members(queryset):
+    """
+    Move the members to new card keys.
+    """
+    return queryset.update(updated_at=timezone.now())
+
+
+def get_stats_key(kind, name):
+    return "profile_card_stats:{0}:{1}".format(kind, name)
+
+
+def record_stats(kind, hits, misses):
+    cache = get_cache()
+    for name, count in [("hits", hits), ("misses", misses)]:
+        if count > 0:
+            key = get_stats_key(kind, name)
+            cache.add(key, 0, None)
+            cache.incr(key, count)
+
+
+def get_stats():
+    cache = get_cache()
+    stats = {}
+    for kind in CARD_SERIALIZERS:
+        hits = cache.get(get_stats_key(kind, "hits"), 0)
+        misses = cache.get(get_stats_key(kind, "misses"), 0)
+        stats[kind] = {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / (hits + misses), 4) if hits + misses > 0 else None
+        }
+    return stats
+
+
+def reset_stats():
+    get_cache().delete_many([
+        get_stats_key(kind, name)
+        for kind in CARD_SERIALIZERS for name in ["hits", "misses"]])
+
+
+class ProfileCardField(serializers.Field):
+    """
+    Read only member card from the cache, in place of the nested
+    MainInfoSerializer or GeneralInfoSerializer.
+    """
+
+    def __init__(self, kind="main", many=False, **kwargs):
+        self.kind = kind
+        self.many = many
+        kwargs['read_only'] = True
+        super(ProfileCardField, self).__init__(**kwargs)
+
+    def get_attribute(self, instance):
+        value = super(ProfileCardField, self).get_attribute(instance)
+        if self.many and value is not None:
+            return list(value.all())
+        return value
+
+    def to_representation(self, value):
+        if self.many:
+            return get_cards(self.kind, value)
+        return get_card(self.kind, value)
@@ -0,0 +1,320 @@
+"""
+Bitmap facet index of the cast search
+
+Each Choice, CastClass, role, point_half bucket and the active members map
+to a bitmap of member ids, bit n standing for member n. search_casts
+intersects the bitmaps of the selected facets and loads a page of the
+remaining ids, instead of joining cast_status once per choice. The bitmaps
+are built from the database on first use and kept up to date by
+accounts.signals once changes commit.
+
+A load holds the lock of the backend from the build to the load, and the
+updates committed meanwhile wait for it, so none is lost between the two.
+"""
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from .models import Member
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# width of the point_half buckets
+POINT_BUCKET = 1000
+
+# active and registered members
+ACTIVE_FACET = "active:1"
+
+# most ids a search sends to the database as a list
+FACET_ID_LIMIT = 1000
+
+# member fields the facets read, besides cast_status
+FACET_FIELDS = {'cast_class', 'point_half', 'role', 'is_active', 'is_registered'}
+
+# redis keeps the first bit of a bitmap in the high bit of its first byte
+REVERSED_BITS = bytes(int('{:08b}'.format(value)[::-1], 2) for value in range(256))
+
+
+def get_choice_facet(choice_id):
+    return "choice:{}".format(choice_id)
+
+
+def get_class_facet(cast_class_id):
+    return "class:{}".format(cast_class_id)
+
+
+def get_point_facet(point_half):
+    return "point:{}".format(point_half // POINT_BUCKET)
+
+
+def get_role_facet(role):
+    return "role:{}".format(role)
+
+
+def to_bitmap(member_ids):
+    member_ids = list(member_ids)
+    if len(member_ids) == 0:
+        return 0
+
+    data = bytearray(max(member_ids) // 8 + 1)
+    for member_id in member_ids:
+        data[member_id >> 3] |= 1 << (member_id & 7)
+    return int.from_bytes(data, 'little')
+
+
+def to_ids(bitmap):
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+    return [
+        index * 8 + bit
+        for index, value in enumerate(data) if value
+        for bit in range(8) if value >> bit & 1]
+
+
+class MemoryFacets:
+    """
+    Bitmaps of this process, for tests and single process runs.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.load_lock = threading.RLock()
+        self.bitmaps = None
+
+    def loading(self):
+        return self.load_lock
+
+    def is_loaded(self):
+        return self.bitmaps is not None
+
+    def unload(self):
+        with self.lock:
+            self.bitmaps = None
+
+    def load(self, bitmaps):
+        with self.lock:
+            self.bitmaps = dict(bitmaps)
+
+    def get_bitmaps(self, facets):
+        with self.lock:
+            return [self.bitmaps.get(facet, 0) for facet in facets]
+
+    def add(self, facet, member_ids):
+        bitmap = to_bitmap(member_ids)
+        with self.lock:
+            self.bitmaps[facet] = self.bitmaps.get(facet, 0) | bitmap
+
+    def remove(self, facet, member_ids, prefix=False):
+        """
+        Clear the members from the facet, or from every facet starting with
+        it when prefix is set.
+        """
+        mask = ~to_bitmap(member_ids)
+        with self.lock:
+            facets = [name for name in self.bitmaps if name.startswith(facet)] if prefix else [facet]
+            for name in facets:
+                if name in self.bitmaps:
+                    self.bitmaps[name] &= mask
+
+    def drop(self, facet):
+        with self.lock:
+            self.bitmaps.pop(facet, None)
+
+
+class RedisFacets:
+    """
+    Bitmaps shared by every process as redis bitmaps, with the set of their
+    names to clear members from.
+    """
+    NAMES_KEY = "facets:names"
+    LOADED_KEY = "facets:loaded"
+    LOCK_KEY = "facets:lock"
+
+    # seconds a load may hold the lock
+    LOCK_TIMEOUT = 60 * 5
+
+    def __init__(self):
+        self.client = redis.Redis.from_url(settings.FACET_REDIS_URL)
+
+    def get_key(self, facet):
+        return "facets:{}".format(facet)
+
+    def loading(self):
+        return self.client.lock(self.LOCK_KEY, timeout=self.LOCK_TIMEOUT)
+
+    def is_loaded(self):
+        return self.client.exists(self.LOADED_KEY) > 0
+
+    def unload(self):
+        self.client.delete(self.LOADED_KEY)
+
+    def load(self, bitmaps):
+        pipeline = self.client.pipeline()
+        for facet in self.client.smembers(self.NAMES_KEY):
+            pipeline.delete(self.get_key(facet.decode()))
+        pipeline.delete(self.NAMES_KEY)
+        for facet, bitmap in bitmaps.items():
+            data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+            pipeline.set(self.get_key(facet), data.translate(REVERSED_BITS))
+            pipeline.sadd(self.NAMES_KEY, facet)
+        pipeline.set(self.LOADED_KEY, 1)
+        pipeline.execute()
+
+    def get_bitmaps(self, facets):
+        pipeline = self.client.pipeline(transaction=False)
+        for facet in facets:
+            pipeline.get(self.get_key(facet))
+        return [
+            int.from_bytes(data.translate(REVERSED_BITS), 'little') if data else 0
+            for data in pipeline.execute()]
+
+    def add(self, facet, member_ids):
+        pipeline = self.client.pipeline()
+        for member_id in member_ids:
+            pipeline.setbit(self.get_key(facet), member_id, 1)
+        pipeline.sadd(self.NAMES_KEY, facet)
+        pipeline.execute()
+
+    def remove(self, facet, member_ids, prefix=False):
+        if prefix:
+            facets = [name.decode() for name in self.client.smembers(self.NAMES_KEY)]
+            facets = [name for name in facets if name.startswith(facet)]
+        else:
+            facets = [facet]
+
+        pipeline = self.client.pipeline()
+        for name in facets:
+            for member_id in member_ids:
+                pipeline.setbit(self.get_key(name), member_id, 0)
+        pipeline.execute()
+
+    def drop(self, facet):
+        pipeline = self.client.pipeline()
+        pipeline.delete(self.get_key(facet))
+        pipeline.srem(self.NAMES_KEY, facet)
+        pipeline.execute()
+
+
+backends = {}
+
+
+def get_backend():
+    path = getattr(settings, 'FACET_BACKEND', 'accounts.facets.MemoryFacets')
+    if path not in backends:
+        backend_class = import_string(path)
+        if backend_class is RedisFacets and redis is None:
+            backend_class = MemoryFacets
+        backends[path] = backend_class()
+    return backends[path]
+
+
+def build_bitmaps():
+    """
+    Bitmaps of every facet from two queries.
+    """
+    facets = {}
+    for member in Member.all_objects.values_list(
+            'id', 'cast_class_id', 'point_half', 'role', 'is_active', 'is_registered', named=True):
+        for facet in get_member_facets(member):
+            facets.setdefault(facet, []).append(member.id)
+
+    for member_id, choice_id in Member.cast_status.through.objects.values_list('member_id', 'choice_id'):
+        facets.setdefault(get_choice_facet(choice_id), []).append(member_id)
+
+    return {facet: to_bitmap(member_ids) for facet, member_ids in facets.items()}
+
+
+def get_member_facets(member):
+    """
+    Facets of the member row, all but its choices.
+    """
+    facets = [get_point_facet(member.point_half), get_role_facet(member.role)]
+    if member.cast_class_id is not None:
+        facets.append(get_class_facet(member.cast_class_id))
+    if member.is_active and member.is_registered:
+        facets.append(ACTIVE_FACET)
+    return facets
+
+
+def get_facets():
+    backend = get_backend()
+    if not backend.is_loaded():
+        with backend.loading():
+            if not backend.is_loaded():
+                backend.load(build_bitmaps())
+    return backend
+
+
+def rebuild_facets():
+    backend = get_backend()
+    with backend.loading():
+        # updates committed from now on wait for the load
+        backend.unload()
+        bitmaps = build_bitmaps()
+        backend.load(bitmaps)
+    return len(bitmaps)
+
+
+def on_loaded_commit(update):
+    """
+    Apply the update once committed, unless the bitmaps are still to be
+    built. During a load it waits for the lock, as the build may have read
+    the rows before the commit.
+    """
+    def run():
+        backend = get_backend()
+        if backend.is_loaded():
+            update(backend)
+            return
+
+        with backend.loading():
+            if backend.is_loaded():
+                update(backend)
+
+    transaction.on_commit(run)
+
+
+def update_member_facets(member):
+    member_id, member_facets = member.id, get_member_facets(member)
+
+    def update(backend):
+        for prefix in ("class:", "point:", "role:", "active:"):
+            backend.remove(prefix, [member_id], prefix=True)
+        for facet in member_facets:
+            backend.add(facet, [member_id])
+
+    on_loaded_commit(update)
+
+
+def get_cast_ids(choices=(), cast_class=0, point_min=None, point_max=None):
+    """
+    Ids of the active casts having every choice, the class and a point_half
+    bucket of the range, or None without any of them. The buckets may hold
+    points just outside the range, which the caller still filters.
+    """
+    facets = [get_choice_facet(choice_id) for choice_id in set(choices)]
+    if cast_class > 0:
+        facets.append(get_class_facet(cast_class))
+    if len(facets) == 0 and (point_min is None or point_max is None):
+        return None
+    facets += [get_role_facet(0), ACTIVE_FACET]
+
+    bitmaps = get_facets().get_bitmaps(facets)
+
+    if point_min is not None and point_max is not None:
+        point_facets = [
+            "point:{}".format(bucket)
+            for bucket in range(max(point_min, 0) // POINT_BUCKET, max(point_max, 0) // POINT_BUCKET + 1)]
+        point_bitmap = 0
+        for bitmap in get_facets().get_bitmaps(point_facets):
+            point_bitmap |= bitmap
+        bitmaps.append(point_bitmap)
+
+    result = bitmaps[0]
+    for bitmap in bitmaps[1:]:
+        result &= bitmap
+    return to_ids(result)
@@ -0,0 +1,73 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from accounts.models import Member
+from accounts.normalize import normalize_name
+from accounts.search import rebuild_search_grams, search_members
+
+PREFIX = "bench_search_"
+
+SYLLABLES = [
+    "あ", "い", "さ", "く", "ら", "ゆ", "な", "み", "り", "か",
+    "ア", "イ", "サ", "ク", "ラ", "ユ", "ナ", "ミ", "リ", "カ",
+    "ｱ", "ｲ", "ｻ", "ｸ", "ﾗ", "ﾕ", "ﾅ", "ﾐ", "ﾘ", "ｶ",
+    "a", "i", "sa", "ku", "ra", "yu", "Na", "Mi", "Ri", "Ka",
+]
+
+
+class Command(BaseCommand):
+    help = 'Compare the nickname search on the n-gram index with icontains'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=1000000, help='Members to search, synthetic ones are added up to it')
+        parser.add_argument('--keywords', nargs='+', default=['さくら', 'ユイ', 'ﾐﾅ', 'ka', 'あ'])
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--cleanup', action='store_true', help='Delete the synthetic members and stop')
+
+    def handle(self, *args, **options):
+        if options['cleanup']:
+            deleted, _ = Member.all_objects.filter(username__startswith=PREFIX).hard_delete()
+            self.stdout.write(self.style.SUCCESS('Deleted {} rows'.format(deleted)))
+            return
+
+        self.fill(options['members'], options['batch_size'])
+
+        for keyword in options['keywords']:
+            scan_count, scan_time = self.measure(
+                lambda: Member.objects.filter(nickname__icontains=keyword).count(), options['repeat'])
+            index_count, index_time = self.measure(
+                lambda: search_members(Member.objects, "nickname", keyword).count(), options['repeat'])
+            self.stdout.write('{0}: icontains {1} rows {2:.1f}ms, index {3} rows {4:.1f}ms'.format(
+                keyword, scan_count, scan_time, index_count, index_time))
+
+    def fill(self, target, batch_size):
+        random.seed(target)
+        count = Member.objects.count()
+        last = Member.all_objects.filter(username__startswith=PREFIX).count()
+        while count < target:
+            size = min(batch_size, target - count)
+            members = []
+            for index in range(last, last + size):
+                nickname = "".join(random.choice(SYLLABLES) for _ in range(random.randint(2, 6)))
+                members.append(Member(
+                    username="{0}{1}".format(PREFIX, index),
+                    nickname=nickname,
+                    search_name=normalize_name(nickname),
+                    role=random.choice([0, 1])))
+            Member.objects.bulk_create(members)
+            rebuild_search_grams(Member.objects.filter(
+                username__in=[member.username for member in members]), batch_size)
+
+            count += size
+            last += size
+            self.stdout.write('{} members'.format(count))
+
+    def measure(self, run, repeat):
+        result = run()
+        started_at = time.perf_counter()
+        for _ in range(repeat):
+            run()
+        return result, (time.perf_counter() - started_at) * 1000 / max(repeat, 1)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from accounts.cards import get_stats, reset_stats
+
+
+class Command(BaseCommand):
+    help = 'Show the hit rates of the profile card cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after showing them')
+
+    def handle(self, *args, **options):
+        for kind, stats in get_stats().items():
+            hit_rate = "-" if stats['hit_rate'] is None else "{:.1%}".format(stats['hit_rate'])
+            self.stdout.write('{0}: {1} hits, {2} misses, hit rate {3}'.format(
+                kind, stats['hits'], stats['misses'], hit_rate))
+
+        if options['reset']:
+            reset_stats()
+            self.stdout.write(self.style.SUCCESS('Reset the counters'))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from accounts.facets import rebuild_facets
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the bitmaps of the cast search facets from the database'
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.SUCCESS('Rebuilt {} facets'.format(rebuild_facets())))
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.13 on 2026-10-18 07:50
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_auto_20201223_1417'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='member',
+            index_together={('is_present', 'presented_at')},
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 3.2.13 on 2026-10-18 08:09
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+from accounts.normalize import get_grams, normalize_name
+
+SEARCH_FIELDS = [(0, 'nickname'), (1, 'username'), (2, 'phone_number')]
+
+
+def index_names(apps, schema_editor):
+    Member = apps.get_model('accounts', 'Member')
+    MemberSearchGram = apps.get_model('accounts', 'MemberSearchGram')
+
+    members = Member.objects.order_by('id').only('id', 'nickname', 'username', 'phone_number')
+    last_id = 0
+    while True:
+        batch = list(members.filter(id__gt=last_id)[:1000])
+        if len(batch) == 0:
+            return
+
+        for member in batch:
+            member.search_name = normalize_name(member.nickname)
+        Member.objects.bulk_update(batch, ['search_name'])
+        MemberSearchGram.objects.bulk_create([
+            MemberSearchGram(member_id=member.id, field=field, gram=gram)
+            for member in batch for field, name in SEARCH_FIELDS for gram in get_grams(getattr(member, name))
+        ], batch_size=10000)
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_member_present_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='member',
+            name='search_name',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=190, verbose_name='検索用ニックネーム'),
+        ),
+        migrations.CreateModel(
+            name='MemberSearchGram',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field', models.IntegerField(choices=[(0, 'nickname'), (1, 'username'), (2, 'phone_number')], default=0, verbose_name='項目')),
+                ('gram', models.CharField(max_length=2, verbose_name='グラム')),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_grams', to=settings.AUTH_USER_MODEL, verbose_name='ユーザー')),
+            ],
+            options={
+                'verbose_name': '検索インデックス',
+                'verbose_name_plural': '検索インデックス',
+                'index_together': {('field', 'gram'), ('member', 'field')},
+            },
+        ),
+        migrations.RunPython(index_names, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.13 on 2026-10-18 08:14
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0004_member_search_index'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='member',
+            index_together={('role', 'is_active', 'is_present'), ('is_present', 'presented_at')},
+        ),
+    ]
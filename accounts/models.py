@@ -4,6 +4,7 @@ from django.db.models.fields import related
 from django_resized import ResizedImageField
 from django.core.validators import MaxValueValidator, MinValueValidator
 from .softmodels import SoftDeletionModel
+from .normalize import normalize_name
 from basics.models import Setting, CastClass, GuestLevel, Location, Choice
 
 # Create your models here.
@@ -128,6 +129,10 @@ class Detail(models.Model):
         'こんな話を話したい・聞きたい', default="", null=True, blank=True, max_length=100)
 
 
+# member fields only the point ledger of calls.ledger writes
+BALANCE_FIELDS = ['point', 'point_used', 'expire_times', 'expire_amount']
+
+
 class Member(SoftDeletionModel):
     def __str__(self):
         return self.username if self.username else "Undefined"
@@ -156,6 +161,8 @@ class Member(SoftDeletionModel):
         '電話番号', unique=True, null=True, blank=True, max_length=20)
     nickname = models.CharField(
         'ニックネーム', null=True, blank=True, max_length=190)
+    search_name = models.CharField(
+        '検索用ニックネーム', default="", blank=True, editable=False, db_index=True, max_length=190)
     avatars = models.ManyToManyField(
         Media, related_name="avatar", verbose_name='アバタ')
     is_registered = models.BooleanField('初期登録', default=False)
@@ -236,6 +243,28 @@ class Member(SoftDeletionModel):
 
     REQUIRED_FIELDS = ['email', 'nickname']
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Member, cls).from_db(db, field_names, values)
+        instance.keep_balances()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super(Member, self).refresh_from_db(using=using, fields=fields)
+        self.keep_balances(fields)
+
+    def keep_balances(self, fields=None):
+        """
+        Remember the balances as loaded, so a full save can tell they were
+        changed on the instance.
+        """
+        if not hasattr(self, '_loaded_balances'):
+            self._loaded_balances = {}
+        deferred = self.get_deferred_fields()
+        self._loaded_balances.update({
+            field: getattr(self, field) for field in BALANCE_FIELDS
+            if field not in deferred and (fields is None or field in fields)})
+
     def save(self, *args, **kwargs):
         isNewOne = self.pk is None
         if isNewOne:
@@ -244,13 +273,63 @@ class Member(SoftDeletionModel):
             self.detail = new_detail
             self.setting = new_setting
 
+        self.search_name = normalize_name(self.nickname)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'nickname' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'search_name'}
+
+        # the balances change through calls.ledger, a full save of a loaded
+        # row would write them back stale, so only listed ones are saved and
+        # a balance changed on the instance is refused instead of dropped
+        adding = self._state.adding
+        if not adding and len(args) == 0 and update_fields is None and not kwargs.get('force_insert'):
+            loaded = getattr(self, '_loaded_balances', {})
+            changed = [
+                field for field in BALANCE_FIELDS
+                if field in loaded and getattr(self, field) != loaded[field]]
+            if len(changed) > 0:
+                raise ValueError(
+                    "Member balances {} change through calls.ledger or save(update_fields=...)".format(
+                        ", ".join(changed)))
+
+            skipped = set(BALANCE_FIELDS) | self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.attname not in skipped]
+
         instance = super(Member, self).save(*args, **kwargs)
+        self.keep_balances(None if adding else kwargs.get('update_fields') or [])
         return instance
 
     class Meta:
         verbose_name = 'ユーザー'
         verbose_name_plural = 'ユーザー'
         unique_together = ('social_type', 'social_id')
+        index_together = [('is_present', 'presented_at'), ('role', 'is_active', 'is_present')]
+
+
+class MemberSearchGram(models.Model):
+    """
+    N-gram index of the normalized member names, see accounts.search.
+    """
+    FIELD_CHOICES = (
+        (0, 'nickname'),
+        (1, 'username'),
+        (2, 'phone_number')
+    )
+
+    member = models.ForeignKey(
+        Member,
+        on_delete=models.CASCADE,
+        related_name='search_grams',
+        verbose_name='ユーザー')
+    field = models.IntegerField('項目', choices=FIELD_CHOICES, default=0)
+    gram = models.CharField('グラム', max_length=2)
+
+    class Meta:
+        verbose_name = '検索インデックス'
+        verbose_name_plural = '検索インデックス'
+        index_together = [('field', 'gram'), ('member', 'field')]
 
 
 class TransferInfo(models.Model):
@@ -0,0 +1,37 @@
+"""
+Normalization of member names for search
+
+Names are compared after NFKC (full-width and half-width forms), with
+katakana folded to hiragana and lowercased, so "ｱｲ", "アイ" and "あい" match.
+"""
+import unicodedata
+
+# katakana ァ..ヶ sit 0x60 above their hiragana
+KATAKANA_START = 0x30A1
+KATAKANA_END = 0x30F6
+KANA_OFFSET = 0x60
+
+
+def normalize_name(value):
+    if not value:
+        return ""
+
+    value = unicodedata.normalize('NFKC', value)
+    value = "".join(
+        chr(ord(char) - KANA_OFFSET) if KATAKANA_START <= ord(char) <= KATAKANA_END else char
+        for char in value)
+    return value.lower().strip()
+
+
+def get_grams(value):
+    """
+    Bigrams of the normalized value, and its last character so that every
+    character starts at least one gram.
+    """
+    value = normalize_name(value)
+    if value == "":
+        return set()
+
+    grams = {value[index:index + 2] for index in range(len(value) - 1)}
+    grams.add(value[-1])
+    return grams
@@ -0,0 +1,102 @@
+"""
+Member name search on the n-gram index
+
+Every member has the grams of their normalized nickname, username and phone
+number in MemberSearchGram. A search reads the members holding all grams of
+the keyword from the index, then checks the candidates against the
+normalized value, in SQL for the nickname and in Python for the fields
+without a normalized column, so no search scans the member table.
+"""
+from django.db.models import Count
+
+from .models import Member, MemberSearchGram
+from .normalize import get_grams, normalize_name
+
+SEARCH_FIELDS = {name: field for field, name in MemberSearchGram.FIELD_CHOICES}
+
+# lookup of the normalized value, used to check the candidates; the fields
+# without a normalized column are normalized and checked here
+VERIFY_LOOKUPS = {
+    "nickname": "search_name__contains",
+}
+
+
+def get_member_grams(member):
+    return {
+        field: get_grams(getattr(member, name))
+        for name, field in SEARCH_FIELDS.items()
+    }
+
+
+def update_search_grams(member):
+    """
+    Rewrite the grams of the fields whose value changed.
+    """
+    existing = {field: set() for field in SEARCH_FIELDS.values()}
+    for field, gram in MemberSearchGram.objects.filter(member=member).values_list('field', 'gram'):
+        existing[field].add(gram)
+
+    rows = []
+    for field, grams in get_member_grams(member).items():
+        if grams == existing[field]:
+            continue
+        if len(existing[field]) > 0:
+            MemberSearchGram.objects.filter(member=member, field=field).delete()
+        rows.extend(MemberSearchGram(member=member, field=field, gram=gram) for gram in grams)
+
+    MemberSearchGram.objects.bulk_create(rows)
+    return len(rows)
+
+
+def rebuild_search_grams(queryset, batch_size=1000):
+    """
+    Rebuild the index of the members in batches, for backfills and benchmarks.
+    """
+    total = 0
+    members = queryset.order_by('id').only('id', 'nickname', 'username', 'phone_number')
+    last_id = 0
+    while True:
+        batch = list(members.filter(id__gt=last_id)[:batch_size])
+        if len(batch) == 0:
+            return total
+
+        MemberSearchGram.objects.filter(member__in=batch).delete()
+        rows = [
+            MemberSearchGram(member_id=member.id, field=field, gram=gram)
+            for member in batch for field, grams in get_member_grams(member).items() for gram in grams]
+        MemberSearchGram.objects.bulk_create(rows, batch_size=batch_size * 10)
+        total += len(batch)
+        last_id = batch[-1].id
+
+
+def get_candidate_ids(field, keyword):
+    field = SEARCH_FIELDS[field]
+    if len(keyword) == 1:
+        # a single character starts the grams holding it
+        return MemberSearchGram.objects.filter(
+            field=field, gram__startswith=keyword).values('member_id')
+
+    grams = {gram for gram in get_grams(keyword) if len(gram) == 2}
+    # collations folding kana may count more rows, never fewer
+    return MemberSearchGram.objects.filter(field=field, gram__in=grams).values(
+        'member_id').annotate(matched=Count('id')).filter(matched__gte=len(grams)).values('member_id')
+
+
+def search_members(queryset, field, keyword, prefix=""):
+    """
+    Filter the queryset to the members whose field contains the keyword,
+    ignoring width, kana and case. The prefix reaches the member from other
+    models, as in "user__".
+    """
+    keyword = normalize_name(keyword)
+    if keyword == "":
+        return queryset
+
+    candidates = Member.all_objects.filter(id__in=get_candidate_ids(field, keyword))
+    if field in VERIFY_LOOKUPS:
+        member_ids = candidates.filter(**{VERIFY_LOOKUPS[field]: keyword}).values('id')
+    else:
+        member_ids = [
+            member_id for member_id, value in candidates.values_list('id', field)
+            if keyword in normalize_name(value)]
+    return queryset.filter(**{"{}id__in".format(prefix): member_ids})
@@ -2,6 +2,8 @@
 Serializers for Auth
 """
 
+from django.db import models
+from django.db.models import prefetch_related_objects
 from django.utils import timezone
 
 from rest_framework import serializers
@@ -11,6 +13,7 @@ from rest_framework_jwt.serializers import JSONWebTokenSerializer
 from drf_extra_fields.fields import Base64ImageField
 from accounts.models import Member, Media, Detail, TransferInfo, Friendship
 from basics.serializers import ClassesSerializer, LevelsSerializer, LocationSerializer, SettingSerializer, ChoiceSerializer
+from chat.presence import PresenceField, PresenceListSerializer
 
 
 class EmailRegisterSerializer(serializers.Serializer):
@@ -167,6 +170,23 @@ class TransferInfoSerializer(serializers.ModelSerializer):
         }
 
 
+# relations MemberSerializer reads, loaded for a whole list at once
+MEMBER_PREFETCHES = [
+    'avatars', 'setting', 'detail', 'cast_status', 'introducer', 'transfer_infos',
+    'favorites', 'location', 'cast_class', 'guest_level']
+
+
+class MemberListSerializer(PresenceListSerializer):
+    """
+    Loads the relations of the whole list before serializing it
+    """
+
+    def to_representation(self, data):
+        members = list(data.all() if isinstance(data, models.Manager) else data)
+        prefetch_related_objects(members, *MEMBER_PREFETCHES)
+        return super(MemberListSerializer, self).to_representation(members)
+
+
 class MemberSerializer(serializers.ModelSerializer):
     avatars = MediaImageSerializer(read_only=True, many=True)
     setting = SettingSerializer(read_only=True)
@@ -176,6 +196,7 @@ class MemberSerializer(serializers.ModelSerializer):
     transfer_infos = TransferInfoSerializer(many=True)
     favorites = serializers.SerializerMethodField()
     location = LocationSerializer(read_only=True)
+    status = PresenceField()
     cast_class = ClassesSerializer(read_only=True)
     guest_level = LevelsSerializer(read_only=True)
 
@@ -211,6 +232,17 @@ class MemberSerializer(serializers.ModelSerializer):
             'back_ratio'
         )
         model = Member
+        list_serializer_class = MemberListSerializer
 
     def get_favorites(self, obj):
-        return list(obj.favorites.values_list('favorite_id', flat=True))
+        return [favorite.favorite_id for favorite in obj.favorites.all()]
+
+    def to_representation(self, instance):
+        from calls.ledger import get_house_point, is_house_member
+
+        data = super(MemberSerializer, self).to_representation(instance)
+
+        # the house balance is spread over the ledger shards
+        if is_house_member(instance):
+            data['point'] = get_house_point()
+        return data
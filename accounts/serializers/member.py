@@ -4,18 +4,22 @@ Serializers for Member
 
 from datetime import datetime
 from django.core.exceptions import ValidationError
+from django.db import models
+from django.db.models import Avg, Count, Prefetch, Q, prefetch_related_objects
 from django.db.models.fields import EmailField
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from dateutil.parser import parse
 
-from rest_framework import serializers, status
+from rest_framework import serializers
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
 
-from accounts.models import Media, Tweet, Member, TransferApplication, Detail
+from accounts.models import BALANCE_FIELDS, Media, Tweet, FavoriteTweet, Member, TransferApplication, Detail
 from basics.serializers import LevelsSerializer, ClassesSerializer, LocationSerializer, ChoiceSerializer
 from .auth import DetailSerializer, MediaImageSerializer, MemberSerializer, TransferInfoSerializer
+from calls.ledger import is_house_member, refresh_balance, set_house_point, set_point
+from chat.presence import PresenceField, PresenceListSerializer
 
 
 def file_validator(file):
@@ -92,6 +96,7 @@ class GeneralInfoSerializer(serializers.ModelSerializer):
     cast_class = ClassesSerializer(read_only=True)
     job = serializers.SerializerMethodField()
     annual = serializers.SerializerMethodField()
+    status = PresenceField()
 
     class Meta:
         fields = (
@@ -112,6 +117,7 @@ class GeneralInfoSerializer(serializers.ModelSerializer):
             'role'
         )
         model = Member
+        list_serializer_class = PresenceListSerializer
 
     def get_job(self, obj):
         return "" if not obj.detail.job else obj.detail.job
@@ -120,6 +126,47 @@ class GeneralInfoSerializer(serializers.ModelSerializer):
         return "" if not obj.detail.annual else obj.detail.annual
 
 
+def get_user_prefetches():
+    """
+    Prefetch plan of UserSerializer, in a fixed number of queries.
+    """
+    return [
+        'detail', 'location', 'cast_class', 'guest_level', 'avatars', 'cast_status', 'transfer_infos',
+        Prefetch(
+            'introducer',
+            queryset=Member.all_objects.select_related(
+                'location').prefetch_related('avatars')),
+    ]
+
+
+def set_review_stats(users):
+    """
+    Average stars and five star count of the reviews of the users, in one query.
+    """
+    stats = {
+        user_id: (average_stars, five_reviews)
+        for user_id, average_stars, five_reviews in Member.all_objects.filter(
+            id__in=[user.id for user in users]).annotate(
+                average_stars=Avg('review_sources__stars'),
+                five_reviews=Count('review_sources', filter=Q(review_sources__stars=5))).values_list(
+                    'id', 'average_stars', 'five_reviews')}
+    for user in users:
+        user.review_stats = stats.get(user.id, (None, 0))
+
+
+class UserListSerializer(serializers.ListSerializer):
+    """
+    Applies the prefetch plan and the review stats to the whole page before
+    serializing it
+    """
+
+    def to_representation(self, data):
+        users = list(data.all() if isinstance(data, models.Manager) else data)
+        prefetch_related_objects(users, *get_user_prefetches())
+        set_review_stats(users)
+        return super(UserListSerializer, self).to_representation(users)
+
+
 class UserSerializer(serializers.ModelSerializer):
     average_review = serializers.SerializerMethodField()
     five_reviews = serializers.SerializerMethodField()
@@ -194,18 +241,22 @@ class UserSerializer(serializers.ModelSerializer):
             'memo': {'allow_blank': True},
             'inviter_code': {'read_only': True}
         }
+        list_serializer_class = UserListSerializer
+
+    def get_review_stats(self, obj):
+        if not hasattr(obj, 'review_stats'):
+            set_review_stats([obj])
+        return obj.review_stats
 
     def get_average_review(self, obj):
-        from django.db.models import Avg
-        average_stars = obj.review_sources.aggregate(Avg('stars'))[
-            'stars__avg']
+        average_stars = self.get_review_stats(obj)[0]
         if average_stars:
             return round(average_stars, 2)
         else:
             return 0
 
     def get_five_reviews(self, obj):
-        return obj.review_sources.filter(stars=5).count()
+        return self.get_review_stats(obj)[1]
 
     def create(self, validated_data):
         detail = validated_data.pop('detail')
@@ -260,6 +311,12 @@ class UserSerializer(serializers.ModelSerializer):
                 raise serializers.ValidationError(
                     {"password": "password length is at least 8"})
 
+        # balances the admin changed in the form, the others may have moved
+        # through the ledger since it was loaded
+        balances = {
+            field: validated_data.pop(field) for field in BALANCE_FIELDS
+            if field in validated_data and validated_data[field] != getattr(instance, field)}
+
         for attr, value in validated_data.items():
             setattr(instance, attr, value)
 
@@ -289,6 +346,20 @@ class UserSerializer(serializers.ModelSerializer):
 
         instance.detail = cur_detail
         instance.save()
+
+        # the point is set as an adjustment invoice, the counters directly,
+        # both moving updated_at so the cached cards are refreshed
+        if 'point' in balances:
+            point = balances.pop('point')
+            if is_house_member(instance):
+                set_house_point(point)
+                refresh_balance(instance)
+            else:
+                set_point(instance, point)
+        if len(balances) > 0:
+            for field, value in balances.items():
+                setattr(instance, field, value)
+            instance.save(update_fields=list(balances) + ['updated_at'])
         return instance
 
 
@@ -304,6 +375,40 @@ def getInviterCode():
     return random_id
 
 
+def get_tweet_prefetches():
+    """
+    Prefetch plan of TweetSerializer: the images, the writer and the
+    registered likers of the tweets, newest like first.
+    """
+    return [
+        'images',
+        Prefetch(
+            'user',
+            queryset=Member.all_objects.select_related(
+                'location').prefetch_related('avatars')),
+        Prefetch(
+            'tweet_likers',
+            queryset=FavoriteTweet.objects.filter(
+                liker__deleted_at=None, liker__is_registered=True).order_by('-created_at').prefetch_related(
+                    Prefetch(
+                        'liker',
+                        queryset=Member.objects.select_related(
+                            'location').prefetch_related('avatars'))),
+            to_attr='registered_likers'),
+    ]
+
+
+class TweetListSerializer(serializers.ListSerializer):
+    """
+    Applies the prefetch plan to the whole page before serializing it
+    """
+
+    def to_representation(self, data):
+        tweets = list(data.all() if isinstance(data, models.Manager) else data)
+        prefetch_related_objects(tweets, *get_tweet_prefetches())
+        return super(TweetListSerializer, self).to_representation(tweets)
+
+
 class TweetSerializer(serializers.ModelSerializer):
     medias = serializers.ListField(
         child=serializers.FileField(
@@ -334,12 +439,13 @@ class TweetSerializer(serializers.ModelSerializer):
             "category",
             "updated_at")
         model = Tweet
+        list_serializer_class = TweetListSerializer
 
     def get_likers(self, obj):
-        likers_id = obj.tweet_likers.all().order_by('-created_at').values_list('liker')
-        like_users = MainInfoSerializer(Member.objects.filter(
-            id__in=likers_id, is_registered=True), many=True)
-        return like_users.data
+        if not hasattr(obj, 'registered_likers'):
+            prefetch_related_objects([obj], *get_tweet_prefetches())
+        return MainInfoSerializer(
+            [like.liker for like in obj.registered_likers], many=True).data
 
     def create(self, validated_data):
         media_ids = []
@@ -0,0 +1,98 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from basics.models import CastClass, Choice, GuestLevel, Location
+from .cards import touch_members
+from .facets import FACET_FIELDS, get_choice_facet, get_class_facet, on_loaded_commit, update_member_facets
+from .models import Detail, Media, Member
+from .search import SEARCH_FIELDS, update_search_grams
+
+
+@receiver(post_save, sender=Detail)
+def detail_saved(sender, instance, **kwargs):
+    touch_members(Member.objects.filter(detail=instance))
+
+
+@receiver(post_save, sender=Media)
+@receiver(pre_delete, sender=Media)
+def media_changed(sender, instance, **kwargs):
+    touch_members(Member.objects.filter(avatars=instance))
+
+
+@receiver(m2m_changed, sender=Member.avatars.through)
+def avatars_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ['post_add', 'post_remove', 'pre_clear']:
+        return
+
+    if not reverse:
+        touch_members(Member.objects.filter(id=instance.id))
+    elif action == 'pre_clear':
+        touch_members(Member.objects.filter(avatars=instance))
+    else:
+        touch_members(Member.objects.filter(id__in=pk_set))
+
+
+@receiver(post_save, sender=CastClass)
+def cast_class_saved(sender, instance, created, **kwargs):
+    if not created:
+        touch_members(Member.objects.filter(cast_class=instance))
+
+
+@receiver(post_save, sender=GuestLevel)
+def guest_level_saved(sender, instance, created, **kwargs):
+    if not created:
+        touch_members(Member.objects.filter(guest_level=instance))
+
+
+@receiver(post_save, sender=Location)
+def location_saved(sender, instance, created, **kwargs):
+    if not created:
+        touch_members(Member.objects.filter(location=instance))
+
+
+@receiver(post_save, sender=Member)
+def member_saved(sender, instance, update_fields, **kwargs):
+    if update_fields is None or len(set(update_fields) & set(SEARCH_FIELDS)) > 0:
+        update_search_grams(instance)
+    if update_fields is None or len(set(update_fields) & FACET_FIELDS) > 0:
+        update_member_facets(instance)
+
+
+@receiver(m2m_changed, sender=Member.cast_status.through)
+def cast_status_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ['post_add', 'post_remove', 'pre_clear']:
+        return
+
+    if not reverse:
+        member_ids = [instance.id]
+        if action == 'pre_clear':
+            on_loaded_commit(lambda backend: backend.remove("choice:", member_ids, prefix=True))
+            return
+        facets = [get_choice_facet(choice_id) for choice_id in pk_set]
+    else:
+        facet = get_choice_facet(instance.id)
+        if action == 'pre_clear':
+            on_loaded_commit(lambda backend: backend.drop(facet))
+            return
+        member_ids, facets = list(pk_set), [facet]
+
+    def update(backend):
+        for facet in facets:
+            if action == 'post_add':
+                backend.add(facet, member_ids)
+            else:
+                backend.remove(facet, member_ids)
+
+    on_loaded_commit(update)
+
+
+@receiver(post_delete, sender=Choice)
+def choice_deleted(sender, instance, **kwargs):
+    facet = get_choice_facet(instance.id)
+    on_loaded_commit(lambda backend: backend.drop(facet))
+
+
+@receiver(post_delete, sender=CastClass)
+def cast_class_deleted(sender, instance, **kwargs):
+    facet = get_class_facet(instance.id)
+    on_loaded_commit(lambda backend: backend.drop(facet))
@@ -1,13 +1,29 @@
 from __future__ import absolute_import, unicode_literals
 from .models import Member
+from chat.tasks import enqueue, broadcast_presents
 from celery import shared_task
+from django.db import transaction
 from django.utils import timezone
 
 
 @shared_task
 def present_cast():
-    for user in Member.objects.filter(is_present=True, role=0):
-        if user.presented_at < timezone.now():
-            user.is_present = False
-            user.presented_at = None
-            user.save()
+    with transaction.atomic():
+        expired_ids = list(
+            Member.objects.select_for_update().filter(
+                is_present=True,
+                role=0,
+                presented_at__lt=timezone.now()).values_list(
+                'id', flat=True))
+        if len(expired_ids) == 0:
+            return 0
+
+        # bulk expiry, updated_at is kept as is
+        Member.objects.filter(id__in=expired_ids).update(
+            is_present=False, presented_at=None)
+
+        # notify guests
+        enqueue(broadcast_presents, expired_ids, "remove")
+
+    print("present cast expired {}".format(len(expired_ids)))
+    return len(expired_ids)
@@ -1,3 +1,287 @@
 """
 Tests for Accounts
 """
+import threading
+from unittest import mock
+
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from basics.models import CastClass, Choice
+from . import facets
+from .cards import get_cache, get_card, get_card_key, get_cards, get_stats, get_timeout, reset_stats
+from .models import Detail, Media, Member, MemberSearchGram
+from .normalize import normalize_name
+from .search import rebuild_search_grams, search_members
+
+
+@override_settings(DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage')
+class ProfileCardTest(TestCase):
+    """
+    Member cards are cached by updated_at and moved on related changes
+    """
+
+    def setUp(self):
+        get_cache().clear()
+        self.cast_class = CastClass.objects.create(name="ゴールド")
+        self.casts = [
+            Member.objects.create(
+                username="cast{}".format(index),
+                email="cast{}@example.com".format(index),
+                nickname="cast{}".format(index),
+                role=0,
+                cast_class=self.cast_class)
+            for index in range(3)]
+
+    def get_casts(self):
+        return list(Member.objects.filter(role=0).order_by('id'))
+
+    def test_multi_get(self):
+        cards = get_cards("general", self.get_casts())
+        self.assertEqual([card['nickname'] for card in cards], ["cast0", "cast1", "cast2"])
+
+        casts = self.get_casts()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_cards("general", casts), cards)
+
+        stats = get_stats()["general"]
+        self.assertEqual(stats["hits"], 3)
+        self.assertEqual(stats["misses"], 3)
+        self.assertEqual(stats["hit_rate"], 0.5)
+
+        reset_stats()
+        self.assertIsNone(get_stats()["general"]["hit_rate"])
+
+    def test_invalidation(self):
+        get_cards("general", self.get_casts())
+
+        cast = self.get_casts()[0]
+        cast.nickname = "renamed"
+        cast.save()
+        self.assertEqual(get_card("general", cast)['nickname'], "renamed")
+
+        detail = Detail.objects.get(pk=cast.detail_id)
+        detail.job = "engineer"
+        detail.save()
+        self.assertEqual(get_card("general", self.get_casts()[0])['job'], "engineer")
+
+        media = Media.objects.create(uri="avatars/cast0.png")
+        cast.avatars.add(media)
+        self.assertEqual(len(get_card("general", self.get_casts()[0])['avatars']), 1)
+
+        self.cast_class.name = "プラチナ"
+        self.cast_class.save()
+        self.assertEqual(
+            [card['cast_class']['name'] for card in get_cards("general", self.get_casts())],
+            ["プラチナ"] * 3)
+
+    def test_annotations_are_not_cached(self):
+        cast = self.get_casts()[0]
+        cast.overall_points = 100
+        self.assertEqual(get_card("main", cast)['overall_points'], 100)
+
+        cast = self.get_casts()[0]
+        self.assertEqual(get_card("main", cast)['overall_points'], 0)
+
+    @override_settings(AWS_QUERYSTRING_EXPIRE=3600, PROFILE_CARD_TIMEOUT=60 * 60 * 24)
+    def test_timeout_below_url_expiry(self):
+        self.assertLess(get_timeout(), 3600)
+
+        get_card("main", self.get_casts()[0])
+        key = get_card_key("main", self.get_casts()[0])
+        ttl = get_cache().client.pttl(get_cache().make_key(key))
+        self.assertTrue(0 < ttl <= get_timeout() * 1000)
+
+
+class MemberSearchTest(TestCase):
+    """
+    Name search ignores width, kana and case through the n-gram index
+    """
+
+    def setUp(self):
+        self.members = [
+            Member.objects.create(
+                username="user{}".format(index),
+                email="user{}@example.com".format(index),
+                nickname=nickname,
+                phone_number="0901234000{}".format(index))
+            for index, nickname in enumerate(["さくら", "ユイ", "Mina", "ｻｸﾗｺ"])]
+
+    def search(self, field, keyword):
+        return sorted(search_members(Member.objects, field, keyword).values_list('username', flat=True))
+
+    def test_normalize(self):
+        self.assertEqual(normalize_name("ｻｸﾗ"), "さくら")
+        self.assertEqual(normalize_name("ＭＩＮＡ "), "mina")
+        self.assertEqual(normalize_name(None), "")
+
+    def test_search(self):
+        self.assertEqual(self.search("nickname", "サクラ"), ["user0", "user3"])
+        self.assertEqual(self.search("nickname", "ゆい"), ["user1"])
+        self.assertEqual(self.search("nickname", "ｍｉｎ"), ["user2"])
+        self.assertEqual(self.search("nickname", "ら"), ["user0", "user3"])
+        self.assertEqual(self.search("nickname", "さら"), [])
+        self.assertEqual(self.search("username", "USER1"), ["user1"])
+        self.assertEqual(self.search("phone_number", "４０００３"), ["user3"])
+        self.assertEqual(len(self.search("nickname", "")), 4)
+
+    def test_search_raw_columns(self):
+        Member.objects.create(
+            username="ＴＡＲＯ", email="taro@example.com", nickname="たろう", phone_number="０８０１１１１")
+        self.assertEqual(self.search("username", "taro"), ["ＴＡＲＯ"])
+        self.assertEqual(self.search("username", "ｔａｒｏ"), ["ＴＡＲＯ"])
+        self.assertEqual(self.search("phone_number", "0801"), ["ＴＡＲＯ"])
+
+    def test_related_search(self):
+        self.members[1].introducer = self.members[0]
+        self.members[1].save()
+        introduced = search_members(Member.objects, "nickname", "さくら", "introducer__")
+        self.assertEqual(list(introduced), [self.members[1]])
+
+    def test_rename(self):
+        member = self.members[0]
+        member.nickname = "ハナ"
+        member.save(update_fields=['nickname'])
+        self.assertEqual(self.search("nickname", "はな"), ["user0"])
+        self.assertEqual(self.search("nickname", "さくら"), ["user3"])
+
+        with self.assertNumQueries(1):
+            member.save(update_fields=['point'])
+
+    def test_rebuild(self):
+        MemberSearchGram.objects.all().delete()
+        self.assertEqual(self.search("nickname", "ゆい"), [])
+        self.assertEqual(rebuild_search_grams(Member.objects, batch_size=2), 4)
+        self.assertEqual(self.search("nickname", "ゆい"), ["user1"])
+
+
+@override_settings(
+    FACET_BACKEND='accounts.facets.MemoryFacets',
+    DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage')
+class FacetIndexTest(TestCase):
+    """
+    Cast search intersects the facet bitmaps kept up to date on commit
+    """
+
+    def setUp(self):
+        facets.backends.clear()
+        get_cache().clear()
+        self.gold = CastClass.objects.create(name="ゴールド")
+        self.choices = [Choice.objects.create(name="choice{}".format(index), category='c') for index in range(3)]
+        self.casts = [
+            Member.objects.create(
+                username="cast{}".format(index),
+                email="cast{}@example.com".format(index),
+                role=0,
+                is_registered=True,
+                point_half=point_half,
+                cast_class=self.gold if index < 2 else None)
+            for index, point_half in enumerate([2000, 3500, 5000])]
+        self.casts[0].cast_status.set(self.choices[:2])
+        self.casts[1].cast_status.set(self.choices)
+        self.casts[2].cast_status.set(self.choices[1:])
+
+    def get_ids(self, *args, **kwargs):
+        return sorted(facets.get_cast_ids(*args, **kwargs))
+
+    def test_bitmaps(self):
+        self.assertEqual(facets.to_ids(facets.to_bitmap([0, 9, 64, 1000])), [0, 9, 64, 1000])
+        self.assertEqual(facets.to_ids(0), [])
+
+    def test_intersection(self):
+        choice_ids = [choice.id for choice in self.choices]
+        self.assertEqual(self.get_ids(choice_ids[:2]), [self.casts[0].id, self.casts[1].id])
+        self.assertEqual(self.get_ids(choice_ids[1:], self.gold.id), [self.casts[1].id])
+        self.assertEqual(self.get_ids(choice_ids[1:2], point_min=3000, point_max=5000), [self.casts[1].id, self.casts[2].id])
+        self.assertEqual(self.get_ids([0]), [])
+        self.assertIsNone(facets.get_cast_ids())
+
+    def test_incremental(self):
+        choice_ids = [choice.id for choice in self.choices]
+        facets.get_facets()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.casts[0].cast_status.remove(self.choices[0])
+            self.choices[2].member_set.add(self.casts[0])
+        self.assertEqual(self.get_ids(choice_ids[:1]), [self.casts[1].id])
+        self.assertEqual(self.get_ids(choice_ids[2:]), [cast.id for cast in self.casts])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.casts[2].cast_class = self.gold
+            self.casts[2].point_half = 12000
+            self.casts[2].save()
+            self.casts[1].cast_status.clear()
+        self.assertEqual(self.get_ids(choice_ids[1:], self.gold.id), [self.casts[0].id, self.casts[2].id])
+        self.assertEqual(self.get_ids(choice_ids[1:], point_min=0, point_max=9000), [self.casts[0].id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.choices[2].delete()
+        self.assertEqual(self.get_ids(choice_ids[2:]), [])
+
+    def test_search_casts(self):
+        client = APIClient()
+        client.force_authenticate(self.casts[0])
+        choice_ids = [choice.id for choice in self.choices]
+
+        response = client.get('/api/accounts/casts/search', {'choices': choice_ids[1:], 'page': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(card['id'] for card in response.data), [self.casts[1].id, self.casts[2].id])
+
+        response = client.get('/api/accounts/casts/search', {
+            'choices': choice_ids[:2], 'cast_class': self.gold.id, 'point_min': 3000, 'point_max': 4000, 'page': 1})
+        self.assertEqual([card['id'] for card in response.data], [self.casts[1].id])
+
+    @mock.patch('accounts.views.member.FACET_ID_LIMIT', 0)
+    def test_search_casts_joined(self):
+        client = APIClient()
+        client.force_authenticate(self.casts[0])
+        choice_ids = [choice.id for choice in self.choices]
+
+        # too many casts for an id list, a cast has to match every choice
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/api/accounts/casts/search', {'choices': choice_ids[1:], 'page': 1})
+        self.assertEqual(sorted(card['id'] for card in response.data), [self.casts[1].id, self.casts[2].id])
+        page_query = [query['sql'] for query in queries if 'HAVING' in query['sql']]
+        self.assertEqual(len(page_query), 1)
+        self.assertEqual(page_query[0].count('JOIN "accounts_member_cast_status"'), 1)
+
+        response = client.get('/api/accounts/casts/search', {'choices': choice_ids, 'page': 1})
+        self.assertEqual([card['id'] for card in response.data], [self.casts[1].id])
+
+    def test_active_casts(self):
+        choice_ids = [choice.id for choice in self.choices]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.casts[1].is_active = False
+            self.casts[1].save()
+        facets.get_facets()
+        self.assertEqual(self.get_ids(choice_ids[1:]), [self.casts[2].id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.casts[1].is_active = True
+            self.casts[1].save()
+            self.casts[2].role = 1
+            self.casts[2].save()
+        self.assertEqual(self.get_ids(choice_ids[1:]), [self.casts[1].id])
+
+    def test_update_during_load(self):
+        choice_ids = [choice.id for choice in self.choices]
+        build_bitmaps = facets.build_bitmaps
+        updates = []
+
+        def build():
+            # built before the commit, its update runs while loading
+            bitmaps = build_bitmaps()
+            with self.captureOnCommitCallbacks() as callbacks:
+                self.casts[2].cast_status.add(self.choices[0])
+            updates.extend(threading.Thread(target=callback) for callback in callbacks)
+            for update in updates:
+                update.start()
+            return bitmaps
+
+        with mock.patch('accounts.facets.build_bitmaps', build):
+            facets.get_facets()
+        for update in updates:
+            update.join()
+        self.assertEqual(self.get_ids(choice_ids[:1]), [self.casts[0].id, self.casts[1].id, self.casts[2].id])
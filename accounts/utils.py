@@ -1,32 +1,47 @@
+from accounts.models import Member
 from accounts.serializers.auth import MemberSerializer
-from .serializers.member import GeneralInfoSerializer
+from .cards import get_card, get_cards
 
-# use channel
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from chat.broadcast import broadcast, broadcast_each
 from datetime import timedelta
 from dateutil.parser import parse
 import pytz
 
 
 def send_present(cast, event, guest_ids):
-    channel_layer = get_channel_layer()
-    for receiver_id in guest_ids:
-        async_to_sync(
-            channel_layer.group_send)(
-            "chat_{}".format(receiver_id), {
-                "type": "cast_present.send", "content": {
-                    "cast": GeneralInfoSerializer(cast).data, "event": event}})
+    return broadcast(
+        guest_ids, {
+            "type": "cast_present.send", "content": {
+                "cast": get_card("general", cast), "event": event}})
+
+
+def send_presents(casts, event, guest_ids):
+    """
+    Send the present event of several casts to every guest in one broadcast.
+    """
+    guest_ids = list(dict.fromkeys(guest_ids))
+    cast_items = get_cards("general", casts)
+    return broadcast_each([
+        (guest_id, {"type": "cast_present.send", "content": {"cast": cast_item, "event": event}})
+        for cast_item in cast_items for guest_id in guest_ids
+    ])
 
 
 def send_user(cast):
-    channel_layer = get_channel_layer()
-    async_to_sync(channel_layer.group_send)(
-        "chat_{}".format(cast.id),
+    return broadcast(
+        [cast.id],
         {"type": "user.send", "content": MemberSerializer(cast).data}
     )
 
 
+def get_active_guest_ids():
+    return list(
+        Member.objects.filter(
+            role=1,
+            is_active=True).values_list(
+            'id', flat=True))
+
+
 def get_edge_time(cur_date_str, cur_type):
     if cur_type == "from":
         cur_date = parse(cur_date_str)
@@ -30,7 +30,8 @@ from django_rest_passwordreset.signals import reset_password_token_created
 
 from accounts.models import Member
 from accounts.serializers.auth import *
-from chat.models import Room, Message
+from chat.models import Room
+from chat.utils import create_message
 
 
 class EmailLoginView(JSONWebTokenAPIView):
@@ -141,18 +142,8 @@ class LineLoginView(APIView):
                         system_room.last_message = system_message
                         system_room.save()
 
-                        Message.objects.create(
-                            content=system_message,
-                            room=system_room,
-                            sender=system_user,
-                            receiver=system_user,
-                            is_read=True)
-                        Message.objects.create(
-                            content=system_message,
-                            room=system_room,
-                            sender=system_user,
-                            receiver=user_obj,
-                            is_read=False)
+                        create_message(
+                            system_room, system_user, [user_obj], system_message)
 
                         admin_room, is_created = Room.objects.get_or_create(
                             room_type="admin", title="Gui運営局", users__id=user_obj.id)
@@ -160,18 +151,8 @@ class LineLoginView(APIView):
                         admin_room.last_message = admin_message
                         admin_room.save()
 
-                        Message.objects.create(
-                            content=admin_message,
-                            room=admin_room,
-                            sender=admin_user,
-                            receiver=admin_user,
-                            is_read=True)
-                        Message.objects.create(
-                            content=admin_message,
-                            room=admin_room,
-                            sender=admin_user,
-                            receiver=user_obj,
-                            is_read=False)
+                        create_message(
+                            admin_room, admin_user, [user_obj], admin_message)
 
                 else:
                     if user_obj.deleted_at is not None:
@@ -6,6 +6,7 @@ import requests
 
 from django.core.paginator import Paginator
 from django.conf import settings
+from django.db import transaction
 from django.db.models import Q, query
 from django.http import Http404
 
@@ -20,12 +21,17 @@ from rest_framework.permissions import AllowAny, IsAuthenticated, BasePermission
 from accounts.serializers.member import *
 from accounts.serializers.auth import MemberSerializer, MediaImageSerializer, DetailSerializer, TransferInfoSerializer
 from accounts.models import Member, Tweet, FavoriteTweet, Detail, TransferInfo, Friendship
-from accounts.utils import get_edge_time, send_present, send_user
-from chat.models import Room, Message
+from accounts.utils import get_edge_time, send_user
+from accounts.cards import get_cards
+from accounts.facets import FACET_ID_LIMIT, get_cast_ids
+from accounts.search import search_members
+from chat.models import Room
 from calls.models import Invoice
 from calls.axes import create_axes_payment
+from calls.ledger import apply_deltas, is_house_member, post_entries, refresh_balance, set_house_point, set_point
 from basics.serializers import ChoiceSerializer
-from chat.utils import send_room_to_users, send_message_to_user
+from chat.utils import send_room_to_users, create_message
+from chat.tasks import enqueue, broadcast_present
 
 
 class IsSuperuserPermission(BasePermission):
@@ -477,8 +483,8 @@ class UserView(
                 # phone_number
                 phone_number = query_obj.get("phone_number", "")
                 if phone_number != "":
-                    query_set = query_set.filter(
-                        phone_number__icontains=phone_number)
+                    query_set = search_members(
+                        query_set, "phone_number", phone_number)
 
                 # is_applied
                 is_applied = query_obj.get("is_applied", -1)
@@ -518,11 +524,12 @@ class UserView(
             # nickname
             nickname = query_obj.get("nickname", "")
             if nickname != "":
-                query_set = query_set.filter(nickname__icontains=nickname)
+                query_set = search_members(query_set, "nickname", nickname)
 
             # username
             username = query_obj.get("username", "")
-            query_set = query_set.filter(username__icontains=username)
+            if username != "":
+                query_set = search_members(query_set, "username", username)
 
             # introducer id
             introducer_id = query_obj.get("introducer_id", 0)
@@ -609,9 +616,7 @@ def get_fresh_casts(request):
         started_at__gt=three_months_ago,
         is_active=True)
     return Response(
-        GeneralInfoSerializer(
-            casts,
-            many=True).data,
+        get_cards("general", casts),
         status=status.HTTP_200_OK)
 
 
@@ -620,9 +625,7 @@ def get_fresh_casts(request):
 def get_present_casts(request):
     casts = Member.objects.filter(role=0, is_present=True, is_active=True)
     return Response(
-        GeneralInfoSerializer(
-            casts,
-            many=True).data,
+        get_cards("general", casts),
         status=status.HTTP_200_OK)
 
 
@@ -647,7 +650,7 @@ def search_casts(request):
 
         nickname = input_data.get('nickname', "")
         if nickname != "":
-            queryset = queryset.filter(nickname__icontains=nickname)
+            queryset = search_members(queryset, "nickname", nickname)
 
         # is new
         is_new = input_data.get('is_new', False)
@@ -663,19 +666,26 @@ def search_casts(request):
         point_max = input_data.get('point_max', 30000)
         queryset = queryset.filter(point_half__lte=point_max)
 
-        # choices
+        # choices, intersected on the facet index with the active casts,
+        # or with one cast_status join grouped by cast when too many casts
+        # are left for an id list
         choices = input_data.get('choices', [])
-        for choice_item in choices:
-            queryset = queryset.filter(cast_status__id=choice_item)
+        if len(choices) > 0:
+            cast_ids = get_cast_ids(choices, cast_class, point_min, point_max)
+            if len(cast_ids) <= FACET_ID_LIMIT:
+                queryset = queryset.filter(id__in=cast_ids)
+            else:
+                choices = set(choices)
+                queryset = queryset.filter(cast_status__id__in=choices).annotate(
+                    choice_count=Count('cast_status', distinct=True)).filter(choice_count=len(choices))
 
         start_index = (page - 1) * size
 
         return Response(
-            GeneralInfoSerializer(
+            get_cards(
+                "general",
                 queryset.order_by("-started_at")
-                .all()[(start_index):(start_index + size)],
-                many=True
-            ).data,
+                .all()[(start_index):(start_index + size)]),
             status=status.HTTP_200_OK)
     else:
         return Response(status=status.HTTP_400_BAD_REQUEST)
@@ -708,7 +718,7 @@ def search_guests(request):
         # nickname
         nickname = input_data.get('nickname', "")
         if nickname != "":
-            queryset = queryset.filter(nickname__icontains=nickname)
+            queryset = search_members(queryset, "nickname", nickname)
 
         # salary
         salary = input_data.get('salary', 0)
@@ -721,11 +731,10 @@ def search_guests(request):
             queryset = queryset.filter(favorite__icontains=favorite)
 
         return Response(
-            GeneralInfoSerializer(
+            get_cards(
+                "general",
                 queryset.order_by("-started_at")
-                .all()[(start_index):(start_index + size)],
-                many=True
-            ).data,
+                .all()[(start_index):(start_index + size)]),
             status=status.HTTP_200_OK)
     else:
         return Response(status=status.HTTP_400_BAD_REQUEST)
@@ -811,8 +820,8 @@ class TransferView(generics.GenericAPIView):
             # nickname
             nickname = query_obj.get("nickname", "")
             if nickname != "":
-                query_set = query_set.filter(
-                    user__nickname__icontains=nickname)
+                query_set = search_members(
+                    query_set, "nickname", nickname, "user__")
 
             # transfer category
             transfer_cat = query_obj.get("transfer_cat", -1)
@@ -902,16 +911,16 @@ class TransferInfoView(
 @api_view(["GET"])
 @permission_classes([IsSuperuserPermission])
 def proceed_transfer(request, id):
-    cur_transfer = TransferApplication.objects.get(pk=id)
-    cur_transfer.status = 1
-    cur_transfer.save()
+    with transaction.atomic():
+        cur_transfer = TransferApplication.objects.select_for_update().get(pk=id)
 
-    # cast point update
-    # print(cur_transfer.user.point)
-    cur_transfer.user.point = cur_transfer.user.point - cur_transfer.point
-    # print(cur_transfer.user.point)
-    cur_transfer.user.save()
-    send_user(cur_transfer.user)
+        # cast point update, once per transfer
+        if cur_transfer.status != 1:
+            cur_transfer.status = 1
+            cur_transfer.save()
+            apply_deltas({cur_transfer.user_id: {"point": -cur_transfer.point}})
+
+    send_user(refresh_balance(cur_transfer.user))
 
     return Response({"success": True}, status=status.HTTP_200_OK)
 
@@ -943,22 +952,12 @@ def like_person(request, id):
         send_room_to_users(new_room, [target_user.id, cur_user.id], "create")
 
         # send message
-        cur_message = Message.objects.create(
-            room=new_room,
-            sender=cur_user,
-            receiver=cur_user,
-            is_like=True,
-            is_read=True)
-        send_message_to_user(cur_message, cur_user.id)
-
-        target_message = Message.objects.create(
-            room=new_room,
-            sender=cur_user,
-            receiver=target_user,
+        create_message(
+            new_room,
+            cur_user,
+            [target_user],
             is_like=True,
-            is_read=False,
-            follower=cur_message)
-        send_message_to_user(target_message, target_user.id)
+            notify_sender=True)
     else:
         new_room = Room.objects.filter(
             room_type="private").filter(
@@ -1118,16 +1117,10 @@ def toggle_present(request):
     cur_user.save()
 
     # notify to guests
-    guest_ids = list(
-        Member.objects.filter(
-            role=1,
-            is_active=True).values_list(
-            'id',
-            flat=True))
     if cur_user.is_present:
-        send_present(cur_user, "add", guest_ids)
+        enqueue(broadcast_present, cur_user.id, "add")
     else:
-        send_present(cur_user, "remove", guest_ids)
+        enqueue(broadcast_present, cur_user.id, "remove")
 
     return Response(MemberSerializer(cur_user).data)
 
@@ -1143,16 +1136,12 @@ def buy_point(request):
         if not create_axes_payment(request.user, point):
             return Response(status=status.HTTP_406_NOT_ACCEPTABLE)
         else:
-            user.point += point
-            user.save()
-
             # create invoice
-            Invoice.objects.create(
-                taker=request.user,
-                take_amount=point,
-                invoice_type="BUY")
+            post_entries(
+                [Invoice(taker=user, take_amount=point, invoice_type="BUY")],
+                {user.id: {"point": point}})
 
-            return Response(MemberSerializer(user).data)
+            return Response(MemberSerializer(refresh_balance(user)).data)
     else:
         return Response(status=status.HTTP_400_BAD_REQUEST)
 
@@ -1219,8 +1208,14 @@ def update_admin_profile(request):
 
         admin.nickname = new_nickname
         admin.username = new_username
-        admin.point = point
         admin.save()
+
+        # the change of the balance is recorded as an adjustment invoice,
+        # the house balance is spread over the ledger shards
+        if is_house_member(admin):
+            set_house_point(point)
+        else:
+            set_point(admin, point)
         return Response(
             MemberSerializer(admin).data,
             status=status.HTTP_200_OK)
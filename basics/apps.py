@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class BasicsConfig(AppConfig):
     name = 'basics'
+
+    def ready(self):
+        from . import signals  # noqa
@@ -0,0 +1,139 @@
+"""
+Reference data cache for basics
+
+Any write to the reference models bumps one global version once committed.
+Built payloads are kept in process and in the shared cache under that
+version, and the GET responses send it as their ETag. Payloads with
+presigned urls get a version that also moves before the urls expire.
+"""
+import hashlib
+import time
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .models import Choice, Location
+from .serializers import ChoiceSerializer, LocationSerializer
+
+VERSION_KEY = "basics:version"
+
+# payloads of this process, name -> (version, data)
+LOCAL_SIZE = 1000
+local_payloads = {}
+
+# seconds a presigned url is still served before it expires
+URL_MARGIN = 60 * 5
+
+
+def get_cache():
+    return caches[getattr(settings, 'BASICS_CACHE', 'default')]
+
+
+def get_version():
+    cache = get_cache()
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, str(time.time_ns()), None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def bump_version():
+    transaction.on_commit(
+        lambda: get_cache().set(VERSION_KEY, str(time.time_ns()), None))
+
+
+def get_url_timeout():
+    return getattr(settings, 'AWS_QUERYSTRING_EXPIRE', 3600) - URL_MARGIN
+
+
+def get_signed_version(version):
+    """
+    Version of the payloads with presigned urls, moved every url timeout so
+    no payload or ETag outlives its urls.
+    """
+    return "{0}-{1}".format(version, int(time.time() // get_url_timeout()))
+
+
+def get_request_name(request, params):
+    """
+    Payload name of the request, from its path and the query params its
+    view reads, so other params do not make new payloads.
+    """
+    values = [(param, request.GET[param]) for param in params if param in request.GET]
+    return "{0}?{1}".format(request.path, urlencode(values))
+
+
+def get_etag(version):
+    return '"basics-{}"'.format(version)
+
+
+def get_reference(name, build, version=None, timeout=None):
+    """
+    Payload of the current version, built only if no process has it yet.
+    """
+    if version is None:
+        version = get_version()
+
+    local = local_payloads.get(name)
+    if local is not None and local[0] == version:
+        return local[1]
+
+    cache = get_cache()
+    key = "basics:{0}:{1}".format(version, hashlib.md5(name.encode()).hexdigest())
+    data = cache.get(key)
+    if data is None:
+        data = build()
+        if timeout is None:
+            timeout = getattr(settings, 'BASICS_CACHE_TIMEOUT', None)
+        cache.set(key, data, timeout)
+
+    if len(local_payloads) >= LOCAL_SIZE:
+        local_payloads.clear()
+    local_payloads[name] = (version, data)
+    return data
+
+
+def get_locations():
+    return get_reference("locations", lambda: [
+        dict(item) for item in LocationSerializer(
+            Location.objects.order_by('order'), many=True).data])
+
+
+def get_location_tree():
+    """
+    Top locations with their children nested, from the one location query.
+    """
+    def build():
+        nodes = {item['id']: dict(item, children=[]) for item in get_locations()}
+        tree = []
+        for node in nodes.values():
+            if node['parent'] in nodes:
+                nodes[node['parent']]['children'].append(node)
+            else:
+                tree.append(node)
+        return tree
+
+    return get_reference("location_tree", build)
+
+
+def get_choice_groups(category):
+    """
+    Choices of a category grouped by subcategory in one query, the groups in
+    order of their first choice and the choices by order.
+    """
+    def build():
+        groups = {}
+        first_ids = {}
+        for choice in Choice.objects.filter(category=category).order_by('order', 'id'):
+            groups.setdefault(choice.subcategory, []).append(choice)
+            first_ids[choice.subcategory] = min(
+                choice.id, first_ids.get(choice.subcategory, choice.id))
+
+        return [
+            {"name": subcategory, "data": ChoiceSerializer(groups[subcategory], many=True).data}
+            for subcategory in sorted(groups, key=lambda subcategory: first_ids[subcategory])]
+
+    return get_reference("choices:{}".format(category), build)
@@ -0,0 +1,22 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .cache import bump_version
+from .models import Banner, CastClass, Choice, CostPlan, Gift, GuestLevel, Location, ReceiptSetting
+
+REFERENCE_MODELS = [Location, CastClass, GuestLevel, Choice, Gift, CostPlan, Banner, ReceiptSetting]
+
+
+def reference_changed(sender, **kwargs):
+    bump_version()
+
+
+for model in REFERENCE_MODELS:
+    post_save.connect(reference_changed, sender=model, dispatch_uid="basics_version_save_{}".format(model.__name__))
+    post_delete.connect(reference_changed, sender=model, dispatch_uid="basics_version_delete_{}".format(model.__name__))
+
+
+@receiver(m2m_changed, sender=CostPlan.classes.through)
+def plan_classes_changed(sender, action, **kwargs):
+    if action in ['post_add', 'post_remove', 'post_clear']:
+        bump_version()
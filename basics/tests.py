@@ -1,3 +1,100 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+
+from accounts.models import Member
+from .cache import VERSION_KEY, get_cache, get_signed_version, local_payloads
+from .models import Choice, Location
+
+
+class ReferenceCacheTest(TestCase):
+    """
+    Reference data is built once per version and validated by ETag
+    """
+
+    def setUp(self):
+        get_cache().clear()
+        local_payloads.clear()
+
+        self.client = APIClient()
+        self.client.force_authenticate(
+            Member.objects.create(username="guest", email="guest@example.com"))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            tokyo = Location.objects.create(name="東京", order=1, shown=True)
+            osaka = Location.objects.create(name="大阪", order=2)
+            Location.objects.create(name="六本木", parent=tokyo, order=2, shown=True)
+            Location.objects.create(name="銀座", parent=tokyo, order=1)
+            Location.objects.create(name="梅田", parent=osaka, order=1)
+
+            for order, (subcategory, name) in enumerate([
+                    ("気分", "まったり"), ("雰囲気", "綺麗系"), ("気分", "ワイワイ"), ("雰囲気", "可愛い系")]):
+                Choice.objects.create(category='s', subcategory=subcategory, name=name, order=order)
+
+    def test_location_tree(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/basics/locations', {'tree': 1})
+        self.assertEqual(
+            [(node['name'], [child['name'] for child in node['children']]) for node in response.data],
+            [("東京", ["銀座", "六本木"]), ("大阪", ["梅田"])])
+
+        # children of a parent come from the same location query
+        tokyo_id = response.data[0]['id']
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/basics/locations', {'pid': tokyo_id, 'shown': 1})
+        self.assertEqual([item['name'] for item in response.data], ["六本木"])
+
+    def test_choice_groups(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/basics/choices', {'category': 's'})
+        self.assertEqual(
+            [(group['name'], [item['name'] for item in group['data']]) for group in response.data],
+            [("気分", ["まったり", "ワイワイ"]), ("雰囲気", ["綺麗系", "可愛い系"])])
+
+    def test_etag(self):
+        response = self.client.get('/api/basics/locations')
+        etag = response['ETag']
+        self.assertEqual(len(response.data), 2)
+
+        response = self.client.get('/api/basics/locations', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # any write moves the version
+        with self.captureOnCommitCallbacks(execute=True):
+            Location.objects.create(name="福岡", order=3)
+
+        response = self.client.get('/api/basics/locations', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(response.data), 3)
+
+    def test_unread_params(self):
+        self.client.get('/api/basics/choices', {'category': 's'})
+
+        # params the view does not read reuse the payload
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/basics/choices', {'category': 's', '_': 12345})
+        self.assertEqual(len(response.data), 2)
+
+    def test_shared_version(self):
+        version = self.client.get('/api/basics/locations')['ETag']
+
+        # another process bumped the version
+        local_payloads.clear()
+        get_cache().set(VERSION_KEY, "other", None)
+        self.assertNotEqual(self.client.get('/api/basics/locations')['ETag'], version)
+
+    @override_settings(AWS_QUERYSTRING_EXPIRE=3600)
+    def test_signed_version(self):
+        with mock.patch('basics.cache.time.time', return_value=0):
+            version = get_signed_version("1")
+            etag = self.client.get('/api/basics/banners')['ETag']
+        with mock.patch('basics.cache.time.time', return_value=3299):
+            self.assertEqual(get_signed_version("1"), version)
+            self.assertEqual(self.client.get('/api/basics/banners', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # moved before the urls of the first payload expire
+        with mock.patch('basics.cache.time.time', return_value=3300):
+            self.assertNotEqual(get_signed_version("1"), version)
+            self.assertEqual(self.client.get('/api/basics/banners', HTTP_IF_NONE_MATCH=etag).status_code, 200)
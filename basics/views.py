@@ -10,6 +10,8 @@ from rest_framework.views import APIView
 
 from .serializers import *
 from .models import *
+from .cache import bump_version, get_etag, get_version, get_reference, get_locations, get_location_tree, \
+    get_choice_groups, get_request_name, get_signed_version, get_url_timeout
 from accounts.serializers.auth import MemberSerializer
 
 # Create your views here.
@@ -22,6 +24,29 @@ class IsAdminPermission(BasePermission):
         return request.user.role < 0
 
 
+def reference_response(request, build, params=(), signed=False):
+    """
+    Cached reference data of the request, or 304 if the client has it.
+
+    params are the query params the payload depends on, signed is set for
+    the payloads with presigned image urls.
+    """
+    version = get_version()
+    timeout = None
+    if signed:
+        version = get_signed_version(version)
+        timeout = get_url_timeout()
+
+    etag = get_etag(version)
+    if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+    return Response(
+        get_reference(get_request_name(request, params), build, version, timeout),
+        status=status.HTTP_200_OK,
+        headers={'ETag': etag})
+
+
 class LocationView(
         mixins.CreateModelMixin,
         mixins.UpdateModelMixin,
@@ -38,19 +63,20 @@ class LocationView(
 
         return super(LocationView, self).get_permissions()
 
-    def get(self, request):
+    def get(self, request, *args, **kwargs):
         id_num = int(request.query_params.get("pid", "0"))
         shown = int(request.query_params.get("shown", "0"))
-        queryset = Location.objects
-        if id_num > 0:
-            queryset = queryset.filter(parent__id=id_num)
-        else:
-            queryset = queryset.filter(parent=None)
-        if shown == 1:
-            queryset = queryset.filter(shown=True)
-        queryset = queryset.order_by('order')
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data, status.HTTP_200_OK)
+
+        # whole tree
+        if request.query_params.get("tree", "0") == "1":
+            return reference_response(request, get_location_tree, ('tree',))
+
+        def build():
+            return [
+                item for item in get_locations()
+                if item['parent'] == (id_num if id_num > 0 else None) and (shown != 1 or item['shown'])]
+
+        return reference_response(request, build, ('pid', 'shown'))
 
     def post(self, request, *args, **kwargs):
         if request.data['parent'] is not None:
@@ -73,6 +99,7 @@ class LocationChangeOrder(APIView):
             for item in input_data:
                 cur_id = item.pop('id')
                 Location.objects.filter(pk=cur_id).update(**item)
+            bump_version()
             return Response({"success": True})
         else:
             return Response(status=status.HTTP_400_BAD_REQUEST)
@@ -99,7 +126,8 @@ class ClassesView(
         return super().get_queryset().order_by('order')
 
     def get(self, request, *args, **kwargs):
-        return self.list(request, *args, **kwargs)
+        return reference_response(
+            request, lambda: self.list(request, *args, **kwargs).data)
 
     def post(self, request, *args, **kwargs):
         return self.create(request, *args, **kwargs)
@@ -129,7 +157,8 @@ class LevelsView(
         return super(LevelsView, self).get_permissions()
 
     def get(self, request, *args, **kwargs):
-        return self.list(request, *args, **kwargs)
+        return reference_response(
+            request, lambda: self.list(request, *args, **kwargs).data)
 
     def post(self, request, *args, **kwargs):
         return self.create(request, *args, **kwargs)
@@ -165,21 +194,10 @@ class ChoiceView(
     def get(self, request, *args, **kwargs):
         category = request.GET.get('category', "")
         if category != "":
-            subcategory_values = list(Choice.objects.filter(
-                category=category).values_list('subcategory').distinct())
-            return_value = []
-            for sub_item in subcategory_values:
-                cur_data = {}
-                cur_data['name'] = sub_item[0]
-                cur_data['data'] = ChoiceSerializer(
-                    Choice.objects.filter(
-                        category=category,
-                        subcategory=sub_item[0]).order_by('order'),
-                    many=True).data
-                return_value.append(cur_data)
-            return Response(return_value, status=status.HTTP_200_OK)
+            return reference_response(request, lambda: get_choice_groups(category), ('category',))
         else:
-            return self.list(request, *args, **kwargs)
+            return reference_response(
+                request, lambda: self.list(request, *args, **kwargs).data, ('page',))
 
     def post(self, request, *args, **kwargs):
         return self.create(request, *args, **kwargs)
@@ -208,7 +226,8 @@ class ReceiptView(
         return super(ReceiptView, self).get_permissions()
 
     def get(self, request, *args, **kwargs):
-        return self.list(request, *args, **kwargs)
+        return reference_response(
+            request, lambda: self.list(request, *args, **kwargs).data)
 
     def post(self, request, *args, **kwargs):
         return self.create(request, *args, **kwargs)
@@ -235,7 +254,8 @@ class BannerView(
         return super(BannerView, self).get_permissions()
 
     def get(self, request, *args, **kwargs):
-        return self.list(request, *args, **kwargs)
+        return reference_response(
+            request, lambda: self.list(request, *args, **kwargs).data, signed=True)
 
     def post(self, request, *args, **kwargs):
         return self.create(request, *args, **kwargs)
@@ -292,13 +312,11 @@ class GiftView(
         if is_shown != "":
             queryset = Gift.objects.filter(
                 is_shown=True, image__isnull=False, location__isnull=False)
-            return Response(
-                GiftSerializer(
-                    queryset,
-                    many=True).data,
-                status=status.HTTP_200_OK)
+            return reference_response(
+                request, lambda: GiftSerializer(queryset, many=True).data, ('is_shown',), signed=True)
         else:
-            return self.list(request, *args, **kwargs)
+            return reference_response(
+                request, lambda: self.list(request, *args, **kwargs).data, ('page',), signed=True)
 
     def post(self, request, *args, **kwargs):
         return self.create(request, *args, **kwargs)
@@ -333,13 +351,11 @@ class CostPlanView(
         if location_id > 0:
             queryset = CostPlan.objects.filter(
                 location_id=location_id).order_by('cost')
-            return Response(
-                CostplanSerializer(
-                    queryset,
-                    many=True).data,
-                status=status.HTTP_200_OK)
+            return reference_response(
+                request, lambda: CostplanSerializer(queryset, many=True).data, ('location',))
         else:
-            return self.list(request, *args, **kwargs)
+            return reference_response(
+                request, lambda: self.list(request, *args, **kwargs).data, ('page',))
 
     def post(self, request, *args, **kwargs):
         return self.create(request, *args, **kwargs)
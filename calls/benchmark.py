@@ -0,0 +1,103 @@
+"""
+Latency and query counts of the hot endpoints
+
+Each endpoint is requested through the DRF test client as a seeded member,
+and the percentiles, query counts and response sizes are kept as a json
+baseline that later runs are compared against.
+"""
+import time
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from accounts.models import Member
+from chat.models import Room
+from .seed import SEED_PREFIX
+
+# a run is a regression when it is this much slower than the baseline
+REGRESSION_RATIO = 1.5
+
+
+def get_seeded_users():
+    seeded = Member.objects.filter(username__startswith=SEED_PREFIX)
+    guest = seeded.filter(role=1, rooms__isnull=False, orders__isnull=False).order_by('id').first()
+    cast = seeded.filter(role=0, cast_class__isnull=False, rooms__isnull=False).order_by('id').first()
+    admin = Member.objects.filter(is_superuser=True).order_by('id').first()
+    if admin is None:
+        admin = Member.objects.create_superuser("{}admin".format(SEED_PREFIX), "", "")
+    return guest, cast, admin
+
+
+def get_endpoints():
+    """
+    Name, user and url with query of each endpoint.
+    """
+    guest, cast, admin = get_seeded_users()
+    if guest is None or cast is None:
+        return []
+
+    room = Room.objects.filter(users=guest).order_by('-updated_at').first()
+    # two choices of a seeded cast, so the facet intersection finds casts
+    choices = list(cast.cast_status.order_by('id').values_list('id', flat=True)[:2])
+    return [
+        ("room_list", guest, "/api/chat/rooms", {"page": 1}),
+        ("message_list", guest, "/api/chat/rooms/{}/messages".format(room.id), {"page": 1}),
+        ("get_ranking", guest, "/api/calls/ranking", {"isCast": "true", "range": 2}),
+        ("search_casts", guest, "/api/accounts/casts/search", {
+            "page": 1, "point_min": 0, "point_max": 30000, "choices": choices}),
+        ("order_cast", cast, "/api/calls/orders/cast", {"mode": "all", "page": 1}),
+        ("get_month_data", admin, "/api/calls/month_data", {}),
+    ]
+
+
+def percentile(values, ratio):
+    values = sorted(values)
+    return values[min(int(len(values) * ratio), len(values) - 1)]
+
+
+def run_endpoint(user, url, params, repeat=10):
+    client = APIClient()
+    client.force_authenticate(user)
+
+    # the first request fills the caches of the process
+    client.get(url, params)
+
+    timings = []
+    for _ in range(max(repeat, 1)):
+        with CaptureQueriesContext(connection) as context:
+            started_at = time.perf_counter()
+            response = client.get(url, params)
+            timings.append((time.perf_counter() - started_at) * 1000)
+
+    return {
+        "status": response.status_code,
+        "queries": len(context.captured_queries),
+        "bytes": len(response.content),
+        "p50": round(percentile(timings, 0.5), 2),
+        "p90": round(percentile(timings, 0.9), 2),
+        "p99": round(percentile(timings, 0.99), 2),
+    }
+
+
+def run_benchmark(repeat=10):
+    return {
+        name: run_endpoint(user, url, params, repeat)
+        for name, user, url, params in get_endpoints()
+    }
+
+
+def compare_results(baseline, results):
+    """
+    Regressions of the results against the baseline, as messages.
+    """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result["queries"] > before["queries"]:
+            regressions.append("{0}: {1} queries, was {2}".format(name, result["queries"], before["queries"]))
+        if result["p90"] > before["p90"] * REGRESSION_RATIO:
+            regressions.append("{0}: p90 {1}ms, was {2}ms".format(name, result["p90"], before["p90"]))
+    return regressions
@@ -0,0 +1,226 @@
+"""
+Billing of the joins from their times
+
+The points of a join are computed on the server from its order and its
+times, in place of the values the client sends with the settlement:
+
+- base: cost_value per 30 minutes of the ordered period
+- extension: cost_extended per started 30 minutes past the period
+- night: night_fund once when the join overlaps the night window of the
+  order, taken daily in Asia/Tokyo
+- desire: desire_cost for a cast joined by priority matching
+
+The cast gets back_ratio percent of the base and the extension, and the
+night and desire back ratios of the order for the rest. Every join of the
+selection is computed at once with NumPy arrays, so re-billing a month of
+joins is a handful of array operations after one query.
+"""
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytz
+from django.db.models import F
+from django.utils import timezone
+
+from .models import InvoiceDetail, Join
+
+# Asia/Tokyo has no daylight saving time
+LOCAL_OFFSET = 9 * 60 * 60
+DAY = 24 * 60 * 60
+UNIT = 30 * 60
+
+JOIN_FIELDS = [
+    'id', 'order_id', 'user_id', 'selection', 'started_at', 'ended_at',
+    'order__period', 'order__cost_value', 'order__cost_extended',
+    'order__night_started_at', 'order__night_ended_at', 'order__night_fund', 'order__night_back_ratio',
+    'order__desire_cost', 'order__desire_back_ratio', 'user__back_ratio']
+
+# values of the preview, named as the fields of InvoiceDetail
+RESULT_FIELDS = [
+    'join_time', 'extend_min', 'night_min', 'base_point', 'extend_point', 'night_point', 'desire_point',
+    'total_point', 'cast_base_point', 'cast_extend_point', 'cast_night_point', 'cast_desire_point', 'cast_point']
+
+
+def get_billed_joins(order_id=None, started_from=None, started_to=None):
+    """
+    Confirmed joins that have started, of one order or started in a range.
+    """
+    query_set = Join.objects.filter(status=1, dropped=False, started_at__isnull=False)
+    if order_id is not None:
+        query_set = query_set.filter(order_id=order_id)
+    if started_from is not None:
+        query_set = query_set.filter(started_at__gte=started_from)
+    if started_to is not None:
+        query_set = query_set.filter(started_at__lt=started_to)
+    return query_set.order_by('id')
+
+
+def to_seconds(value):
+    return -1 if value is None else value.hour * 3600 + value.minute * 60 + value.second
+
+
+def night_seconds(times, window_start, window_end):
+    """
+    Seconds of the night windows from the local epoch to the times. A window
+    ending before it starts runs over midnight.
+    """
+    local_times = times + LOCAL_OFFSET
+    days, seconds = np.divmod(local_times, DAY)
+
+    crossing = window_end < window_start
+    length = np.where(crossing, window_end + DAY - window_start, window_end - window_start)
+    within = np.where(
+        crossing,
+        np.clip(seconds, 0, window_end) + np.clip(seconds - window_start, 0, DAY - window_start),
+        np.clip(seconds - window_start, 0, np.maximum(length, 0)))
+    return days * length + within
+
+
+def compute_points(columns, until):
+    """
+    Points of the joins from their columns, a dict of JOIN_FIELDS to arrays.
+    Joins not ended yet are billed until the given time.
+    """
+    started = columns['started_at']
+    ended = np.where(columns['ended_at'] < 0, until, columns['ended_at'])
+    ended = np.maximum(ended, started)
+    duration = ended - started
+
+    period = columns['order__period'] * 3600
+    extend_units = -(-np.maximum(duration - period, 0) // UNIT)
+    base_point = columns['order__cost_value'] * 2 * columns['order__period']
+    extend_point = extend_units * columns['order__cost_extended']
+
+    window_start, window_end = columns['order__night_started_at'], columns['order__night_ended_at']
+    has_night = (window_start >= 0) & (window_end >= 0) & (window_start != window_end)
+    night_start = np.where(has_night, window_start, 0)
+    night_end = np.where(has_night, window_end, 0)
+    night = np.where(
+        has_night, night_seconds(ended, night_start, night_end) - night_seconds(started, night_start, night_end), 0)
+    night_point = np.where(night > 0, columns['order__night_fund'], 0)
+
+    desire_point = np.where(columns['selection'] == 1, columns['order__desire_cost'], 0)
+
+    cast_base_point = base_point * columns['user__back_ratio'] // 100
+    cast_extend_point = extend_point * columns['user__back_ratio'] // 100
+    cast_night_point = night_point * columns['order__night_back_ratio'] // 100
+    cast_desire_point = desire_point * columns['order__desire_back_ratio'] // 100
+
+    return {
+        'join_time': duration // 60,
+        'extend_min': extend_units * 30,
+        'night_min': night // 60,
+        'base_point': base_point,
+        'extend_point': extend_point,
+        'night_point': night_point,
+        'desire_point': desire_point,
+        'total_point': base_point + extend_point + night_point + desire_point,
+        'cast_base_point': cast_base_point,
+        'cast_extend_point': cast_extend_point,
+        'cast_night_point': cast_night_point,
+        'cast_desire_point': cast_desire_point,
+        'cast_point': cast_base_point + cast_extend_point + cast_night_point + cast_desire_point,
+    }
+
+
+def load_columns(query_set):
+    rows = list(query_set.values_list(*JOIN_FIELDS))
+    columns = {}
+    for index, field in enumerate(JOIN_FIELDS):
+        values = [row[index] for row in rows]
+        if field in ['started_at', 'ended_at']:
+            values = [-1 if value is None else int(value.timestamp()) for value in values]
+        elif field in ['order__night_started_at', 'order__night_ended_at']:
+            values = [to_seconds(value) for value in values]
+        else:
+            values = [0 if value is None else int(value) for value in values]
+        columns[field] = np.array(values, dtype=np.int64)
+    return columns
+
+
+def compute_bills(query_set, until=None):
+    """
+    Columns of the joins and the arrays of their points.
+    """
+    columns = load_columns(query_set)
+    if len(columns['id']) == 0:
+        return columns, {field: np.zeros(0, dtype=np.int64) for field in RESULT_FIELDS}
+
+    until = int((until or timezone.now()).timestamp())
+    return columns, compute_points(columns, until)
+
+
+def to_rows(columns, points, start=0, stop=None):
+    """
+    Billing rows of the joins from start to stop, with the join, order and
+    cast ids.
+    """
+    keys = ['join_id', 'order_id', 'cast_id'] + RESULT_FIELDS
+    values = [columns['id'], columns['order_id'], columns['user_id']] + [points[field] for field in RESULT_FIELDS]
+    return [dict(zip(keys, row)) for row in zip(*[column[start:stop].tolist() for column in values])]
+
+
+def bill_joins(query_set, until=None):
+    """
+    Billing rows of the joins, with the join, order and cast ids.
+    """
+    return to_rows(*compute_bills(query_set, until))
+
+
+def sum_rows(rows):
+    return {field: sum(row[field] for row in rows) for field in RESULT_FIELDS if field.endswith('_point')}
+
+
+def sum_points(points):
+    return {field: int(points[field].sum()) for field in RESULT_FIELDS if field.endswith('_point')}
+
+
+def get_recorded_points(order_ids, chunk_size=1000):
+    """
+    Total and cast points of the settled invoice details, by order and cast.
+    """
+    order_ids = sorted(set(order_ids))
+    recorded = {}
+    for index in range(0, len(order_ids), chunk_size):
+        for order_id, cast_id, total_point, cast_point in InvoiceDetail.objects.filter(
+                invoices__invoice_type="CALL",
+                invoices__order_id__in=order_ids[index:index + chunk_size],
+                invoices__taker_id=F('cast_id')).values_list(
+                    'invoices__order_id', 'cast_id', 'total_point', 'cast_point'):
+            recorded[(order_id, cast_id)] = (total_point, cast_point)
+    return recorded
+
+
+def audit_rows(rows):
+    """
+    Rows whose settled points differ from the computed ones, with the
+    recorded values, unsettled joins skipped.
+    """
+    recorded = get_recorded_points([row['order_id'] for row in rows])
+    differences = []
+    for row in rows:
+        points = recorded.get((row['order_id'], row['cast_id']))
+        if points is not None and points != (row['total_point'], row['cast_point']):
+            differences.append(dict(row, recorded_total_point=points[0], recorded_cast_point=points[1]))
+    return differences
+
+
+def get_local_date(value=None):
+    """
+    Date of the time, now by default, in Asia/Tokyo.
+    """
+    if value is None:
+        value = timezone.now()
+    return timezone.localtime(value, pytz.timezone("Asia/Tokyo")).date()
+
+
+def get_month_range(month):
+    """
+    Start and end of the month of the date in Asia/Tokyo.
+    """
+    start = month.replace(day=1)
+    end = (start + timedelta(days=32)).replace(day=1)
+    local_zone = pytz.timezone("Asia/Tokyo")
+    return (
+        local_zone.localize(datetime(start.year, start.month, 1)),
+        local_zone.localize(datetime(end.year, end.month, 1)))
@@ -0,0 +1,240 @@
+"""
+Query budgets of the read endpoints
+
+Every GET route of the basics, accounts, chat and calls apps is requested
+as the member its permission asks for, on seeded data at a small and a
+large size, and its query count and response size are checked against
+query_budgets.json. Every route has to answer with a 2xx status, and one
+whose query count grows with the data is an N+1 unless the budget file lists
+it under "scales".
+"""
+import json
+import os
+import re
+
+import pytz
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import get_resolver
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from accounts import facets
+from accounts.models import Tweet
+from accounts.views.member import IsAdminPermission, IsCastPermission, IsGuestPermission, IsSuperuserPermission
+from basics import cache as basics_cache
+from basics.models import CastClass, Choice, CostPlan, Gift, GuestLevel, Location
+from chat.models import Room
+from .benchmark import get_seeded_users
+from .models import Invoice, Order
+
+BUDGET_FILE = os.path.join(os.path.dirname(__file__), 'query_budgets.json')
+
+APPS = ['api/basics/', 'api/accounts/', 'api/chat/', 'api/calls/']
+
+# responses may grow this much over the recorded size
+BYTES_SLACK = 0.25
+
+# GET routes that change data or call out, never requested
+ACTION_ROUTES = {
+    'api/accounts/users/toggle_active/<int:id>',
+    'api/accounts/users/to_cast/<int:id>',
+    'api/accounts/users/check',
+    'api/accounts/thumbnails/delete',
+    'api/accounts/verify/<str:email>/<str:email_token>',
+    'api/accounts/casts/transfer',
+    'api/accounts/transfers/proceed/<int:id>',
+    'api/accounts/favorites/<int:id>',
+    'api/accounts/toggle_present',
+    'api/accounts/point/pdf',
+    'api/accounts/profile',
+    'api/chat/messages/change/<int:id>',
+    'api/calls/orders/<int:id>/apply',
+    'api/calls/orders/<int:id>/confirm/<int:user_id>',
+    'api/calls/orders/<int:id>/room',
+    'api/calls/orders/<int:id>/cancel',
+    'api/calls/orders/<int:id>/auto',
+    'api/calls/orders/<int:id>/complete',
+    'api/calls/orders/<int:id>/fail',
+    'api/calls/orders/cancel',
+    'api/calls/orders/request/<int:pk>/cancel',
+    'api/calls/orders/request/<int:pk>/confirm',
+    'api/calls/orders/request/<int:pk>/reject',
+    'api/calls/joins/<int:id>/drop',
+    'api/calls/joins/<int:id>/recover',
+    'api/calls/rooms/<int:id>/joins/start',
+    'api/calls/rooms/<int:id>/joins/end',
+    'api/calls/rooms/<int:id>/joins/check',
+}
+
+
+def first_id(queryset):
+    return queryset.order_by('id').values_list('id', flat=True).first() or 0
+
+
+def get_order_id(user):
+    if user.role == 1:
+        return first_id(Order.objects.filter(user=user))
+    return first_id(Order.objects.all())
+
+
+# the object of the first path parameter, from the guest, cast and admin
+# and the member the route is requested as
+ROUTE_OBJECTS = {
+    'api/basics/locations': lambda users, user: first_id(Location.objects.all()),
+    'api/basics/classes': lambda users, user: first_id(CastClass.objects.all()),
+    'api/basics/levels': lambda users, user: first_id(GuestLevel.objects.all()),
+    'api/basics/choices': lambda users, user: first_id(Choice.objects.all()),
+    'api/basics/gifts': lambda users, user: first_id(Gift.objects.all()),
+    'api/basics/plans': lambda users, user: first_id(CostPlan.objects.all()),
+    'api/accounts/admins': lambda users, user: users[2].id,
+    'api/accounts/users': lambda users, user: users[1].id,
+    'api/accounts/members': lambda users, user: users[1].id,
+    'api/accounts/tweets': lambda users, user: first_id(Tweet.objects.all()),
+    'api/chat/rooms': lambda users, user: first_id(Room.objects.filter(users=users[0])),
+    'api/chat/admin/rooms': lambda users, user: first_id(Room.objects.filter(users=users[0])),
+    'api/calls/invoices': lambda users, user: first_id(Invoice.objects.all()),
+    'api/calls/orders': lambda users, user: get_order_id(user),
+    'api/calls/orders/request': lambda users, user: get_order_id(user),
+    'api/calls/rooms': lambda users, user: first_id(Room.objects.filter(users=user)),
+}
+
+# query parameters a route needs besides the page
+ROUTE_PARAMS = {
+    'api/calls/schedules': lambda: {"query": json.dumps({"date": str(timezone.localtime(timezone=pytz.timezone("Asia/Tokyo")).date())})},
+}
+
+
+def walk_patterns(patterns, prefix=''):
+    for pattern in patterns:
+        if hasattr(pattern, 'url_patterns'):
+            yield from walk_patterns(pattern.url_patterns, prefix + str(pattern.pattern))
+        else:
+            yield prefix + str(pattern.pattern), pattern.callback
+
+
+def get_routes():
+    """
+    Routes of the four apps answering GET, with their view class.
+    """
+    routes = []
+    for route, callback in walk_patterns(get_resolver().url_patterns):
+        view_class = getattr(callback, 'cls', None)
+        if view_class is None or not hasattr(view_class, 'get') or route in ACTION_ROUTES:
+            continue
+        if any(route.startswith(app) for app in APPS):
+            routes.append((route, view_class))
+    return routes
+
+
+def get_user(view_class, users):
+    guest, cast, admin = users
+    permissions = getattr(view_class, 'permission_classes', [])
+    if IsSuperuserPermission in permissions or IsAdminPermission in permissions:
+        return admin
+    if IsCastPermission in permissions:
+        return cast
+    if IsGuestPermission in permissions:
+        return guest
+    return guest
+
+
+def get_url(route, users, user):
+    if '<' not in route:
+        return '/' + route
+
+    base = route[:route.index('<')].rstrip('/')
+    object_id = ROUTE_OBJECTS[base](users, user) if base in ROUTE_OBJECTS else 0
+    return '/' + re.sub(r'<int:\w+>', str(object_id), route, count=1).replace('<int:user_id>', str(users[1].id))
+
+
+def reset_caches():
+    """
+    Measure every request cold.
+    """
+    for alias in settings.CACHES:
+        caches[alias].clear()
+    facets.backends.clear()
+    basics_cache.local_payloads.clear()
+
+
+def measure_routes(size):
+    """
+    Status, query count and response size of every route, with the page
+    size asked for where the view takes one.
+    """
+    users = get_seeded_users()
+    results = {}
+    for route, view_class in get_routes():
+        user = get_user(view_class, users)
+        client = APIClient(raise_request_exception=False)
+        client.force_authenticate(user)
+        url = get_url(route, users, user)
+        params = dict(ROUTE_PARAMS[route]() if route in ROUTE_PARAMS else {}, page=1, size=size)
+
+        reset_caches()
+        with CaptureQueriesContext(connection) as context:
+            response = client.get(url, params)
+        results[route] = {
+            "status": response.status_code,
+            "queries": len(context.captured_queries),
+            "bytes": len(response.content),
+        }
+    return results
+
+
+def load_budgets():
+    if not os.path.exists(BUDGET_FILE):
+        return {"routes": {}, "scales": []}
+    with open(BUDGET_FILE) as budget_file:
+        return json.load(budget_file)
+
+
+def save_budgets(small, large, scales):
+    budgets = {
+        "routes": {
+            route: {"status": result["status"], "queries": result["queries"], "bytes": result["bytes"]}
+            for route, result in sorted(large.items())},
+        "scales": sorted(scales),
+    }
+    with open(BUDGET_FILE, 'w') as budget_file:
+        json.dump(budgets, budget_file, indent=2, ensure_ascii=False)
+        budget_file.write('\n')
+    return budgets
+
+
+def get_scaling_routes(small, large):
+    return [
+        route for route in large
+        if route in small and large[route]["queries"] > small[route]["queries"]]
+
+
+def check_budgets(small, large, budgets):
+    """
+    Failures of the measured routes, as messages.
+    """
+    failures = []
+    for route in get_scaling_routes(small, large):
+        if route not in budgets["scales"]:
+            failures.append("{0}: {1} queries on the small data, {2} on the large".format(
+                route, small[route]["queries"], large[route]["queries"]))
+
+    for route, result in large.items():
+        # a failing route is no baseline
+        if not 200 <= result["status"] < 300:
+            failures.append("{0}: status {1}".format(route, result["status"]))
+        budget = budgets["routes"].get(route)
+        if budget is None:
+            failures.append("{}: no budget".format(route))
+            continue
+        if result["status"] != budget["status"]:
+            failures.append("{0}: status {1}, was {2}".format(route, result["status"], budget["status"]))
+        if result["queries"] > budget["queries"]:
+            failures.append("{0}: {1} queries over the budget of {2}".format(
+                route, result["queries"], budget["queries"]))
+        if result["bytes"] > budget["bytes"] * (1 + BYTES_SLACK):
+            failures.append("{0}: {1} bytes over the budget of {2}".format(
+                route, result["bytes"], budget["bytes"]))
+    return failures
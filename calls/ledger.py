@@ -0,0 +1,134 @@
+"""
+Point ledger
+
+Every change of a balance is an Invoice appended together with an atomic
+UPDATE ... SET point = point + delta in one transaction, so concurrent gifts
+and settlements never overwrite each other. The house share of the
+settlements goes to one of HOUSE_SHARDS sub-accounts picked at random
+instead of the admin row, and the house balance is summed on read.
+"""
+import random
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, Sum, Value, When
+from django.utils import timezone
+
+from accounts.models import BALANCE_FIELDS, Member
+from .models import HouseShard, Invoice
+
+HOUSE_USERNAME = "admin"
+
+# reason of the invoices recording a balance set by an admin
+ADJUSTMENT_REASON = "残高調整"
+
+
+def get_house_member():
+    return Member.objects.get(is_superuser=True, username=HOUSE_USERNAME)
+
+
+def is_house_member(member):
+    return member.is_superuser and member.username == HOUSE_USERNAME
+
+
+def get_shard_count():
+    return max(getattr(settings, 'HOUSE_SHARDS', 16), 1)
+
+
+def apply_deltas(deltas):
+    """
+    Add the deltas, a dict of member id to a dict of field to delta, to the
+    members in one UPDATE.
+    """
+    changes = {}
+    for field in BALANCE_FIELDS:
+        whens = [
+            When(pk=member_id, then=Value(member_deltas[field]))
+            for member_id, member_deltas in sorted(deltas.items()) if member_deltas.get(field, 0) != 0]
+        if len(whens) > 0:
+            changes[field] = F(field) + Case(*whens, default=Value(0))
+
+    if len(changes) > 0:
+        member_ids = [member_id for member_id, member_deltas in deltas.items() if any(member_deltas.values())]
+        # updated_at expires the cached cards showing the point
+        Member.all_objects.filter(pk__in=member_ids).update(updated_at=timezone.now(), **changes)
+
+
+def credit_house(amount):
+    if amount == 0:
+        return
+
+    shard = random.randrange(get_shard_count())
+    if HouseShard.objects.filter(shard=shard).update(point=F('point') + amount) == 0:
+        HouseShard.objects.bulk_create([HouseShard(shard=shard)], ignore_conflicts=True)
+        HouseShard.objects.filter(shard=shard).update(point=F('point') + amount)
+
+
+def get_house_point():
+    admin_point = Member.objects.filter(
+        is_superuser=True, username=HOUSE_USERNAME).values_list('point', flat=True).first() or 0
+    return admin_point + (HouseShard.objects.aggregate(total=Sum('point'))['total'] or 0)
+
+
+def get_adjustment(member, delta):
+    """
+    ADMIN invoice of a balance set by hand, for the difference.
+    """
+    if delta >= 0:
+        return Invoice(invoice_type="ADMIN", taker=member, take_amount=delta, reason=ADJUSTMENT_REASON)
+    return Invoice(invoice_type="ADMIN", giver=member, give_amount=-delta, reason=ADJUSTMENT_REASON)
+
+
+def set_house_point(point):
+    """
+    Set the house balance, folding the shards back into the admin row and
+    recording the difference as an adjustment.
+    """
+    with transaction.atomic():
+        list(HouseShard.objects.select_for_update().order_by('shard'))
+        house = Member.objects.select_for_update().filter(is_superuser=True, username=HOUSE_USERNAME).first()
+        if house is None:
+            return
+
+        delta = point - get_house_point()
+        if delta != 0:
+            get_adjustment(house, delta).save()
+        HouseShard.objects.update(point=0)
+        Member.objects.filter(pk=house.pk).update(point=point, updated_at=timezone.now())
+
+
+def set_point(member, point):
+    """
+    Set the balance of a member other than the house, recording the
+    difference as an adjustment.
+    """
+    with transaction.atomic():
+        current = Member.all_objects.select_for_update().values_list('point', flat=True).get(pk=member.pk)
+        if point != current:
+            post_entries([get_adjustment(member, point - current)], {member.pk: {"point": point - current}})
+    return refresh_balance(member)
+
+
+def post_entries(invoices, deltas=None, house=0):
+    """
+    Append the invoices and apply the balance deltas and the house credit in
+    one transaction. Returns the saved invoices.
+    """
+    with transaction.atomic():
+        for invoice in invoices:
+            invoice.save()
+        apply_deltas(deltas or {})
+        credit_house(house)
+    return invoices
+
+
+def get_balances(member_ids):
+    return dict(Member.all_objects.filter(pk__in=member_ids).values_list('id', 'point'))
+
+
+def refresh_balance(member):
+    """
+    Reload the fields the ledger changes on an instance held by the caller.
+    """
+    member.refresh_from_db(fields=BALANCE_FIELDS + ['updated_at'])
+    return member
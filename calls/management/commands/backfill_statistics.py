@@ -0,0 +1,49 @@
+from datetime import timedelta
+
+from dateutil.parser import parse
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+
+from calls.models import Order, Invoice
+from calls.statistics import rollup_day
+
+
+class Command(BaseCommand):
+    help = 'Roll up the daily statistics of a date range, both dates included'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='from_date', default='')
+        parser.add_argument('--to', dest='to_date', default='')
+
+    def handle(self, *args, **options):
+        yesterday = timezone.now().date() - timedelta(days=1)
+
+        try:
+            if options['from_date'] != '':
+                start_date = parse(options['from_date']).date()
+            else:
+                first_dates = [
+                    value for value in [
+                        Invoice.objects.aggregate(Min('created_at'))['created_at__min'],
+                        Order.objects.aggregate(Min('created_at'))['created_at__min']
+                    ] if value is not None]
+                if len(first_dates) == 0:
+                    self.stdout.write('Nothing to roll up')
+                    return
+                start_date = min(first_dates).date()
+
+            end_date = yesterday
+            if options['to_date'] != '':
+                end_date = parse(options['to_date']).date()
+        except ValueError as e:
+            raise CommandError(e)
+
+        cur_date = start_date
+        total = 0
+        while cur_date <= end_date:
+            total += rollup_day(cur_date)
+            cur_date += timedelta(days=1)
+
+        self.stdout.write(self.style.SUCCESS(
+            'Rolled up {} rows from {} to {}'.format(total, start_date, end_date)))
@@ -0,0 +1,43 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from calls.benchmark import compare_results, run_benchmark
+
+
+class Command(BaseCommand):
+    help = 'Time the hot endpoints as seeded members and compare with a saved baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=10)
+        parser.add_argument('--output', default='', help='Save the results as the json baseline')
+        parser.add_argument('--compare', default='', help='Baseline to compare against')
+
+    def handle(self, *args, **options):
+        baseline = {}
+        if options['compare'] != '':
+            try:
+                with open(options['compare']) as baseline_file:
+                    baseline = json.load(baseline_file)
+            except (OSError, ValueError) as e:
+                raise CommandError(e)
+
+        with override_settings(ALLOWED_HOSTS=['testserver']):
+            results = run_benchmark(options['repeat'])
+        if len(results) == 0:
+            raise CommandError('No seeded members, run seed_data first')
+
+        for name, result in results.items():
+            self.stdout.write(
+                '{0}: {status} p50 {p50}ms p90 {p90}ms p99 {p99}ms, {queries} queries, {bytes} bytes'.format(
+                    name, **result))
+
+        if options['output'] != '':
+            with open(options['output'], 'w') as baseline_file:
+                json.dump(results, baseline_file, indent=2)
+            self.stdout.write(self.style.SUCCESS('Saved the baseline to {}'.format(options['output'])))
+
+        regressions = compare_results(baseline, results)
+        if len(regressions) > 0:
+            raise CommandError('Regressions against the baseline\n' + '\n'.join(regressions))
@@ -0,0 +1,101 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from accounts.models import Member
+from calls.benchmark import get_seeded_users
+from calls.ledger import apply_deltas, get_balances, get_house_member, get_house_point, post_entries
+from calls.models import Invoice
+
+BENCH_TYPE = "BENCH"
+
+
+def give_naive(guest_id, cast_id, admin_id, point, back):
+    """
+    The read-modify-write the views did before the ledger.
+    """
+    Invoice.objects.create(invoice_type=BENCH_TYPE, giver_id=guest_id, give_amount=point)
+    for member_id, delta in [(guest_id, -point), (cast_id, back), (admin_id, point - back)]:
+        member = Member.all_objects.get(pk=member_id)
+        member.point += delta
+        member.save(update_fields=['point'])
+
+
+def give_ledger(guest_id, cast_id, admin_id, point, back):
+    post_entries(
+        [Invoice(invoice_type=BENCH_TYPE, giver_id=guest_id, give_amount=point)],
+        {guest_id: {"point": -point}, cast_id: {"point": back}},
+        house=point - back)
+
+
+class Command(BaseCommand):
+    help = 'Give gifts from parallel threads and check that no balance update is lost'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--gifts', type=int, default=100, help='Gifts per thread')
+        parser.add_argument('--point', type=int, default=1000)
+        parser.add_argument('--back', type=int, default=600)
+        parser.add_argument('--naive', action='store_true', help='Update the balances with read-modify-write')
+
+    def handle(self, *args, **options):
+        guest, cast, _ = get_seeded_users()
+        if guest is None or cast is None:
+            raise CommandError('No seeded members, run seed_data first')
+        try:
+            admin = get_house_member()
+        except Member.DoesNotExist:
+            raise CommandError('No house member "admin"')
+
+        give = give_naive if options['naive'] else give_ledger
+        point, back = options['point'], options['back']
+        before = get_balances([guest.id, cast.id])
+        house_before = get_house_point()
+        errors = []
+
+        def run():
+            try:
+                for _ in range(options['gifts']):
+                    give(guest.id, cast.id, admin.id, point, back)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run) for _ in range(max(options['threads'], 1))]
+        started_at = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started_at
+
+        count = Invoice.objects.filter(invoice_type=BENCH_TYPE).count()
+        after = get_balances([guest.id, cast.id])
+        changes = {
+            "guest": (after[guest.id] - before[guest.id], -point * count),
+            "cast": (after[cast.id] - before[cast.id], back * count),
+            "house": (get_house_point() - house_before, (point - back) * count),
+        }
+
+        self.stdout.write('{0} gifts in {1:.2f}s, {2:.0f} per second, {3} failed'.format(
+            count, elapsed, count / elapsed if elapsed > 0 else 0, len(errors)))
+        lost = 0
+        for name, (change, expected) in changes.items():
+            self.stdout.write('{0}: {1:+d}, expected {2:+d}'.format(name, change, expected))
+            lost += abs(change - expected)
+
+        # put the balances back
+        with transaction.atomic():
+            Invoice.objects.filter(invoice_type=BENCH_TYPE).delete()
+            apply_deltas({
+                guest.id: {"point": -changes["guest"][0]},
+                cast.id: {"point": -changes["cast"][0]}})
+            Member.all_objects.filter(pk=admin.id).update(point=admin.point)
+        post_entries([], house=-(get_house_point() - house_before))
+
+        if lost > 0:
+            raise CommandError('{} points of updates were lost'.format(lost))
+        self.stdout.write(self.style.SUCCESS('No lost updates'))
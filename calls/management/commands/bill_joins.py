@@ -0,0 +1,49 @@
+import csv
+import time
+
+from dateutil.parser import parse
+from django.core.management.base import BaseCommand, CommandError
+
+from calls.billing import audit_rows, bill_joins, get_billed_joins, get_local_date, get_month_range, sum_rows
+
+
+class Command(BaseCommand):
+    help = 'Compute the points of the joins of a month and audit the settled ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--month', default='', help='Any date of the month, default is this month')
+        parser.add_argument('--audit', action='store_true', help='Compare with the settled invoice details')
+        parser.add_argument('--output', default='', help='Write the rows as csv')
+
+    def handle(self, *args, **options):
+        month = get_local_date()
+        if options['month'] != '':
+            try:
+                month = parse(options['month']).date()
+            except (ValueError, OverflowError) as e:
+                raise CommandError(e)
+
+        started_at = time.perf_counter()
+        started_from, started_to = get_month_range(month)
+        rows = bill_joins(get_billed_joins(started_from=started_from, started_to=started_to))
+        elapsed = (time.perf_counter() - started_at) * 1000
+
+        self.stdout.write('{0} joins of {1:%Y-%m} in {2:.2f}ms'.format(len(rows), month, elapsed))
+        for field, value in sum_rows(rows).items():
+            self.stdout.write('{0}: {1}'.format(field, value))
+
+        if options['audit']:
+            rows = audit_rows(rows)
+            for row in rows:
+                self.stdout.write('order {order_id} cast {cast_id}: total {total_point}, settled {recorded_total_point}, '
+                                  'cast {cast_point}, settled {recorded_cast_point}'.format(**row))
+
+        if options['output'] != '' and len(rows) > 0:
+            with open(options['output'], 'w', newline='') as report_file:
+                writer = csv.DictWriter(report_file, fieldnames=list(rows[0].keys()))
+                writer.writeheader()
+                writer.writerows(rows)
+            self.stdout.write(self.style.SUCCESS('Wrote the rows to {}'.format(options['output'])))
+
+        if options['audit'] and len(rows) > 0:
+            raise CommandError('{} settled joins differ from the computed points'.format(len(rows)))
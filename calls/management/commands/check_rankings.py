@@ -0,0 +1,33 @@
+from dateutil.parser import parse
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from calls.ranking import PERIODS, get_bucket, check_bucket
+
+
+class Command(BaseCommand):
+    help = 'Compare the ranking buckets containing a date with the invoice aggregation'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', default='', help='default is today')
+        parser.add_argument('--period', choices=PERIODS, action='append')
+
+    def handle(self, *args, **options):
+        cur_time = timezone.now()
+        if options['date'] != '':
+            try:
+                cur_time = timezone.make_aware(parse(options['date']))
+            except ValueError as e:
+                raise CommandError(e)
+
+        mismatch_count = 0
+        for period in options['period'] or PERIODS:
+            bucket = get_bucket(period, cur_time)
+            for kind, user_id, stored, expected in check_bucket(period, bucket):
+                mismatch_count += 1
+                self.stdout.write('{0} {1} {2} user {3}: stored {4}, expected {5}'.format(
+                    period, bucket, kind, user_id, stored, expected))
+
+        if mismatch_count > 0:
+            raise CommandError('{} ranking entries are inconsistent'.format(mismatch_count))
+        self.stdout.write(self.style.SUCCESS('Rankings are consistent'))
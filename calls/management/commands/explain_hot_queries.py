@@ -0,0 +1,101 @@
+import json
+import statistics
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.utils import timezone
+
+from accounts.models import Member
+from calls.models import Invoice, Join, Order
+from chat.models import Receipt, Room, UnreadCounter
+from chat.utils import get_received_messages
+
+
+def get_busiest(queryset, field):
+    """
+    Value of the field with the most rows, so the plans are read where an
+    index matters most.
+    """
+    row = queryset.values(field).annotate(rows=Count('id')).order_by('-rows').first()
+    return row[field] if row is not None else 0
+
+
+def get_hot_queries():
+    """
+    The filters of the chat, calls and accounts views the hot indexes serve,
+    on the ids with the most rows.
+    """
+    member_id = get_busiest(Receipt.objects.all(), 'user_id')
+    room_id = get_busiest(Receipt.objects.filter(user_id=member_id), 'room_id')
+    giver_id = get_busiest(Invoice.objects.all(), 'giver_id')
+    taker_id = get_busiest(Invoice.objects.all(), 'taker_id')
+    order_id = get_busiest(Join.objects.all(), 'order_id')
+    superuser_ids = list(Member.objects.filter(is_superuser=True).values_list('id', flat=True)) or [0]
+    month_ago = timezone.now() - timedelta(days=30)
+
+    return {
+        "chat.room_timeline": get_received_messages(
+            user_id=member_id, room_id=room_id).filter(room_id=room_id).order_by('-created_at'),
+        "chat.room_unread": Receipt.objects.filter(user_id=member_id, room_id=room_id, is_read=False),
+        "chat.admin_unread": get_received_messages(
+            user_id__in=superuser_ids, is_read=False).order_by('-created_at'),
+        "chat.unread_counters": UnreadCounter.objects.filter(user_id=member_id),
+        "chat.rooms_by_type": Room.objects.filter(room_type="admin").order_by('-updated_at'),
+        "calls.invoices_by_type": Invoice.objects.filter(invoice_type="CALL").order_by('-created_at'),
+        "calls.gave_points": Invoice.objects.filter(giver_id=giver_id, created_at__gte=month_ago),
+        "calls.took_points": Invoice.objects.filter(taker_id=taker_id, created_at__gte=month_ago),
+        "calls.order_applicants": Join.objects.filter(order_id=order_id, status=0, dropped=False),
+        "calls.expired_orders": Order.objects.filter(status__in=[0, 1], collect_ended_at__lt=timezone.now()),
+        "accounts.present_casts": Member.objects.filter(role=0, is_active=True, is_present=True),
+    }
+
+
+class Command(BaseCommand):
+    help = 'Explain and time the hot queries, and compare them with a report saved before a migration'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--limit', type=int, default=50, help='Rows read per run')
+        parser.add_argument('--output', default='', help='Save the report as json')
+        parser.add_argument('--compare', default='', help='Report saved before, to show side by side')
+
+    def handle(self, *args, **options):
+        before = {}
+        if options['compare'] != '':
+            try:
+                with open(options['compare']) as report_file:
+                    before = json.load(report_file)
+            except (OSError, ValueError) as e:
+                raise CommandError(e)
+
+        report = {}
+        for name, queryset in get_hot_queries().items():
+            report[name] = {
+                "plan": queryset.explain(),
+                "ms": self.measure(queryset[:options['limit']], options['repeat']),
+            }
+
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            if name in before:
+                self.stdout.write('before {:.2f}ms'.format(before[name]['ms']))
+                self.stdout.write(before[name]['plan'])
+                self.stdout.write('after {:.2f}ms'.format(report[name]['ms']))
+            else:
+                self.stdout.write('{:.2f}ms'.format(report[name]['ms']))
+            self.stdout.write(report[name]['plan'])
+
+        if options['output'] != '':
+            with open(options['output'], 'w') as report_file:
+                json.dump({"vendor": connection.vendor, **report}, report_file, indent=2)
+            self.stdout.write(self.style.SUCCESS('Saved the report to {}'.format(options['output'])))
+
+    def measure(self, queryset, repeat):
+        timings = []
+        for _ in range(max(repeat, 1)):
+            started_at = time.perf_counter()
+            list(queryset.all())
+            timings.append((time.perf_counter() - started_at) * 1000)
+        return statistics.median(timings)
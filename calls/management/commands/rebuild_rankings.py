@@ -0,0 +1,26 @@
+from dateutil.parser import parse
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from calls.ranking import PERIODS, get_bucket, rebuild_bucket
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the ranking buckets containing a date from the invoices'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', default='', help='default is today')
+        parser.add_argument('--period', choices=PERIODS, action='append')
+
+    def handle(self, *args, **options):
+        cur_time = timezone.now()
+        if options['date'] != '':
+            try:
+                cur_time = timezone.make_aware(parse(options['date']))
+            except ValueError as e:
+                raise CommandError(e)
+
+        for period in options['period'] or PERIODS:
+            bucket = get_bucket(period, cur_time)
+            total = rebuild_bucket(period, bucket)
+            self.stdout.write('{0} {1}: {2} entries'.format(period, bucket, total))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from calls.reconcile import CHUNK_SIZE, reconcile_balances, write_report
+
+
+class Command(BaseCommand):
+    help = 'Compare the point of every member with the invoice ledger'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+        parser.add_argument('--output', default='', help='Write the discrepancies as csv')
+        parser.add_argument('--show', type=int, default=20, help='Discrepancies printed')
+
+    def handle(self, *args, **options):
+        rows, summary = reconcile_balances(options['chunk_size'])
+        self.stdout.write('{invoices} invoices, {members} members in {elapsed_ms}ms'.format(**summary))
+
+        for row in rows[:options['show']]:
+            self.stdout.write('user {0} {1}: point {2}, expected {3}, difference {4:+d}'.format(*row))
+
+        if options['output'] != '':
+            write_report(rows, options['output'])
+            self.stdout.write(self.style.SUCCESS('Wrote the report to {}'.format(options['output'])))
+
+        if len(rows) > 0:
+            raise CommandError('{} balances differ from the ledger'.format(len(rows)))
+        self.stdout.write(self.style.SUCCESS('Balances match the ledger'))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from calls.seed import seed_data
+
+
+class Command(BaseCommand):
+    help = 'Seed members, orders, rooms, messages, invoices and tweets at the given scale'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=1000)
+        parser.add_argument('--seed', type=int, default=0, help='Same seed, same rows')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            counts = seed_data(options['members'], options['seed'], options['batch_size'])
+
+        for name, count in counts.items():
+            self.stdout.write('{0}: {1}'.format(name, count))
+        self.stdout.write(self.style.SUCCESS('Seeded'))
@@ -0,0 +1,32 @@
+# Generated by Django 3.2.13 on 2026-10-18 07:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('basics', '0004_auto_20210115_1634'),
+        ('calls', '0002_auto_20210114_1128'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyStatistic',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='日付')),
+                ('category', models.CharField(blank=True, default='', max_length=100, verbose_name='目的')),
+                ('count', models.IntegerField(default=0, verbose_name='件数')),
+                ('give_sum', models.IntegerField(default=0, verbose_name='使用ポイント')),
+                ('take_sum', models.IntegerField(default=0, verbose_name='取得ポイント')),
+                ('location', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='basics.location', verbose_name='支店')),
+            ],
+            options={
+                'verbose_name': '日次統計',
+                'verbose_name_plural': '日次統計',
+                'unique_together': {('date', 'location', 'category')},
+            },
+        ),
+    ]
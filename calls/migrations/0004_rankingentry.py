@@ -0,0 +1,33 @@
+# Generated by Django 3.2.13 on 2026-10-18 07:52
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('calls', '0003_dailystatistic'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RankingEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('day', '日間'), ('week', '週間'), ('month', '月間'), ('year', '年間')], max_length=10, verbose_name='期間')),
+                ('bucket', models.DateField(verbose_name='期間開始日')),
+                ('kind', models.CharField(choices=[('give_call', 'ゲスト-合流'), ('give_gift', 'ゲスト-ギフト'), ('take_call', 'キャスト-合流'), ('take_gift', 'キャスト-ギフト')], max_length=20, verbose_name='種類')),
+                ('points', models.IntegerField(default=0, verbose_name='ポイント')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ranking_entries', to=settings.AUTH_USER_MODEL, verbose_name='ユーザー')),
+            ],
+            options={
+                'verbose_name': 'ランキング',
+                'verbose_name_plural': 'ランキング',
+                'unique_together': {('period', 'bucket', 'kind', 'user')},
+                'index_together': {('period', 'bucket', 'kind', 'points')},
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.2.13 on 2026-10-18 08:14
+
+from django.conf import settings
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('calls', '0004_rankingentry'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='invoice',
+            index_together={('invoice_type', 'created_at'), ('taker', 'created_at'), ('giver', 'created_at')},
+        ),
+        migrations.AlterIndexTogether(
+            name='join',
+            index_together={('order', 'status', 'dropped')},
+        ),
+        migrations.AlterIndexTogether(
+            name='order',
+            index_together={('status', 'collect_ended_at')},
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.2.13 on 2026-10-18 08:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calls', '0005_hot_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HouseShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.IntegerField(unique=True, verbose_name='番号')),
+                ('point', models.IntegerField(default=0, verbose_name='ポイント')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新日時')),
+            ],
+            options={
+                'verbose_name': 'ハウス口座',
+                'verbose_name_plural': 'ハウス口座',
+            },
+        ),
+    ]
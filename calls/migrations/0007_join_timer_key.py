@@ -0,0 +1,18 @@
+# Generated by Django 3.2.13 on 2026-10-18 08:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calls', '0006_houseshard'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='join',
+            name='timer_key',
+            field=models.CharField(blank=True, default='', max_length=32, verbose_name='タイマーキー'),
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 3.2.13 on 2026-10-18 09:02
+
+from datetime import timedelta
+
+from django.db import migrations
+from django.db.models import Count, Min, Sum
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+ORDER_CATEGORY = "ORDER"
+ROLLUP_CATEGORY = "ROLLUP"
+BATCH_SIZE = 1000
+
+
+def rollup_history(apps, schema_editor):
+    """
+    Roll up every past day with its marker, so the dashboards read the
+    rollup from the deploy on
+    """
+    Invoice = apps.get_model('calls', 'Invoice')
+    Order = apps.get_model('calls', 'Order')
+    DailyStatistic = apps.get_model('calls', 'DailyStatistic')
+
+    today = timezone.now().date()
+    first_dates = [
+        value for value in [
+            Invoice.objects.aggregate(Min('created_at'))['created_at__min'],
+            Order.objects.aggregate(Min('created_at'))['created_at__min']
+        ] if value is not None]
+
+    DailyStatistic.objects.all().delete()
+    if len(first_dates) == 0:
+        return
+
+    rows = []
+    invoice_rows = Invoice.objects.filter(created_at__date__lt=today).annotate(
+        stat_date=TruncDate('created_at'),
+        stat_location=Coalesce('order__parent_location', 'giver__location', 'taker__location')
+    ).values('stat_date', 'stat_location', 'invoice_type').annotate(
+        count=Count('id'), give_sum=Sum('give_amount'), take_sum=Sum('take_amount')).order_by()
+    for row in invoice_rows.iterator():
+        rows.append(DailyStatistic(
+            date=row['stat_date'],
+            location_id=row['stat_location'],
+            category=row['invoice_type'] or "",
+            count=row['count'],
+            give_sum=row['give_sum'] or 0,
+            take_sum=row['take_sum'] or 0))
+
+    order_rows = Order.objects.filter(created_at__date__lt=today).annotate(
+        stat_date=TruncDate('created_at')).values('stat_date', 'parent_location').annotate(
+        count=Count('id')).order_by()
+    for row in order_rows.iterator():
+        rows.append(DailyStatistic(
+            date=row['stat_date'], location_id=row['parent_location'], category=ORDER_CATEGORY, count=row['count']))
+
+    cur_date = min(first_dates).date()
+    while cur_date < today:
+        rows.append(DailyStatistic(date=cur_date, category=ROLLUP_CATEGORY))
+        cur_date += timedelta(days=1)
+
+    DailyStatistic.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calls', '0007_join_timer_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(rollup_history, migrations.RunPython.noop),
+    ]
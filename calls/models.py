@@ -109,6 +109,10 @@ class Order(models.Model):
     created_at = models.DateTimeField('作成日時', auto_now_add=True)
     updated_at = models.DateTimeField('更新日時', auto_now=True)
 
+    class Meta:
+        # expired orders of the call control
+        index_together = ('status', 'collect_ended_at')
+
 
 class Invoice(models.Model):
 
@@ -146,6 +150,14 @@ class Invoice(models.Model):
     created_at = models.DateTimeField('作成日時', auto_now_add=True)
     updated_at = models.DateTimeField('更新日時', auto_now=True)
 
+    class Meta:
+        # invoice lists and the point sums by date
+        index_together = [
+            ('invoice_type', 'created_at'),
+            ('giver', 'created_at'),
+            ('taker', 'created_at')
+        ]
+
 
 class InvoiceDetail(models.Model):
 
@@ -209,6 +221,11 @@ class Join(models.Model):
     is_ten_left = models.BooleanField("10分前", default=False)
     is_extended = models.BooleanField("延長", default=False)
     is_ended = models.BooleanField("修了", default=False)
+    timer_key = models.CharField("タイマーキー", default="", max_length=32, blank=True)
+
+    class Meta:
+        # applicants of an order
+        index_together = ('order', 'status', 'dropped')
 
 
 class Review(models.Model):
@@ -238,3 +255,83 @@ class Review(models.Model):
     content = models.TextField('内容', null=True, blank=True)
     created_at = models.DateTimeField('作成日時', auto_now_add=True)
     updated_at = models.DateTimeField('更新日時', auto_now=True)
+
+
+class DailyStatistic(models.Model):
+    """
+    DailyStatistic Model
+
+    Invoice counts and sums per day, location and invoice type,
+    order counts are stored under the ORDER category
+    """
+    date = models.DateField('日付')
+    location = models.ForeignKey(
+        Location,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        verbose_name='支店')
+    category = models.CharField('目的', default="", blank=True, max_length=100)
+    count = models.IntegerField('件数', default=0)
+    give_sum = models.IntegerField('使用ポイント', default=0)
+    take_sum = models.IntegerField('取得ポイント', default=0)
+
+    class Meta:
+        verbose_name = '日次統計'
+        verbose_name_plural = '日次統計'
+        unique_together = ('date', 'location', 'category')
+
+
+class RankingEntry(models.Model):
+    """
+    RankingEntry Model
+
+    Points of a user in one ranking period bucket, fed by invoice creation
+    """
+
+    PERIOD_CHOICES = (
+        ('day', '日間'),
+        ('week', '週間'),
+        ('month', '月間'),
+        ('year', '年間'),
+    )
+
+    KIND_CHOICES = (
+        ('give_call', 'ゲスト-合流'),
+        ('give_gift', 'ゲスト-ギフト'),
+        ('take_call', 'キャスト-合流'),
+        ('take_gift', 'キャスト-ギフト'),
+    )
+
+    period = models.CharField('期間', choices=PERIOD_CHOICES, max_length=10)
+    bucket = models.DateField('期間開始日')
+    kind = models.CharField('種類', choices=KIND_CHOICES, max_length=20)
+    user = models.ForeignKey(
+        Member,
+        on_delete=models.CASCADE,
+        related_name="ranking_entries",
+        verbose_name="ユーザー")
+    points = models.IntegerField('ポイント', default=0)
+
+    class Meta:
+        verbose_name = 'ランキング'
+        verbose_name_plural = 'ランキング'
+        unique_together = ('period', 'bucket', 'kind', 'user')
+        index_together = ('period', 'bucket', 'kind', 'points')
+
+
+class HouseShard(models.Model):
+    """
+    HouseShard Model
+
+    One of the sub-accounts the house points are credited to, so that
+    settlements do not all lock the admin row. The house balance is the
+    point of the admin plus the sum of the shards, see calls.ledger
+    """
+    shard = models.IntegerField('番号', unique=True)
+    point = models.IntegerField('ポイント', default=0)
+    updated_at = models.DateTimeField('更新日時', auto_now=True)
+
+    class Meta:
+        verbose_name = 'ハウス口座'
+        verbose_name_plural = 'ハウス口座'
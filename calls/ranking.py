@@ -0,0 +1,238 @@
+"""
+Precomputed rankings for get_ranking
+"""
+from datetime import datetime, time, timedelta
+
+import pytz
+from dateutil.relativedelta import relativedelta
+from django.db import transaction
+from django.db.models import Case, F, Q, Sum, Value, When
+from django.utils import timezone
+
+from accounts.models import Member
+from .models import Invoice, RankingEntry
+
+PERIODS = ['day', 'week', 'month', 'year']
+RANKED_TYPES = {'CALL': 'call', 'GIFT': 'gift'}
+TOP_SIZE = 10
+
+
+def get_bucket(period, value=None):
+    """
+    First day of the period containing the time, in Asia/Tokyo.
+    """
+    if value is None:
+        value = timezone.now()
+    cur_date = value.astimezone(pytz.timezone("Asia/Tokyo")).date()
+
+    if period == 'day':
+        return cur_date
+    if period == 'week':
+        # weeks start on sunday
+        return cur_date - timedelta(days=(cur_date.weekday() + 1) % 7)
+    if period == 'month':
+        return cur_date.replace(day=1)
+    return cur_date.replace(month=1, day=1)
+
+
+def get_bucket_range(period, bucket):
+    start_time = pytz.timezone("Asia/Tokyo").localize(
+        datetime.combine(bucket, time.min))
+
+    if period == 'day':
+        end_time = start_time + timedelta(days=1)
+    elif period == 'week':
+        end_time = start_time + timedelta(days=7)
+    elif period == 'month':
+        end_time = start_time + relativedelta(months=1)
+    else:
+        end_time = start_time + relativedelta(years=1)
+
+    return start_time, end_time
+
+
+def get_kind(is_cast, is_gift):
+    return "{0}_{1}".format(
+        "take" if is_cast else "give", "gift" if is_gift else "call")
+
+
+def get_ranked_users(is_cast, is_gift):
+    query_set = Member.objects.filter(
+        setting__ranking_display=True, is_active=True)
+    if is_cast:
+        query_set = query_set.filter(role=0)
+        if not is_gift:
+            query_set = query_set.filter(is_present=True)
+    else:
+        query_set = query_set.filter(role=1)
+    return query_set
+
+
+def record_invoice(invoice):
+    """
+    Add the points of a new invoice to every period bucket.
+    """
+    record_invoices([invoice])
+
+
+def record_invoices(invoices):
+    """
+    Add the points of new invoices to every period bucket, in two queries
+    per set of buckets.
+    """
+    with transaction.atomic():
+        for buckets, bucket_entries in get_entries(invoices).items():
+            RankingEntry.objects.bulk_create([
+                RankingEntry(period=period, bucket=bucket, kind=kind, user_id=user_id)
+                for period, bucket in buckets for kind, user_id in bucket_entries
+            ], ignore_conflicts=True)
+            add_points(buckets, bucket_entries)
+
+
+def remove_invoice(invoice):
+    """
+    Take the points of a deleted invoice back out of its period buckets.
+    """
+    for buckets, bucket_entries in get_entries([invoice]).items():
+        add_points(buckets, {key: -points for key, points in bucket_entries.items()})
+
+
+def get_entries(invoices):
+    """
+    Points of the ranked invoices by set of buckets, then by kind and user.
+    """
+    entries = {}
+    for invoice in invoices:
+        suffix = RANKED_TYPES.get(invoice.invoice_type)
+        if suffix is None:
+            continue
+
+        buckets = tuple((period, get_bucket(period, invoice.created_at)) for period in PERIODS)
+        bucket_entries = entries.setdefault(buckets, {})
+        if invoice.giver_id is not None and invoice.give_amount != 0:
+            key = ("give_" + suffix, invoice.giver_id)
+            bucket_entries[key] = bucket_entries.get(key, 0) + invoice.give_amount
+        if invoice.taker_id is not None and invoice.take_amount != 0:
+            key = ("take_" + suffix, invoice.taker_id)
+            bucket_entries[key] = bucket_entries.get(key, 0) + invoice.take_amount
+    return {buckets: bucket_entries for buckets, bucket_entries in entries.items() if len(bucket_entries) > 0}
+
+
+def add_points(buckets, bucket_entries):
+    bucket_filter = Q()
+    for period, bucket in buckets:
+        bucket_filter |= Q(period=period, bucket=bucket)
+    entry_filter = Q()
+    for kind, user_id in bucket_entries:
+        entry_filter |= Q(kind=kind, user_id=user_id)
+
+    RankingEntry.objects.filter(bucket_filter).filter(entry_filter).update(
+        points=F('points') + Case(
+            *[When(kind=kind, user_id=user_id, then=Value(points))
+              for (kind, user_id), points in bucket_entries.items()],
+            default=Value(0)))
+
+
+def get_top_users(period, is_cast, is_gift, size=TOP_SIZE):
+    """
+    Top users of the current bucket with their overall_points, filled up by
+    call times like before. The filled up users have no points (None).
+    """
+    users = get_ranked_users(is_cast, is_gift)
+    top_points = dict(
+        RankingEntry.objects.filter(
+            period=period,
+            bucket=get_bucket(period),
+            kind=get_kind(is_cast, is_gift),
+            user__in=users).order_by(
+            '-points', '-user__call_times').values_list(
+            'user_id', 'points')[:size])
+    top_ids = list(top_points)
+
+    if len(top_ids) < size:
+        top_ids += list(
+            users.exclude(id__in=top_ids).order_by(
+                '-call_times').values_list('id', flat=True)[:size - len(top_ids)])
+
+    top_users = users.in_bulk(top_ids)
+    result = []
+    for user_id in top_ids:
+        if user_id in top_users:
+            user = top_users[user_id]
+            user.overall_points = top_points.get(user_id)
+            result.append(user)
+    return result
+
+
+def get_user_rank(period, is_cast, is_gift, user):
+    """
+    Rank and points of the user in the current bucket. The rank counts the
+    ranked users above its points, read from the (period, bucket, kind,
+    points) index and joined with the members, so it costs in proportion to
+    the rank rather than to the number of members.
+    """
+    users = get_ranked_users(is_cast, is_gift)
+    if not users.filter(id=user.id).exists():
+        return {"rank": None, "points": 0}
+
+    entries = RankingEntry.objects.filter(
+        period=period,
+        bucket=get_bucket(period),
+        kind=get_kind(is_cast, is_gift))
+    points = entries.filter(user=user).values_list('points', flat=True).first() or 0
+
+    return {
+        "rank": entries.filter(points__gt=points, user__in=users).count() + 1,
+        "points": points
+    }
+
+
+def compute_bucket(period, bucket):
+    """
+    Points per (kind, user) of a bucket, aggregated from invoices.
+    """
+    start_time, end_time = get_bucket_range(period, bucket)
+    invoices = Invoice.objects.filter(
+        created_at__gte=start_time,
+        created_at__lt=end_time,
+        invoice_type__in=list(RANKED_TYPES.keys()))
+
+    result = {}
+    for prefix, user_field, amount_field in [
+            ("give", "giver_id", "give_amount"), ("take", "taker_id", "take_amount")]:
+        rows = invoices.exclude(**{user_field: None}).values(
+            user_field, 'invoice_type').annotate(
+            points=Sum(amount_field)).order_by()
+        for row in rows:
+            if row['points']:
+                kind = "{0}_{1}".format(prefix, RANKED_TYPES[row['invoice_type']])
+                result[(kind, row[user_field])] = row['points']
+
+    return result
+
+
+def rebuild_bucket(period, bucket):
+    rows = compute_bucket(period, bucket)
+    with transaction.atomic():
+        RankingEntry.objects.filter(period=period, bucket=bucket).delete()
+        RankingEntry.objects.bulk_create([
+            RankingEntry(period=period, bucket=bucket, kind=kind, user_id=user_id, points=points)
+            for (kind, user_id), points in rows.items()
+        ], batch_size=1000)
+    return len(rows)
+
+
+def check_bucket(period, bucket):
+    """
+    Differences between the stored bucket and the invoices,
+    as (kind, user_id, stored, expected) tuples.
+    """
+    expected = compute_bucket(period, bucket)
+    stored = {
+        (kind, user_id): points for kind, user_id, points in RankingEntry.objects.filter(
+            period=period, bucket=bucket).exclude(points=0).values_list('kind', 'user_id', 'points')}
+
+    return [
+        (key[0], key[1], stored.get(key, 0), expected.get(key, 0))
+        for key in sorted(set(expected) | set(stored))
+        if stored.get(key, 0) != expected.get(key, 0)]
@@ -0,0 +1,140 @@
+"""
+Balance reconciliation over the invoice ledger
+
+The invoices are read in primary key chunks, as mysqlclient has no server
+side cursors, and their takes and gives are added into NumPy arrays indexed
+by member id. The balance each member should have is then compared with
+Member.point in one vectorized pass. Proceeded transfers take points without
+an invoice and are counted as gives, and the house member is compared with
+the house balance including its shards.
+"""
+import csv
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from django.db import connection, transaction
+from django.db.models import Max, Value
+from django.db.models.functions import Coalesce
+
+from accounts.models import Member, TransferApplication
+from .ledger import HOUSE_USERNAME, get_house_point
+from .models import Invoice
+
+CHUNK_SIZE = 50000
+
+
+def stream_chunks(queryset, fields, chunk_size=CHUNK_SIZE):
+    """
+    Arrays of the fields of the rows, chunk_size rows at a time in id order,
+    null ids read as member 0.
+    """
+    last_id = 0
+    while True:
+        rows = list(queryset.filter(id__gt=last_id).order_by('id').values_list('id', *fields)[:chunk_size])
+        if len(rows) == 0:
+            return
+        last_id = rows[-1][0]
+        yield np.array(rows, dtype=np.int64)[:, 1:]
+
+
+def grow(balances, member_ids):
+    """
+    The array extended to the members created since it was sized.
+    """
+    size = int(member_ids.max()) + 1 if len(member_ids) > 0 else 0
+    if size > len(balances):
+        return np.concatenate([balances, np.zeros(size - len(balances), dtype=np.int64)])
+    return balances
+
+
+def add_amounts(balances, member_ids, amounts):
+    balances = grow(balances, member_ids)
+    np.add.at(balances, member_ids, amounts)
+    return balances
+
+
+def compute_balances(chunk_size=CHUNK_SIZE):
+    """
+    Balance of every member by the ledger, as an array indexed by member id,
+    and the number of invoices read.
+    """
+    max_id = Member.all_objects.aggregate(max_id=Max('id'))['max_id'] or 0
+    balances = np.zeros(max_id + 1, dtype=np.int64)
+
+    invoices = Invoice.objects.annotate(
+        taker_key=Coalesce('taker_id', Value(0)), giver_key=Coalesce('giver_id', Value(0)))
+    invoice_count = 0
+    for chunk in stream_chunks(invoices, ['taker_key', 'take_amount', 'giver_key', 'give_amount'], chunk_size):
+        balances = add_amounts(balances, chunk[:, 0], chunk[:, 1])
+        balances = add_amounts(balances, chunk[:, 2], -chunk[:, 3])
+        invoice_count += len(chunk)
+
+    transfers = TransferApplication.objects.filter(status=1).annotate(user_key=Coalesce('user_id', Value(0)))
+    for chunk in stream_chunks(transfers, ['user_key', 'point'], chunk_size):
+        balances = add_amounts(balances, chunk[:, 0], -chunk[:, 1])
+
+    # member 0 collects the rows of deleted members
+    balances[0] = 0
+    return balances, invoice_count
+
+
+@contextmanager
+def snapshot():
+    """
+    A transaction reading a single snapshot of the database. MySQL and
+    PostgreSQL connections run READ COMMITTED, so the transaction is raised
+    to REPEATABLE READ before its first read. Inside an outer transaction
+    the isolation of that one applies.
+    """
+    outermost = not connection.in_atomic_block
+    with transaction.atomic():
+        if outermost and connection.vendor in ('mysql', 'postgresql'):
+            with connection.cursor() as cursor:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        yield
+
+
+def reconcile_balances(chunk_size=CHUNK_SIZE):
+    """
+    Members whose point differs from the ledger, as rows of id, username,
+    point, expected and difference, with the counts of the run.
+    """
+    started_at = time.perf_counter()
+
+    # one snapshot of the invoices and the balances
+    with snapshot():
+        balances, invoice_count = compute_balances(chunk_size)
+        members = np.concatenate(
+            [np.zeros((0, 2), dtype=np.int64)] + list(stream_chunks(Member.all_objects, ['id', 'point'], chunk_size)))
+        house = Member.all_objects.filter(
+            is_superuser=True, username=HOUSE_USERNAME).values_list('id', flat=True).first()
+        house_point = get_house_point()
+
+    balances = grow(balances, members[:, 0])
+    points = members[:, 1].copy()
+    if house is not None:
+        points[members[:, 0] == house] = house_point
+    expected = balances[members[:, 0]]
+    mismatched = np.flatnonzero(points != expected)
+
+    usernames = dict(Member.all_objects.filter(
+        id__in=members[mismatched, 0].tolist()).values_list('id', 'username'))
+    rows = [
+        (int(members[index, 0]), usernames.get(int(members[index, 0]), ""),
+         int(points[index]), int(expected[index]), int(points[index] - expected[index]))
+        for index in mismatched]
+
+    return rows, {
+        "members": len(members),
+        "invoices": invoice_count,
+        "mismatched": len(rows),
+        "elapsed_ms": round((time.perf_counter() - started_at) * 1000, 2),
+    }
+
+
+def write_report(rows, path):
+    with open(path, 'w', newline='') as report_file:
+        writer = csv.writer(report_file)
+        writer.writerow(['id', 'username', 'point', 'expected', 'difference'])
+        writer.writerows(rows)
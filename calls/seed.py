@@ -0,0 +1,260 @@
+"""
+Synthetic data at production scale
+
+Everything is drawn from one random seed, so the same arguments give the
+same rows. Rows are written with bulk_create and tagged by the username
+prefix of their members, and the derived tables (search index, unread
+counters, daily statistics, rankings) are rebuilt at the end.
+"""
+import random
+from datetime import timedelta
+
+from django.utils import timezone
+
+from accounts.facets import rebuild_facets
+from accounts.models import Detail, Media, Member, Tweet
+from accounts.normalize import normalize_name
+from accounts.search import rebuild_search_grams
+from basics.models import CastClass, Choice, CostPlan, Gift, GuestLevel, Location, Setting
+from chat.models import Message, Receipt, Room
+from chat.utils import rebuild_unread_counters
+from .models import Invoice, Join, Order
+from .ranking import PERIODS, get_bucket, rebuild_bucket
+from .statistics import rollup_day
+
+SEED_PREFIX = "seed_"
+
+# share of the members by role
+ROLE_WEIGHTS = {0: 30, 1: 65, 10: 5}
+
+# days the rows are spread over
+SPREAD_DAYS = 90
+
+NICKNAME_PARTS = ["さくら", "ユイ", "ﾐﾅ", "あや", "カナ", "りこ", "Mai", "ひな", "エミ", "Rin"]
+MESSAGE_PARTS = ["こんにちは", "よろしくお願いします", "今日は空いていますか", "ありがとうございました", "また会いましょう"]
+
+
+def insert_rows(model, rows, batch_size=1000):
+    """
+    bulk_create that also sets the ids on backends that do not return them.
+    """
+    model._base_manager.bulk_create(rows, batch_size=batch_size)
+    if len(rows) > 0 and rows[0].pk is None:
+        ids = list(model._base_manager.order_by('-id').values_list('id', flat=True)[:len(rows)])
+        for row, pk in zip(rows, reversed(ids)):
+            row.pk = pk
+    return rows
+
+
+def set_created_at(model, rows, times, batch_size=1000):
+    """
+    Spread the rows in time, auto_now_add stamps them all with now on insert.
+    """
+    for row, created_at in zip(rows, times):
+        row.created_at = created_at
+    model._base_manager.bulk_update(rows, ['created_at'], batch_size=batch_size)
+
+
+def get_references():
+    parent = Location.objects.get_or_create(name="シード", parent=None)[0]
+    locations = [
+        Location.objects.get_or_create(name="シード{}".format(index), parent=parent)[0]
+        for index in range(3)]
+    cast_classes = [
+        CastClass.objects.get_or_create(name="シードクラス{}".format(index), defaults={"order": index})[0]
+        for index in range(3)]
+    guest_levels = [
+        GuestLevel.objects.get_or_create(name="シードレベル{}".format(index), defaults={"order": index})[0]
+        for index in range(3)]
+    choices = [
+        Choice.objects.get_or_create(name="シード{}".format(index), category='sc'[index % 2])[0]
+        for index in range(10)]
+    cost_plans = []
+    for index, location in enumerate(locations):
+        cost_plan = CostPlan.objects.get_or_create(
+            name="シードプラン{}".format(index), location=location, defaults={"cost": 3000 + index * 1000})[0]
+        cost_plan.classes.set(cast_classes)
+        cost_plans.append(cost_plan)
+    gifts = [
+        Gift.objects.get_or_create(
+            name="シードギフト{}".format(index), location=locations[index % 3],
+            defaults={"point": 1000 * (index + 1), "back": 500 * (index + 1)})[0]
+        for index in range(3)]
+
+    return {
+        "parent": parent,
+        "locations": locations,
+        "cast_classes": cast_classes,
+        "guest_levels": guest_levels,
+        "choices": choices,
+        "cost_plans": cost_plans,
+        "gifts": gifts,
+    }
+
+
+def seed_data(members=1000, seed=0, batch_size=1000):
+    """
+    Members with avatars, orders in every status with their joins, private
+    rooms with a receipt per participant, invoices and tweets. Returns the
+    number of rows of each kind.
+    """
+    rng = random.Random(seed)
+    now = timezone.now()
+    references = get_references()
+
+    def random_time():
+        return now - timedelta(seconds=rng.randint(0, SPREAD_DAYS * 24 * 60 * 60))
+
+    # later runs add members after the seeded ones
+    start = Member.all_objects.filter(username__startswith=SEED_PREFIX).count()
+
+    # members with their detail, setting and avatar
+    details = insert_rows(Detail, [Detail() for _ in range(members)], batch_size)
+    member_settings = insert_rows(Setting, [Setting() for _ in range(members)], batch_size)
+    roles = rng.choices(list(ROLE_WEIGHTS.keys()), weights=list(ROLE_WEIGHTS.values()), k=members)
+    new_members = []
+    for index, role in enumerate(roles):
+        nickname = "{0}{1}".format(rng.choice(NICKNAME_PARTS), start + index)
+        new_members.append(Member(
+            username="{0}{1}".format(SEED_PREFIX, start + index),
+            email="{0}{1}@example.com".format(SEED_PREFIX, start + index),
+            nickname=nickname,
+            search_name=normalize_name(nickname),
+            role=role,
+            is_registered=role != 10,
+            is_applied=role == 10,
+            is_present=role == 0 and rng.random() < 0.3,
+            presented_at=now + timedelta(hours=1),
+            birthday=now - timedelta(days=rng.randint(20 * 365, 50 * 365)),
+            point=rng.randint(0, 100000) if role == 1 else 0,
+            point_half=rng.randrange(2000, 10001, 500),
+            cast_class=rng.choice(references["cast_classes"]) if role == 0 else None,
+            guest_level=rng.choice(references["guest_levels"]) if role == 1 else None,
+            location=rng.choice(references["locations"]),
+            detail=details[index],
+            setting=member_settings[index],
+            started_at=random_time()))
+    insert_rows(Member, new_members, batch_size)
+
+    avatars = insert_rows(Media, [Media(uri="static/images/seed.jpg") for _ in range(members)], batch_size)
+    Member.avatars.through.objects.bulk_create([
+        Member.avatars.through(member_id=member.id, media_id=avatar.id)
+        for member, avatar in zip(new_members, avatars)], batch_size=batch_size)
+
+    casts = [member for member in new_members if member.role == 0]
+    guests = [member for member in new_members if member.role == 1]
+    Member.cast_status.through.objects.bulk_create([
+        Member.cast_status.through(member_id=cast.id, choice_id=choice.id)
+        for cast in casts for choice in rng.sample(references["choices"], 3)], batch_size=batch_size)
+
+    counts = {"members": members, "casts": len(casts), "guests": len(guests)}
+    if len(casts) == 0 or len(guests) == 0:
+        rebuild_search_grams(Member.objects.filter(id__in=[member.id for member in new_members]), batch_size)
+        rebuild_facets()
+        return counts
+
+    # private rooms of a guest and a cast, with a receipt per participant
+    rooms = insert_rows(Room, [Room(room_type="private", status=0) for _ in range(max(members // 4, 1))], batch_size)
+    room_users = [(rng.choice(guests), rng.choice(casts)) for _ in rooms]
+    Room.users.through.objects.bulk_create([
+        Room.users.through(room_id=room.id, member_id=user.id)
+        for room, users in zip(rooms, room_users) for user in users], batch_size=batch_size)
+
+    messages, participants, times = [], [], []
+    for room, users in zip(rooms, room_users):
+        for _ in range(rng.randint(5, 30)):
+            sender = rng.choice(users)
+            messages.append(Message(room=room, sender=sender, content=rng.choice(MESSAGE_PARTS)))
+            participants.append(users)
+            times.append(random_time())
+    insert_rows(Message, messages, batch_size)
+    set_created_at(Message, messages, times, batch_size)
+    Receipt.objects.bulk_create([
+        Receipt(
+            message_id=message.id, user_id=user.id, room_id=message.room_id,
+            is_read=user.id == message.sender_id or rng.random() < 0.8, created_at=message.created_at)
+        for message, users in zip(messages, participants) for user in users], batch_size=batch_size)
+
+    last_messages = {}
+    for message in messages:
+        if message.room_id not in last_messages or message.created_at > last_messages[message.room_id].created_at:
+            last_messages[message.room_id] = message
+    for room in rooms:
+        if room.id in last_messages:
+            room.last_message = last_messages[room.id].content
+            room.last_sender_id = last_messages[room.id].sender_id
+    Room.objects.bulk_update(rooms, ['last_message', 'last_sender'], batch_size=batch_size)
+
+    # orders in every status, their joins and the invoices of the paid ones
+    orders, times = [], []
+    for index in range(max(members // 5, 1)):
+        cost_plan = rng.choice(references["cost_plans"])
+        meet_time = random_time() + timedelta(days=rng.randint(0, 2))
+        orders.append(Order(
+            status=index % len(Order.STATUS_CHOICES),
+            user=rng.choice(guests),
+            parent_location=references["parent"],
+            location=cost_plan.location,
+            cost_plan=cost_plan,
+            meet_time_iso=meet_time,
+            person=rng.randint(1, 3),
+            period=rng.randint(1, 3),
+            collect_started_at=meet_time - timedelta(hours=1),
+            collect_ended_at=meet_time - timedelta(minutes=30),
+            cost_value=cost_plan.cost))
+        times.append(meet_time - timedelta(hours=2))
+    insert_rows(Order, orders, batch_size)
+    set_created_at(Order, orders, times, batch_size)
+
+    joins = []
+    for order in orders:
+        for cast in rng.sample(casts, min(order.person + 1, len(casts))):
+            joins.append(Join(
+                order=order, user=cast, status=1 if order.status >= 3 else 0,
+                dropped=rng.random() < 0.1, is_ended=order.status >= 5))
+    insert_rows(Join, joins, batch_size)
+
+    invoices, times = [], []
+    for order in orders:
+        if order.status in [6, 7]:
+            points = order.cost_value * order.period * 2
+            invoices.append(Invoice(
+                invoice_type="CALL", give_amount=points, take_amount=points * 3 // 4,
+                giver=order.user, taker=rng.choice(casts), order=order))
+            times.append(order.collect_ended_at + timedelta(hours=order.period))
+    for _ in range(members // 2):
+        gift = rng.choice(references["gifts"])
+        invoices.append(Invoice(
+            invoice_type="GIFT", give_amount=gift.point, take_amount=gift.back,
+            giver=rng.choice(guests), taker=rng.choice(casts), gift=gift))
+        times.append(random_time())
+    for _ in range(members // 5):
+        points = rng.choice([3000, 5000, 10000])
+        invoices.append(Invoice(invoice_type="BUY", take_amount=points, taker=rng.choice(guests)))
+        times.append(random_time())
+    insert_rows(Invoice, invoices, batch_size)
+    set_created_at(Invoice, invoices, times, batch_size)
+
+    tweets = insert_rows(Tweet, [
+        Tweet(content=rng.choice(MESSAGE_PARTS), user=rng.choice(new_members), category=rng.randint(0, 1))
+        for _ in range(members // 2)], batch_size)
+    set_created_at(Tweet, tweets, [random_time() for _ in tweets], batch_size)
+
+    # derived tables
+    rebuild_search_grams(Member.objects.filter(id__in=[member.id for member in new_members]), batch_size)
+    rebuild_unread_counters(batch_size)
+    rebuild_facets()
+    for day in range(SPREAD_DAYS + 1):
+        rollup_day((now - timedelta(days=day)).date())
+    for period in PERIODS:
+        rebuild_bucket(period, get_bucket(period, now))
+
+    counts.update({
+        "rooms": len(rooms),
+        "messages": len(messages),
+        "orders": len(orders),
+        "joins": len(joins),
+        "invoices": len(invoices),
+        "tweets": len(tweets),
+    })
+    return counts
@@ -1,26 +1,30 @@
 from django.core.exceptions import ValidationError
+from django.db import models, transaction
 from .models import Invoice, Order, Join, Review, InvoiceDetail
 from rest_framework import serializers
 
-from django.db.models import Sum
+from django.db.models import Sum, Count, Prefetch, Q, prefetch_related_objects
 from django.utils import timezone
 from datetime import timedelta
 
-from basics.models import Location
+from basics.models import CostPlan, Gift, Location
 from basics.serializers import ChoiceSerializer, GiftSerializer, LocationSerializer, CostplanSerializer, ClassesSerializer
 
-from chat.serializers import RoomSerializer
+from chat.models import Room
+from chat.serializers import RoomSerializer, get_room_prefetches
 
-from accounts.serializers.member import GeneralInfoSerializer, MainInfoSerializer
+from accounts.cards import ProfileCardField, get_cards
 from accounts.models import Member
 from .axes import create_axes_payment
+from .ledger import apply_deltas, get_house_member, post_entries, refresh_balance
+from .settlement import AlreadySettled, is_settled, lock_order
 
 
 class JoinSerializer(serializers.ModelSerializer):
     """
     Join Serializer
     """
-    user = GeneralInfoSerializer(read_only=True)
+    user = ProfileCardField("general")
     user_id = serializers.IntegerField(write_only=True)
     order_id = serializers.IntegerField(write_only=True)
 
@@ -41,10 +45,51 @@ class JoinSerializer(serializers.ModelSerializer):
         model = Join
 
 
+def get_order_prefetches():
+    """
+    Prefetch plan of OrderSerializer: the members, places, plan, situations,
+    room and joins of the orders, in a fixed number of queries.
+    """
+    return [
+        'user',
+        'target',
+        'parent_location',
+        'location',
+        Prefetch('cost_plan', queryset=CostPlan.objects.select_related('location').prefetch_related('classes')),
+        'situations',
+        Prefetch('room', queryset=Room.objects.prefetch_related(*get_room_prefetches())),
+        Prefetch('joins', queryset=Join.objects.select_related('user')),
+    ]
+
+
+def load_order_cards(orders):
+    """
+    Cache the cards of the guests and casts of the orders at once, for the
+    ProfileCardFields of each order.
+    """
+    members = []
+    for order in orders:
+        members += [member for member in [order.user, order.target] if member is not None]
+        members += [join.user for join in order.joins.all() if join.user is not None]
+    get_cards("general", members)
+
+
+class OrderListSerializer(serializers.ListSerializer):
+    """
+    Applies the prefetch plan to the whole page before serializing it
+    """
+
+    def to_representation(self, data):
+        orders = list(data.all() if isinstance(data, models.Manager) else data)
+        prefetch_related_objects(orders, *get_order_prefetches())
+        load_order_cards(orders)
+        return super(OrderListSerializer, self).to_representation(orders)
+
+
 class OrderSerializer(serializers.ModelSerializer):
-    user = GeneralInfoSerializer(read_only=True)
-    target = GeneralInfoSerializer(read_only=True)
-    joined = MainInfoSerializer(many=True, read_only=True)
+    user = ProfileCardField("general")
+    target = ProfileCardField("general")
+    joined = ProfileCardField(many=True)
     parent_location = LocationSerializer(read_only=True)
     location = LocationSerializer(read_only=True)
     cost_plan = CostplanSerializer(read_only=True)
@@ -119,6 +164,7 @@ class OrderSerializer(serializers.ModelSerializer):
             'operator_message': {'allow_blank': True},
             'meet_time': {'allow_blank': True}
         }
+        list_serializer_class = OrderListSerializer
 
     def get_applying(self, obj):
         return obj.joins.count()
@@ -176,8 +222,20 @@ class OrderSerializer(serializers.ModelSerializer):
         return instance
 
 
+class InvoiceDetailListSerializer(serializers.ListSerializer):
+    """
+    Loads the cards of all the casts at once before serializing the details
+    """
+
+    def to_representation(self, data):
+        details = list(data.all() if isinstance(data, models.Manager) else data)
+        prefetch_related_objects(details, 'cast')
+        get_cards("main", [detail.cast for detail in details])
+        return super(InvoiceDetailListSerializer, self).to_representation(details)
+
+
 class InvoiceDetailSerializer(serializers.ModelSerializer):
-    cast = MainInfoSerializer(read_only=True)
+    cast = ProfileCardField()
     cast_id = serializers.IntegerField(write_only=True)
     invoice_ids = serializers.ListField(
         child=serializers.IntegerField(), write_only=True
@@ -203,58 +261,101 @@ class InvoiceDetailSerializer(serializers.ModelSerializer):
             'cast_desire_point',
             'order_id')
         model = InvoiceDetail
+        list_serializer_class = InvoiceDetailListSerializer
 
     def create(self, validated_data):
         invoice_ids = validated_data.pop("invoice_ids")
         order_id = validated_data.pop("order_id")
         cur_order = Order.objects.get(pk=order_id)
-        invoice_detail = InvoiceDetail.objects.create(**validated_data)
-
-        # Invoice create for cast
-        invoice_cast = Invoice.objects.create(
-            invoice_type="CALL",
-            taker=invoice_detail.cast,
-            order_id=order_id,
-            take_amount=invoice_detail.cast_point,
-            room=cur_order.room)
-        cur_cast = invoice_detail.cast
-        cur_cast.point += invoice_detail.cast_point
-
-        invoice_ids.append(invoice_cast.id)
-        invoice_detail.invoices.set(invoice_ids)
-
-        # cast expire data update
-        if invoice_detail.extend_min > 0:
-            cur_cast.expire_times += 1
-            cur_cast.expire_amount += invoice_detail.extend_min
-        cur_cast.save()
-
-        # guest expire data update
-        if invoice_detail.extend_min > 0:
-            guest = cur_order.user
-            if cur_order.is_private:
-                guest = cur_order.user if cur_order.user.role == 1 else cur_order.target
-            guest.expire_times += 1
-            guest.expire_amount += invoice_detail.extend_min
-            guest.save()
-
-        admin = Member.objects.get(is_superuser=True, username="admin")
-        Invoice.objects.create(
-            invoice_type="ADMIN",
-            taker=admin,
-            take_amount=invoice_detail.total_point - invoice_detail.cast_point,
-            order_id=order_id,
-            room=cur_order.room)
-        admin.point += invoice_detail.total_point - invoice_detail.cast_point
-        admin.save()
+        admin = get_house_member()
+        house_point = validated_data['total_point'] - validated_data['cast_point']
+
+        with transaction.atomic():
+            lock_order(cur_order)
+            if is_settled(cur_order, [validated_data['cast_id']]):
+                raise AlreadySettled("Cast already settled")
+
+            invoice_detail = InvoiceDetail.objects.create(**validated_data)
+
+            # Invoice for cast and house
+            invoice_cast = Invoice(
+                invoice_type="CALL",
+                taker=invoice_detail.cast,
+                order_id=order_id,
+                take_amount=invoice_detail.cast_point,
+                room=cur_order.room)
+            invoice_admin = Invoice(
+                invoice_type="ADMIN",
+                taker=admin,
+                take_amount=house_point,
+                order_id=order_id,
+                room=cur_order.room)
+            deltas = {invoice_detail.cast_id: {"point": invoice_detail.cast_point}}
+
+            # cast and guest expire data update
+            if invoice_detail.extend_min > 0:
+                guest = cur_order.user
+                if cur_order.is_private:
+                    guest = cur_order.user if cur_order.user.role == 1 else cur_order.target
+                for user_id in [invoice_detail.cast_id, guest.id]:
+                    user_deltas = deltas.setdefault(user_id, {})
+                    user_deltas["expire_times"] = user_deltas.get("expire_times", 0) + 1
+                    user_deltas["expire_amount"] = user_deltas.get("expire_amount", 0) + invoice_detail.extend_min
+
+            post_entries([invoice_cast, invoice_admin], deltas, house=house_point)
+
+            invoice_ids.append(invoice_cast.id)
+            invoice_detail.invoices.set(invoice_ids)
 
         return invoice_detail
 
 
+class SettleLineSerializer(InvoiceDetailSerializer):
+    """
+    Line of one cast in the settlement of an order
+    """
+    invoice_ids = serializers.ListField(
+        child=serializers.IntegerField(), write_only=True, required=False, default=list
+    )
+
+    class Meta(InvoiceDetailSerializer.Meta):
+        fields = tuple(field for field in InvoiceDetailSerializer.Meta.fields if field != 'order_id')
+
+
+class SettleOrderSerializer(serializers.Serializer):
+    lines = SettleLineSerializer(many=True)
+
+
+class InvoiceListSerializer(serializers.ListSerializer):
+    """
+    Loads the orders, gifts, rooms and member cards of the whole page before
+    serializing it
+    """
+
+    def to_representation(self, data):
+        invoices = list(data.all() if isinstance(data, models.Manager) else data)
+        prefetch_related_objects(
+            invoices,
+            'giver',
+            'taker',
+            Prefetch('order', queryset=Order.objects.prefetch_related(*get_order_prefetches())),
+            Prefetch('details', queryset=InvoiceDetail.objects.select_related('cast')),
+            Prefetch('gift', queryset=Gift.objects.select_related('location')),
+            Prefetch('room', queryset=Room.objects.prefetch_related(*get_room_prefetches())))
+
+        members = []
+        for invoice in invoices:
+            members += [member for member in [invoice.giver, invoice.taker] if member is not None]
+            members += [detail.cast for detail in invoice.details.all() if detail.cast is not None]
+        get_cards("main", members)
+        load_order_cards([invoice.order for invoice in invoices if invoice.order is not None])
+        return super(InvoiceListSerializer, self).to_representation(invoices)
+
+
 class InvoiceSerializer(serializers.ModelSerializer):
     order = OrderSerializer(read_only=True)
-    giver = MainInfoSerializer(read_only=True)
-    taker = MainInfoSerializer(read_only=True)
+    giver = ProfileCardField()
+    taker = ProfileCardField()
     giver_id = serializers.IntegerField(write_only=True, required=False)
     taker_id = serializers.IntegerField(write_only=True, required=False)
     details = InvoiceDetailSerializer(many=True, read_only=True)
@@ -285,43 +386,95 @@ class InvoiceSerializer(serializers.ModelSerializer):
         extra_kwargs = {
             'reason': {'allow_blank': True},
         }
+        list_serializer_class = InvoiceListSerializer
 
     def create(self, validated_data):
         from math import ceil
 
+        deltas = {}
         if "taker_id" in validated_data.keys():
-            try:
-                taker = Member.objects.get(pk=validated_data['taker_id'])
-            except BaseException:
+            if not Member.objects.filter(pk=validated_data['taker_id']).exists():
                 raise ValidationError("User Not Found")
-            taker.point = taker.point + validated_data['take_amount']
-            taker.save()
+            deltas[validated_data['taker_id']] = {"point": validated_data.get('take_amount', 0)}
 
         if "giver_id" in validated_data.keys():
             try:
                 giver = Member.objects.get(pk=validated_data['giver_id'])
             except Member.DoesNotExist:
                 raise ValidationError("User Not Found")
-            giver.point = giver.point - validated_data['give_amount']
-            giver.point_used += validated_data['give_amount']
+            giver_deltas = deltas.setdefault(giver.id, {})
+            giver_deltas["point"] = giver_deltas.get("point", 0) - validated_data.get('give_amount', 0)
+            giver_deltas["point_used"] = validated_data.get('give_amount', 0)
+
+        with transaction.atomic():
+            invoice = super(InvoiceSerializer, self).create(validated_data)
+            apply_deltas(deltas)
+            shortage = -refresh_balance(giver).point if "giver_id" in validated_data.keys() else 0
 
-            if giver.point < 0:
-                auto_charge = ceil((-giver.point) / 1000) * 1000
+        # the card is charged after the commit, so no row lock is held over
+        # the payment call and a rolled back invoice is never charged
+        if shortage > 0:
+            auto_charge = ceil(shortage / 1000) * 1000
 
-                # create axes payment
-                if not create_axes_payment(giver, auto_charge):
-                    raise ValidationError('Payment Failed')
-                else:
-                    Invoice.objects.create(
-                        invoice_type="AUTO", taker=giver, take_amount=auto_charge)
-                    giver.point += auto_charge
+            # create axes payment
+            if not create_axes_payment(giver, auto_charge):
+                with transaction.atomic():
+                    apply_deltas({
+                        member_id: {field: -delta for field, delta in member_deltas.items()}
+                        for member_id, member_deltas in deltas.items()})
+                    invoice.delete()
+                raise ValidationError('Payment Failed')
 
-            giver.save()
+            post_entries(
+                [Invoice(invoice_type="AUTO", taker=giver, take_amount=auto_charge)],
+                {giver.id: {"point": auto_charge}})
 
-        return super(InvoiceSerializer, self).create(validated_data)
+        return invoice
+
+
+def get_rank_metrics(user_ids, is_guest, created_from=None, created_to=None):
+    """
+    Invoice metrics of the users in one conditional aggregation query,
+    guests are measured by gave invoices and casts by took invoices. The
+    bounds are the times of get_edge_time, as the ranking order uses.
+    """
+    if is_guest:
+        user_field = 'giver_id'
+        amount_field = 'give_amount'
+    else:
+        user_field = 'taker_id'
+        amount_field = 'take_amount'
+
+    query_set = Invoice.objects.filter(**{"{}__in".format(user_field): list(user_ids)})
+    if created_from is not None:
+        query_set = query_set.filter(created_at__gte=created_from)
+    if created_to is not None:
+        query_set = query_set.filter(created_at__lt=created_to)
+
+    call_filter = Q(invoice_type="CALL")
+    gift_filter = Q(invoice_type="GIFT")
+    private_filter = call_filter & Q(order__is_private=True)
+    public_filter = call_filter & Q(order__is_private=False)
+
+    rows = query_set.values(user_field).annotate(
+        overall_points=Sum(amount_field),
+        call_points=Sum(amount_field, filter=call_filter),
+        private_times=Count('id', filter=private_filter),
+        private_points=Sum('take_amount', filter=private_filter),
+        public_times=Count('id', filter=public_filter),
+        public_points=Sum('take_amount', filter=public_filter),
+        gift_points=Sum(amount_field, filter=gift_filter),
+        gift_times=Count('id', filter=gift_filter)).order_by()
+
+    return {row.pop(user_field): row for row in rows}
 
 
 class RankUserSerializer(serializers.ModelSerializer):
+    """
+    RankUser Serializer
+
+    The metrics come from get_rank_metrics through the context
+    """
     overall_points = serializers.SerializerMethodField()
     call_points = serializers.SerializerMethodField()
     private_times = serializers.SerializerMethodField()
@@ -347,82 +500,44 @@ class RankUserSerializer(serializers.ModelSerializer):
             'gift_times')
         model = Member
 
-    def get_gave_took(self, obj):
-        date_from = self.context.get('from', "")
-        date_to = self.context.get('to', "")
-        if obj.role == 1:
-            query_set = obj.gave
-        else:
-            query_set = obj.took
-        if date_from != "":
-            query_set = query_set.filter(created_at__date__gte=date_from)
-        if date_to != "":
-            query_set = query_set.filter(created_at__date__lte=date_to)
-        return query_set
+    def get_metric(self, obj, key, default=None):
+        return self.context.get('metrics', {}).get(obj.id, {}).get(key, default)
 
     def get_overall_points(self, obj):
-        if obj.role == 1:
-            return self.get_gave_took(obj).aggregate(
-                Sum('give_amount'))['give_amount__sum']
-        else:
-            return self.get_gave_took(obj).aggregate(
-                Sum('take_amount'))['take_amount__sum']
+        return self.get_metric(obj, 'overall_points')
 
     def get_call_points(self, obj):
-        if obj.role == 1:
-            return self.get_gave_took(obj).filter(
-                invoice_type='CALL').aggregate(
-                Sum('give_amount'))['give_amount__sum']
-        else:
-            return self.get_gave_took(obj).filter(
-                invoice_type='CALL').aggregate(
-                Sum('take_amount'))['take_amount__sum']
+        return self.get_metric(obj, 'call_points')
 
     def get_private_times(self, obj):
         if obj.role == 0:
-            return self.get_gave_took(obj).filter(
-                invoice_type="CALL", order__is_private=True).count()
+            return self.get_metric(obj, 'private_times', 0)
         else:
             return 0
 
     def get_public_times(self, obj):
         if obj.role == 0:
-            return self.get_gave_took(obj).filter(
-                invoice_type="CALL", order__is_private=False).count()
+            return self.get_metric(obj, 'public_times', 0)
         else:
             return 0
 
     def get_private_points(self, obj):
         if obj.role == 0:
-            return self.get_gave_took(obj).filter(
-                invoice_type="CALL", order__is_private=True).aggregate(
-                Sum('take_amount'))['take_amount__sum']
+            return self.get_metric(obj, 'private_points')
         else:
             return 0
 
     def get_public_points(self, obj):
         if obj.role == 0:
-            return self.get_gave_took(obj).filter(
-                invoice_type="CALL", order__is_private=False).aggregate(
-                Sum('take_amount'))['take_amount__sum']
+            return self.get_metric(obj, 'public_points')
         else:
             return 0
 
     def get_gift_points(self, obj):
-        if obj.role == 1:
-            return self.get_gave_took(obj).filter(
-                invoice_type="GIFT").aggregate(
-                Sum('give_amount'))['give_amount__sum']
-        else:
-            return self.get_gave_took(obj).filter(
-                invoice_type="GIFT").aggregate(
-                Sum('take_amount'))['take_amount__sum']
+        return self.get_metric(obj, 'gift_points')
 
     def get_gift_times(self, obj):
-        if obj.role == 1:
-            return self.get_gave_took(obj).filter(invoice_type="GIFT").count()
-        else:
-            return self.get_gave_took(obj).filter(invoice_type="GIFT").count()
+        return self.get_metric(obj, 'gift_times', 0)
 
 
 class AdminOrderCreateSerializer(serializers.Serializer):
@@ -432,8 +547,8 @@ class AdminOrderCreateSerializer(serializers.Serializer):
 
 
 class ReviewSerializer(serializers.ModelSerializer):
-    source = MainInfoSerializer(read_only=True)
-    target = MainInfoSerializer(read_only=True)
+    source = ProfileCardField()
+    target = ProfileCardField()
     source_id = serializers.IntegerField(write_only=True)
     target_id = serializers.IntegerField(write_only=True)
     order = OrderSerializer(read_only=True)
@@ -0,0 +1,148 @@
+"""
+Settlement of an order in one request
+
+The lines of every cast are written together: the invoice details, the CALL
+invoice of each cast and the ADMIN invoice of the house with bulk_create,
+and the balances, expire counters, house share and rankings with one update
+each, all in a single transaction. The invoices the client already created
+(the payment of the guest) are linked to the details as before.
+"""
+from django.db import connection, transaction
+
+from accounts.models import Member
+from .ledger import apply_deltas, credit_house, get_house_member
+from .models import Invoice, InvoiceDetail, Join, Order
+from .ranking import record_invoices
+
+
+class SettlementError(Exception):
+    """
+    Lines that do not settle the order
+    """
+    pass
+
+
+class AlreadySettled(SettlementError):
+    pass
+
+
+def is_settled(order, cast_ids=None):
+    """
+    Whether the order, or the casts of it when given, took their CALL
+    invoices already.
+    """
+    query_set = Invoice.objects.filter(order=order, invoice_type="CALL", taker__isnull=False)
+    if cast_ids is not None:
+        query_set = query_set.filter(taker_id__in=cast_ids)
+    return query_set.exists()
+
+
+def lock_order(order):
+    """
+    Lock the order until the end of the transaction, so that it is settled
+    once.
+    """
+    list(Order.objects.select_for_update().filter(pk=order.pk).values_list('id', flat=True))
+
+
+def get_confirmed_cast_ids(order):
+    return set(Join.objects.filter(order=order, status=1, dropped=False).values_list('user_id', flat=True))
+
+
+def get_guest(order):
+    if order.is_private and order.user.role != 1:
+        return order.target
+    return order.user
+
+
+def create_details(details):
+    """
+    bulk_create where the backend returns the ids, one insert per detail on
+    the others (MySQL) as the invoices are linked to them.
+    """
+    if connection.features.can_return_rows_from_bulk_insert:
+        return InvoiceDetail.objects.bulk_create(details)
+    for detail in details:
+        detail.save()
+    return details
+
+
+def settle_order(order, lines):
+    """
+    Settle the order with the validated lines of its confirmed casts, each
+    with the fields of InvoiceDetailSerializer. Returns the invoice details,
+    raises AlreadySettled for a settled order and SettlementError for lines
+    that do not settle it.
+    """
+    cast_ids = [line['cast_id'] for line in lines]
+    if len(cast_ids) == 0 or len(set(cast_ids)) != len(cast_ids):
+        raise SettlementError("One line per cast is required")
+    casts = Member.objects.in_bulk(cast_ids)
+    if len(casts) != len(cast_ids):
+        raise SettlementError("Cast Not Found")
+    admin = get_house_member()
+
+    details, invoices, invoice_ids, deltas = [], [], [], {}
+    guest = get_guest(order)
+    for line in lines:
+        line = dict(line)
+        invoice_ids.append(line.pop('invoice_ids', []))
+        line.pop('order_id', None)
+        detail = InvoiceDetail(**line)
+        detail.cast = casts[detail.cast_id]
+        details.append(detail)
+
+        invoices.append(Invoice(
+            invoice_type="CALL",
+            taker=detail.cast,
+            order=order,
+            take_amount=detail.cast_point,
+            room_id=order.room_id))
+        cast_deltas = deltas.setdefault(detail.cast_id, {})
+        cast_deltas["point"] = cast_deltas.get("point", 0) + detail.cast_point
+
+        # cast and guest expire data update
+        if detail.extend_min > 0 and guest is not None:
+            for user_id in [detail.cast_id, guest.id]:
+                user_deltas = deltas.setdefault(user_id, {})
+                user_deltas["expire_times"] = user_deltas.get("expire_times", 0) + 1
+                user_deltas["expire_amount"] = user_deltas.get("expire_amount", 0) + detail.extend_min
+
+    house_point = sum(detail.total_point - detail.cast_point for detail in details)
+    invoices.append(Invoice(
+        invoice_type="ADMIN",
+        taker=admin,
+        order=order,
+        take_amount=house_point,
+        room_id=order.room_id))
+
+    with transaction.atomic():
+        lock_order(order)
+        if is_settled(order):
+            raise AlreadySettled("Order already settled")
+        # one line for each cast confirmed on the order
+        if set(cast_ids) != get_confirmed_cast_ids(order):
+            raise SettlementError("The lines do not match the confirmed casts")
+
+        create_details(details)
+        Invoice.objects.bulk_create(invoices)
+
+        # the ids of the CALL invoices, read back where the backend does not return them
+        call_ids = dict(Invoice.objects.filter(
+            order=order, invoice_type="CALL", taker_id__in=cast_ids, details__isnull=True
+        ).order_by('id').values_list('taker_id', 'id'))
+        InvoiceDetail.invoices.through.objects.bulk_create([
+            InvoiceDetail.invoices.through(invoicedetail_id=detail.id, invoice_id=invoice_id)
+            for detail, line_invoice_ids in zip(details, invoice_ids)
+            for invoice_id in dict.fromkeys(line_invoice_ids + [call_ids[detail.cast_id]])
+        ], ignore_conflicts=True)
+
+        apply_deltas(deltas)
+        credit_house(house_point)
+        record_invoices(invoices)
+
+    # the casts with their new balances
+    casts = Member.objects.in_bulk(cast_ids)
+    for detail in details:
+        detail.cast = casts[detail.cast_id]
+    return details
@@ -0,0 +1,26 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Invoice, Order
+from .ranking import record_invoice, remove_invoice
+from .statistics import expire_day
+
+
+@receiver(post_save, sender=Invoice)
+def invoice_created(sender, instance, created, **kwargs):
+    if created:
+        record_invoice(instance)
+    elif instance.created_at is not None:
+        expire_day(instance.created_at.date())
+
+
+@receiver(post_delete, sender=Invoice)
+@receiver(post_delete, sender=Order)
+def statistic_deleted(sender, instance, **kwargs):
+    if instance.created_at is not None:
+        expire_day(instance.created_at.date())
+
+
+@receiver(post_delete, sender=Invoice)
+def invoice_deleted(sender, instance, **kwargs):
+    remove_invoice(instance)
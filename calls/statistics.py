@@ -0,0 +1,218 @@
+"""
+Daily statistics for the admin dashboard
+
+Every rolled up day has a ROLLUP_CATEGORY marker row. Days without one,
+today, days not rolled up yet or whose invoices changed since, are computed
+live from the invoices and orders until the nightly task rolls them up.
+"""
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Count, Min, Sum
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from .models import Order, Invoice, DailyStatistic
+
+ORDER_CATEGORY = "ORDER"
+ROLLUP_CATEGORY = "ROLLUP"
+
+
+def compute_days(start_date, end_date):
+    """
+    Statistic rows of the days between both dates included, aggregated from
+    orders and invoices.
+    """
+    rows = []
+
+    invoice_rows = Invoice.objects.filter(
+        created_at__date__gte=start_date, created_at__date__lte=end_date).annotate(
+        stat_date=TruncDate('created_at'),
+        stat_location=Coalesce(
+            'order__parent_location',
+            'giver__location',
+            'taker__location')
+    ).values('stat_date', 'stat_location', 'invoice_type').annotate(
+        count=Count('id'),
+        give_sum=Sum('give_amount'),
+        take_sum=Sum('take_amount')).order_by()
+    for row in invoice_rows:
+        rows.append(DailyStatistic(
+            date=row['stat_date'],
+            location_id=row['stat_location'],
+            category=row['invoice_type'] or "",
+            count=row['count'],
+            give_sum=row['give_sum'] or 0,
+            take_sum=row['take_sum'] or 0))
+
+    order_rows = Order.objects.filter(
+        created_at__date__gte=start_date, created_at__date__lte=end_date).annotate(
+        stat_date=TruncDate('created_at')).values(
+        'stat_date', 'parent_location').annotate(count=Count('id')).order_by()
+    for row in order_rows:
+        rows.append(DailyStatistic(
+            date=row['stat_date'],
+            location_id=row['parent_location'],
+            category=ORDER_CATEGORY,
+            count=row['count']))
+
+    return rows
+
+
+def compute_day(date):
+    return compute_days(date, date)
+
+
+def rollup_day(date):
+    """
+    Store the statistics of one day with its marker, replacing the previous
+    rollup.
+    """
+    rows = compute_day(date)
+    rows.append(DailyStatistic(date=date, category=ROLLUP_CATEGORY))
+    with transaction.atomic():
+        DailyStatistic.objects.filter(date=date).delete()
+        DailyStatistic.objects.bulk_create(rows)
+    return len(rows) - 1
+
+
+def expire_day(date):
+    """
+    Drop the rollup of a past day whose invoices or orders changed, it is
+    computed live until rolled up again.
+    """
+    if date < timezone.now().date():
+        DailyStatistic.objects.filter(date=date).delete()
+
+
+def get_first_date():
+    first_dates = [
+        value for value in [
+            Invoice.objects.aggregate(Min('created_at'))['created_at__min'],
+            Order.objects.aggregate(Min('created_at'))['created_at__min']
+        ] if value is not None]
+    return min(first_dates).date() if len(first_dates) > 0 else None
+
+
+def get_missing_ranges(start_date, end_date):
+    """
+    Runs of consecutive days between both dates included that have no
+    rollup, today always included.
+    """
+    today = timezone.now().date()
+    rolled_dates = set(DailyStatistic.objects.filter(
+        category=ROLLUP_CATEGORY,
+        date__gte=start_date,
+        date__lte=end_date,
+        date__lt=today).values_list('date', flat=True))
+
+    ranges = []
+    cur_date = start_date
+    while cur_date <= end_date:
+        if cur_date not in rolled_dates:
+            if len(ranges) > 0 and ranges[-1][1] == cur_date - timedelta(days=1):
+                ranges[-1] = (ranges[-1][0], cur_date)
+            else:
+                ranges.append((cur_date, cur_date))
+        cur_date += timedelta(days=1)
+    return ranges
+
+
+def rollup_missing(end_date=None):
+    """
+    Roll up every past day without a rollup, returns the number of days.
+    """
+    first_date = get_first_date()
+    end_date = end_date or timezone.now().date() - timedelta(days=1)
+    if first_date is None:
+        return 0
+
+    days = 0
+    for start, end in get_missing_ranges(first_date, end_date):
+        cur_date = start
+        while cur_date <= end:
+            rollup_day(cur_date)
+            cur_date += timedelta(days=1)
+            days += 1
+    return days
+
+
+def _add_row(stats, category, count, give_sum, take_sum):
+    cur_stat = stats.setdefault(
+        category, {"count": 0, "give_sum": 0, "take_sum": 0})
+    cur_stat["count"] += count
+    cur_stat["give_sum"] += give_sum
+    cur_stat["take_sum"] += take_sum
+
+
+def get_daily_statistics(start_date, end_date, location_id=None):
+    """
+    Statistics per date and category between both dates included, days
+    after today left out.
+
+    Rolled up days are read from the stored rows, the others computed live.
+    """
+    today = timezone.now().date()
+    end_date = min(end_date, today)
+    result = {}
+    if start_date > end_date:
+        return result
+
+    stored_rows = DailyStatistic.objects.filter(
+        date__gte=start_date, date__lte=end_date, date__lt=today).exclude(category=ROLLUP_CATEGORY)
+    if location_id is not None:
+        stored_rows = stored_rows.filter(location_id=location_id)
+    for row in stored_rows.values('date', 'category').annotate(
+            count_sum=Sum('count'),
+            give_total=Sum('give_sum'),
+            take_total=Sum('take_sum')).order_by():
+        _add_row(
+            result.setdefault(row['date'], {}),
+            row['category'],
+            row['count_sum'],
+            row['give_total'],
+            row['take_total'])
+
+    for start, end in get_missing_ranges(start_date, end_date):
+        for row in compute_days(start, end):
+            if location_id is None or row.location_id == location_id:
+                _add_row(
+                    result.setdefault(row.date, {}),
+                    row.category,
+                    row.count,
+                    row.give_sum,
+                    row.take_sum)
+
+    return result
+
+
+def get_total_statistics(location_id=None):
+    """
+    Statistics per category over all days.
+    """
+    result = {}
+    first_date = get_first_date()
+    if first_date is None:
+        return result
+
+    stored_rows = DailyStatistic.objects.filter(
+        date__lt=timezone.now().date()).exclude(category=ROLLUP_CATEGORY)
+    if location_id is not None:
+        stored_rows = stored_rows.filter(location_id=location_id)
+    for row in stored_rows.values('category').annotate(
+            count_sum=Sum('count'),
+            give_total=Sum('give_sum'),
+            take_total=Sum('take_sum')).order_by():
+        _add_row(
+            result,
+            row['category'],
+            row['count_sum'],
+            row['give_total'],
+            row['take_total'])
+
+    for start, end in get_missing_ranges(first_date, timezone.now().date()):
+        for row in compute_days(start, end):
+            if location_id is None or row.location_id == location_id:
+                _add_row(result, row.category, row.count, row.give_sum, row.take_sum)
+
+    return result
@@ -1,149 +1,295 @@
 from __future__ import absolute_import, unicode_literals
 
 from .models import Order, Join
-from accounts.models import Member
-from .utils import send_call, send_applier
-from chat.utils import send_super_message, create_room, send_notice_to_room
+from .statistics import rollup_day, rollup_missing
+from .reconcile import reconcile_balances, write_report
+from chat.utils import create_room, send_notice_to_room
+from chat.tasks import enqueue, broadcast_call, broadcast_applier, broadcast_room_created, broadcast_super_message
 
+import logging
+import time
+import uuid
 import pytz
+from django.db import transaction
 from django.utils import timezone
 from datetime import timedelta
-from celery import shared_task
-from django.db.models import Q
+from celery import shared_task, current_app
+from django.db.models import F
+
+logger = logging.getLogger(__name__)
 
 
 @shared_task
 def call_control():
-    for order_item in Order.objects.filter(Q(status=0) | Q(status=1)):
-        # if collect ended at
-        if order_item.collect_ended_at < timezone.now():
-            persons = order_item.person
-            print("person is {}".format(persons))
-            if order_item.status == 0 and order_item.joins.count() < persons:
-                print("no casts applied")
-
-                message = "誠に申し訳ございません。\n \
-                    {}名のキャストをお探ししましたが募集人数に達しなかったためご予約をキャンセルさせていただきました。\n \
-                    またのご利用心よりお待ちしております。\n \
-                    \n \
-                    応募キャスト : {}".format(persons, order_item.joins.count())
-                order_item.status = 8
-                order_item.save()
-
-                # remove the order from application list of cast page
-                class_ids = list(
-                    order_item.cost_plan.classes.values_list(
-                        'id', flat=True))
-                cast_ids = list(
-                    Member.objects.filter(
-                        role=0,
-                        cast_class__id__in=class_ids).values_list(
-                        'id',
-                        flat=True))
-                # user_ids = list(Member.objects.filter(location = order_item.parent_location, role = 0).values_list('id', flat = True))
-                send_call(order_item, cast_ids, "delete")
-
-                # send super message to guest
-                send_super_message("system", order_item.user.id, message)
-
-                # send super message to applied casts
-                cast_ids = list(
-                    order_item.joins.values_list(
-                        'user_id', flat=True))
-                for cast_id in cast_ids:
-                    send_super_message("system", cast_id, message)
-
-                send_call(order_item, cast_ids, "mine")
-
-            if order_item.status == 1 and order_item.joins.filter(
-                    status=1).count() < persons:
-
-                # if remaining casts are less than required
-                if order_item.joins.filter(status=0, dropped=False).count(
-                ) < persons - order_item.joins.filter(status=1).count():
-                    continue
-
-                # order remaining casts by call times
-                candidates = list(
-                    order_item.joins.filter(
-                        status=0,
-                        dropped=False).order_by('user__call_times').values_list(
-                        'id',
-                        flat=True))
-                added_cast_ids = []
-                for _ in range(persons - order_item.joins.filter(status=1).count()):
-                    candidate_id = candidates.pop(0)
-                    added_cast_ids.append(candidate_id)
-                    cur_join = Join.objects.get(pk=candidate_id)
-                    cur_join.status = 1
-                    cur_join.selection = 0
-                    cur_join.save()
-
-                # send cast ids call
-                send_call(order_item, added_cast_ids, "create")
-
-                # remove other joins
-                remove_cast_ids = list(
-                    order_item.joins.filter(
-                        status=0).values_list(
-                        'user_id',
-                        flat=True))
-                start_time_str = order_item.meet_time_iso.astimezone(pytz.timezone(
-                    "Asia/Tokyo")).strftime("%Y{0}%m{1}%d{2}%H{3}%M{4}").format(*"年月日時分")
-                message = "オーダーにエントリー頂き、誠にありが \
-                    とうございました。 残念ながら「合流: {0} {1} キャスト{2}人」のマッチングでは外れました。\
-                    是非またオーダーにエントリー頂けますようお願いいたします!".format(
-                    order_item.location.name if order_item.location else order_item.location_other,
-                    start_time_str,
-                    order_item.person)
-                for cast_id in remove_cast_ids:
-                    send_super_message("system", cast_id, message)
-
-                order_item.joins.filter(status=0).delete()
-
-                # make room for confirmed join casts
-                room_id = create_room(
-                    order_item, list(
-                        order_item.joins.values_list(
-                            'user_id', flat=True)))
-
-                # notify guest
-                send_applier(order_item.id, room_id, order_item.user_id, True)
+    tick_started = time.perf_counter()
+    metrics = {"expired": 0, "cancelled": 0, "matched": 0, "waiting": 0, "handled": 0, "locked": 0}
+
+    # orders whose collection time is over
+    expired_ids = list(
+        Order.objects.filter(
+            status__in=[0, 1],
+            collect_ended_at__lt=timezone.now()).values_list(
+            'id', flat=True))
+    metrics["expired"] = len(expired_ids)
+
+    for order_id in expired_ids:
+        metrics[control_expired_order(order_id)] += 1
+
+    metrics["elapsed_ms"] = round((time.perf_counter() - tick_started) * 1000, 2)
+    logger.info("call control %s", metrics)
+    if metrics["locked"] > 0:
+        logger.warning("call control skipped %d orders locked by another worker", metrics["locked"])
+    return metrics
+
+
+def control_expired_order(order_id):
+    """
+    Cancel or match one expired order, returns what happened to it.
+
+    The order row is locked for the transaction and skipped as "locked"
+    when another worker holds it, so concurrent ticks never handle the same
+    order twice. An order no longer expired is "handled".
+    """
+    with transaction.atomic():
+        expired = Order.objects.filter(
+            pk=order_id,
+            status__in=[0, 1],
+            collect_ended_at__lt=timezone.now())
+        order_item = expired.select_for_update(skip_locked=True).first()
+        if order_item is None:
+            # skipped rows are not told apart from missing ones
+            return "locked" if expired.exists() else "handled"
+
+        persons = order_item.person
+        joins = list(
+            Join.objects.filter(order=order_item).annotate(
+                call_times=F('user__call_times')).order_by('call_times', 'id'))
+
+        if order_item.status == 0 and len(joins) < persons:
+            return cancel_expired_order(order_item, joins)
+
+        confirmed_joins = [join for join in joins if join.status == 1]
+        if order_item.status == 1 and len(confirmed_joins) < persons:
+            return match_expired_order(order_item, joins, persons - len(confirmed_joins))
+
+    return "waiting"
+
+
+def cancel_expired_order(order_item, joins):
+    persons = order_item.person
+    logger.info("no casts applied to order %d", order_item.id)
+
+    message = "誠に申し訳ございません。\n \
+        {}名のキャストをお探ししましたが募集人数に達しなかったためご予約をキャンセルさせていただきました。\n \
+        またのご利用心よりお待ちしております。\n \
+        \n \
+        応募キャスト : {}".format(persons, len(joins))
+    order_item.status = 8
+    order_item.save()
+
+    # remove the order from application list of cast page
+    enqueue(broadcast_call, order_item.id, "delete")
+
+    # send super message to guest and applied casts
+    cast_ids = [join.user_id for join in joins]
+    enqueue(broadcast_super_message, "system", [order_item.user_id] + cast_ids, message)
+    enqueue(broadcast_call, order_item.id, "mine", audience="joins")
+
+    return "cancelled"
+
+
+def match_expired_order(order_item, joins, needed):
+    # if remaining casts are less than required
+    candidates = [
+        join for join in joins if join.status == 0 and not join.dropped]
+    if len(candidates) < needed:
+        return "waiting"
+
+    # remaining casts are ordered by call times
+    winners = candidates[:needed]
+    for join in winners:
+        join.status = 1
+        join.selection = 0
+    Join.objects.bulk_update(winners, ['status', 'selection'])
+
+    # remove other joins
+    remove_cast_ids = [
+        join.user_id for join in joins if join.status == 0]
+    Join.objects.filter(order=order_item, status=0).delete()
+
+    start_time_str = order_item.meet_time_iso.astimezone(pytz.timezone(
+        "Asia/Tokyo")).strftime("%Y{0}%m{1}%d{2}%H{3}%M{4}").format(*"年月日時分")
+    message = "オーダーにエントリー頂き、誠にありが \
+        とうございました。 残念ながら「合流: {0} {1} キャスト{2}人」のマッチングでは外れました。\
+        是非またオーダーにエントリー頂けますようお願いいたします!".format(
+        order_item.location.name if order_item.location else order_item.location_other,
+        start_time_str,
+        order_item.person)
+    enqueue(broadcast_super_message, "system", remove_cast_ids, message)
+
+    # send cast ids call
+    added_cast_ids = [join.user_id for join in winners]
+    enqueue(broadcast_call, order_item.id, "create", receiver_ids=added_cast_ids)
+
+    # make room for confirmed join casts, its events sent once committed
+    cast_ids = [join.user_id for join in joins if join.status == 1]
+    room_id = create_room(order_item, cast_ids, send=False)
+    enqueue(broadcast_room_created, order_item.id, room_id, cast_ids)
+
+    # notify guest
+    enqueue(broadcast_applier, order_item.id, room_id, order_item.user_id, True)
+
+    return "matched"
+
+
+def get_timer_id(join_id, timer_key, kind):
+    return "join-{0}-{1}-{2}".format(join_id, kind, timer_key)
+
+
+def schedule_join_timers(join, period):
+    """
+    Schedule the ten minutes left and extension tasks of a started join.
+
+    Every schedule gets a new key in the task ids, as the workers drop the
+    ids they have revoked before.
+    """
+    join.timer_key = uuid.uuid4().hex
+    Join.objects.filter(pk=join.id).update(timer_key=join.timer_key)
+
+    ended_predict = join.started_at + timedelta(hours=period)
+    timers = (
+        (notify_ten_left, "ten_left", ended_predict - timedelta(minutes=10)),
+        (notify_extended, "extended", ended_predict),
+    )
+    for task, kind, eta in timers:
+        task_id = get_timer_id(join.id, join.timer_key, kind)
+        transaction.on_commit(
+            lambda task=task, eta=eta, task_id=task_id: task.apply_async(
+                args=[join.id], eta=eta, task_id=task_id))
+
+
+def cancel_join_timers(join_id, started_at):
+    if started_at is None:
+        return
+
+    timer_key = Join.objects.filter(pk=join_id).values_list('timer_key', flat=True).first()
+    if not timer_key:
+        return
+
+    for kind in ("ten_left", "extended"):
+        task_id = get_timer_id(join_id, timer_key, kind)
+        transaction.on_commit(lambda task_id=task_id: current_app.control.revoke(task_id))
+
+
+@shared_task
+def notify_ten_left(join_id):
+    """
+    Notify the cast ten minutes before the join ends, at most once.
+    """
+    join = Join.objects.select_related('order__room').filter(
+        pk=join_id,
+        is_started=True,
+        is_ended=False,
+        is_ten_left=False,
+        order__status=4).first()
+    if join is None or join.order.room is None:
+        return False
+
+    # a timer of an older start
+    ended_predict = join.started_at + timedelta(hours=join.order.period)
+    if ended_predict - timedelta(minutes=10) > timezone.now() + timedelta(seconds=1):
+        return False
+
+    if Join.objects.filter(pk=join_id, is_ten_left=False).update(is_ten_left=True) == 0:
+        return False
+
+    # notification
+    room = join.order.room
+    message = "終了予定10分前です。時間を過ぎると自動延長になります。"
+    room.last_message = message
+    room.save()
+    send_notice_to_room(room, message, True, join.user_id)
+    return True
+
+
+@shared_task
+def notify_extended(join_id):
+    """
+    Mark the join as extended once its predicted end has passed.
+    """
+    join = Join.objects.select_related('order').filter(
+        pk=join_id,
+        is_started=True,
+        is_ended=False,
+        is_ten_left=True,
+        is_extended=False,
+        order__status=4).first()
+    if join is None:
+        return False
+
+    # a timer of an older start
+    ended_predict = join.started_at + timedelta(hours=join.order.period)
+    if ended_predict > timezone.now() + timedelta(seconds=1):
+        return False
+
+    return Join.objects.filter(
+        pk=join_id, is_extended=False).update(is_extended=True) > 0
 
 
 @shared_task
 def call_notify():
-    for order_item in Order.objects.filter(status=4):
-
-        if order_item.room is not None:
-
-            # loop through join
-            for join in order_item.joins.filter(
-                    is_started=True, is_ended=False):
-
-                ended_predict = join.started_at + \
-                    timedelta(hours=order_item.period)
-                ten_ended_predict = ended_predict - timedelta(minutes=10)
-                cur_time = timezone.now()
-
-                if not join.is_ten_left:
-
-                    # check 10 minutes left
-                    if ten_ended_predict < cur_time:
-                        # update join
-                        join.is_ten_left = True
-                        join.save()
-
-                        # notification
-                        message = "終了予定10分前です。時間を過ぎると自動延長になります。"
-                        order_item.room.last_message = message
-                        order_item.room.save()
-                        send_notice_to_room(
-                            order_item.room, message, True, join.user_id)
-                else:
-
-                    # check time extended
-                    if ended_predict < cur_time:
-                        # update join's extended state
-                        join.is_extended = True
-                        join.save()
+    """
+    Reconciliation sweep for join timers that were lost or not scheduled.
+    """
+    cur_time = timezone.now()
+    ongoing_joins = Join.objects.filter(
+        is_started=True,
+        is_ended=False,
+        order__status=4,
+        order__room__isnull=False)
+
+    notified_count = 0
+    extended_count = 0
+    for period in ongoing_joins.values_list(
+            'order__period', flat=True).distinct().order_by():
+        period_started_at = cur_time - timedelta(hours=period)
+
+        for join_id in ongoing_joins.filter(
+                order__period=period,
+                is_ten_left=False,
+                started_at__lt=period_started_at + timedelta(minutes=10)).values_list('id', flat=True):
+            notified_count += int(notify_ten_left(join_id))
+
+        for join_id in ongoing_joins.filter(
+                order__period=period,
+                is_ten_left=True,
+                is_extended=False,
+                started_at__lt=period_started_at).values_list('id', flat=True):
+            extended_count += int(notify_extended(join_id))
+
+    logger.info("call notify sweep: %d ten left, %d extended", notified_count, extended_count)
+    return notified_count, extended_count
+
+
+@shared_task
+def rollup_statistics(days=2):
+    """
+    Nightly rollup of the last days and of the days whose rollup was
+    dropped by a change, today is always computed live.
+    """
+    today = timezone.now().date()
+    for delta in range(1, days + 1):
+        rollup_day(today - timedelta(days=delta))
+    return rollup_missing()
+
+
+@shared_task
+def reconcile_ledger(report_path=""):
+    """
+    Nightly check of the balances against the invoice ledger.
+    """
+    rows, summary = reconcile_balances()
+    if report_path != "":
+        write_report(rows, report_path)
+    print("ledger reconcile {}".format(summary))
+    return summary
@@ -1,3 +1,842 @@
-from django.test import TestCase
+import os
+import threading
+from importlib import import_module
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pytz
+
+from django.apps import apps as django_apps
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from accounts import facets
+from accounts.models import Member, MemberSearchGram, TransferApplication
+from accounts.serializers.auth import MemberSerializer
+from accounts.serializers.member import UserSerializer
+from chat.models import Message, Receipt, Room, UnreadCounter
+from chat.tasks import broadcast_applier, broadcast_call, broadcast_room_created, broadcast_super_message
+from .benchmark import compare_results, run_benchmark
+from .billing import audit_rows, bill_joins, get_billed_joins, night_seconds
+from .budget import check_budgets, get_scaling_routes, load_budgets, measure_routes, save_budgets
+from .ledger import apply_deltas, get_house_point, post_entries, refresh_balance, set_house_point
+from .models import DailyStatistic, HouseShard, Invoice, InvoiceDetail, Join, Order, RankingEntry
+from .reconcile import reconcile_balances
+from .settlement import settle_order
+from .ranking import PERIODS, check_bucket, get_bucket, get_user_rank, rebuild_bucket
+from .seed import seed_data
+from .serializers import InvoiceSerializer
+from .statistics import ROLLUP_CATEGORY, get_daily_statistics, get_total_statistics, rollup_day
+from .tasks import (
+    call_control, call_notify, cancel_join_timers, control_expired_order, rollup_statistics, schedule_join_timers)
+
+
+class RankUsersTest(TestCase):
+    """
+    get_rank_users aggregates the metrics of a page in constant queries
+    """
+
+    def setUp(self):
+        self.admin = Member.objects.create(
+            username="admin", email="admin@example.com", role=-1)
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+        self.casts = []
+        for index in range(12):
+            cast = Member.objects.create(
+                username="cast{}".format(index),
+                email="cast{}@example.com".format(index),
+                role=0)
+            self.casts.append(cast)
+
+            private_order = Order.objects.create(is_private=True)
+            public_order = Order.objects.create(is_private=False)
+            Invoice.objects.create(
+                invoice_type="CALL", take_amount=100, taker=cast, order=private_order)
+            Invoice.objects.create(
+                invoice_type="CALL", take_amount=200, taker=cast, order=public_order)
+            Invoice.objects.create(
+                invoice_type="GIFT", take_amount=10 * (index + 1), taker=cast)
+
+    def get_page(self, size):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(
+                '/api/calls/admin/ranking', {'type': 'cast', 'size': size})
+        self.assertEqual(response.status_code, 200)
+        return response.data, len(context.captured_queries)
+
+    def test_query_count_is_constant(self):
+        small_page, small_queries = self.get_page(2)
+        large_page, large_queries = self.get_page(12)
+
+        self.assertEqual(len(small_page['results']), 2)
+        self.assertEqual(len(large_page['results']), 12)
+        self.assertEqual(small_queries, large_queries)
+
+    def test_local_dates(self):
+        # early morning in Asia/Tokyo, still the day before in UTC
+        Invoice.objects.filter(taker=self.casts[0]).update(
+            created_at=pytz.timezone("Asia/Tokyo").localize(datetime(2026, 9, 10, 2, 0)))
+        response = self.client.get('/api/calls/admin/ranking', {
+            'type': 'cast', 'size': 12, 'query': '{"from": "2026-09-10", "to": "2026-09-10"}'})
+
+        top_user = response.data['results'][0]
+        self.assertEqual(top_user['id'], self.casts[0].id)
+        self.assertEqual(top_user['overall_points'], 310)
+        self.assertEqual(top_user['call_points'], 300)
+
+    def test_metrics(self):
+        page, _ = self.get_page(12)
+        top_user = page['results'][0]
+
+        self.assertEqual(top_user['id'], self.casts[-1].id)
+        self.assertEqual(top_user['overall_points'], 420)
+        self.assertEqual(top_user['call_points'], 300)
+        self.assertEqual(top_user['private_times'], 1)
+        self.assertEqual(top_user['private_points'], 100)
+        self.assertEqual(top_user['public_times'], 1)
+        self.assertEqual(top_user['public_points'], 200)
+        self.assertEqual(top_user['gift_times'], 1)
+        self.assertEqual(top_user['gift_points'], 120)
+
+
+@override_settings(
+    DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage',
+    FACET_BACKEND='accounts.facets.MemoryFacets')
+class SeedDataTest(TestCase):
+    """
+    Seeding is repeatable and feeds the endpoint benchmark
+    """
+
+    def setUp(self):
+        facets.backends.clear()
+
+    def test_seed(self):
+        counts = seed_data(members=60, seed=1)
+        self.assertEqual(Member.objects.filter(username__startswith="seed_").count(), 60)
+        self.assertEqual(Order.objects.count(), counts["orders"])
+        self.assertEqual(Join.objects.count(), counts["joins"])
+        self.assertEqual(Message.objects.count(), counts["messages"])
+        self.assertEqual(Receipt.objects.count(), counts["messages"] * 2)
+        self.assertEqual(set(Order.objects.values_list('status', flat=True)), set(range(len(Order.STATUS_CHOICES))))
+        self.assertTrue(MemberSearchGram.objects.exists())
+        self.assertTrue(UnreadCounter.objects.exists())
+        self.assertTrue(facets.get_backend().is_loaded())
+
+        nicknames = list(Member.objects.order_by('id').values_list('nickname', flat=True))
+        Member.all_objects.all().hard_delete()
+        seed_data(members=60, seed=1)
+        self.assertEqual(list(Member.objects.order_by('id').values_list('nickname', flat=True)), nicknames)
+
+    def test_benchmark(self):
+        seed_data(members=60, seed=1)
+        results = run_benchmark(repeat=1)
+        self.assertEqual(len(results), 6)
+        for result in results.values():
+            self.assertEqual(result["status"], 200)
+        # the choices of a seeded cast find it on the facets
+        self.assertGreater(results["search_casts"]["bytes"], 2)
+
+        slower = {name: dict(result, queries=result["queries"] + 1) for name, result in results.items()}
+        self.assertEqual(compare_results(results, results), [])
+        self.assertEqual(len(compare_results(results, slower)), 6)
+
+
+@override_settings(DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage')
+class QueryBudgetTest(TestCase):
+    """
+    Read endpoints stay within their query budgets and do not scale with
+    the data, UPDATE_QUERY_BUDGETS=1 records the budgets again
+    """
+
+    def test_budgets(self):
+        seed_data(members=30, seed=1)
+        small = measure_routes(size=5)
+        seed_data(members=60, seed=2)
+        large = measure_routes(size=10)
+
+        if os.environ.get('UPDATE_QUERY_BUDGETS') == '1':
+            save_budgets(small, large, get_scaling_routes(small, large))
+
+        self.assertEqual(check_budgets(small, large, load_budgets()), [])
+
+    def test_failing_route(self):
+        # a recorded error status is still a failure
+        result = {"api/basics/locations/<int:pk>": {"status": 500, "queries": 0, "bytes": 145}}
+        budgets = {"routes": result, "scales": []}
+        self.assertEqual(
+            check_budgets(result, result, budgets), ["api/basics/locations/<int:pk>: status 500"])
+
+
+@override_settings(
+    HOUSE_SHARDS=4,
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class LedgerTest(TestCase):
+    """
+    The ledger appends invoices with atomic balance updates and keeps the
+    house balance over its shards
+    """
+
+    def setUp(self):
+        self.admin = Member.objects.create(
+            username="admin", email="admin@example.com", role=-1, is_superuser=True, point=1000)
+        self.guest = Member.objects.create(
+            username="guest", email="guest@example.com", role=1, point=5000)
+        self.cast = Member.objects.create(
+            username="cast", email="cast@example.com", role=0, point=0)
+
+    def test_post_entries(self):
+        for _ in range(10):
+            post_entries(
+                [Invoice(invoice_type="GIFT", give_amount=300, giver=self.guest)],
+                {self.guest.id: {"point": -300, "point_used": 300}, self.cast.id: {"point": 200}},
+                house=100)
+
+        self.assertEqual(refresh_balance(self.guest).point, 2000)
+        self.assertEqual(self.guest.point_used, 3000)
+        self.assertEqual(refresh_balance(self.cast).point, 2000)
+        self.assertEqual(refresh_balance(self.admin).point, 1000)
+        self.assertEqual(get_house_point(), 2000)
+        self.assertLessEqual(HouseShard.objects.count(), 4)
+        self.assertEqual(Invoice.objects.filter(invoice_type="GIFT").count(), 10)
+
+    def test_full_save_keeps_balance(self):
+        guest = Member.objects.get(pk=self.guest.id)
+        # credited between the load and the save
+        apply_deltas({self.guest.id: {"point": 500, "point_used": 100}})
+        guest.call_times += 1
+        guest.save()
+
+        guest = Member.objects.get(pk=self.guest.id)
+        self.assertEqual((guest.point, guest.point_used, guest.call_times), (5500, 100, 1))
+
+    def test_full_save_refuses_balance(self):
+        guest = Member.objects.get(pk=self.guest.id)
+        guest.point = 100
+        with self.assertRaises(ValueError):
+            guest.save()
+        guest.save(update_fields=['point'])
+        guest.call_times += 1
+        guest.save()
+        self.assertEqual(Member.objects.get(pk=self.guest.id).point, 100)
+
+    def test_user_balance_update(self):
+        guest = Member.objects.get(pk=self.guest.id)
+        updated_at = guest.updated_at
+        apply_deltas({self.guest.id: {"point_used": 100}})
+        UserSerializer().update(guest, {
+            'detail': {'about': ""}, 'detail_id': guest.detail_id, 'point': 7000, 'expire_times': 2})
+
+        guest = Member.objects.get(pk=self.guest.id)
+        self.assertEqual((guest.point, guest.point_used, guest.expire_times), (7000, 100, 2))
+        self.assertGreater(guest.updated_at, updated_at)
+        adjustment = Invoice.objects.get(invoice_type="ADMIN")
+        self.assertEqual((adjustment.taker_id, adjustment.take_amount), (self.guest.id, 2000))
+
+    @mock.patch('calls.serializers.create_axes_payment')
+    def test_auto_charge(self, create_axes_payment):
+        data = {"invoice_type": "GIFT", "give_amount": 5500, "take_amount": 0, "giver_id": self.guest.id, "reason": ""}
+
+        create_axes_payment.return_value = False
+        serializer = InvoiceSerializer(data=data)
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        with self.assertRaises(ValidationError):
+            serializer.save()
+        self.assertEqual((refresh_balance(self.guest).point, self.guest.point_used), (5000, 0))
+        self.assertFalse(Invoice.objects.exists())
+        # the rankings credited on create are taken back with the invoice
+        self.assertFalse(RankingEntry.objects.exclude(points=0).exists())
+
+        create_axes_payment.return_value = True
+        serializer = InvoiceSerializer(data=data)
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        serializer.save()
+        create_axes_payment.assert_called_with(mock.ANY, 1000)
+        self.assertEqual((refresh_balance(self.guest).point, self.guest.point_used), (500, 5500))
+        self.assertEqual(Invoice.objects.filter(invoice_type="AUTO", take_amount=1000).count(), 1)
+        self.assertEqual(
+            list(RankingEntry.objects.filter(user=self.guest).values_list('kind', 'points').distinct()),
+            [("give_gift", 5500)])
+
+    def test_set_house_point(self):
+        post_entries([], house=500)
+        set_house_point(300)
+
+        self.assertEqual(get_house_point(), 300)
+        self.assertEqual(MemberSerializer(self.admin).data['point'], 300)
+        adjustment = Invoice.objects.get(invoice_type="ADMIN")
+        self.assertEqual((adjustment.giver_id, adjustment.give_amount), (self.admin.id, 1200))
+
+    def test_update_admin_profile(self):
+        client = APIClient()
+        client.force_authenticate(self.admin)
+        self.admin.set_password("password")
+        self.admin.save()
+
+        response = client.get('/api/accounts/profile', {
+            'old_password': "password", 'nickname': "house", 'username': "admin", 'point': 4000})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['point'], 4000)
+        adjustment = Invoice.objects.get(invoice_type="ADMIN")
+        self.assertEqual((adjustment.taker_id, adjustment.take_amount), (self.admin.id, 3000))
+
+    def test_transfer_is_taken_once(self):
+        transfer = TransferApplication.objects.create(user=self.cast, point=1000, apply_type=1)
+        self.cast.point = 3000
+        self.cast.save(update_fields=['point'])
+
+        client = APIClient()
+        client.force_authenticate(self.admin)
+        for _ in range(2):
+            response = client.get('/api/accounts/transfers/proceed/{}'.format(transfer.id))
+            self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(refresh_balance(self.cast).point, 2000)
+
+
+class ReconcileTest(TestCase):
+    """
+    reconcile_balances finds the members whose point differs from the ledger
+    """
+
+    def setUp(self):
+        self.admin = Member.objects.create(
+            username="admin", email="admin@example.com", role=-1, is_superuser=True)
+        self.guest = Member.objects.create(username="guest", email="guest@example.com", role=1)
+        self.cast = Member.objects.create(username="cast", email="cast@example.com", role=0)
+
+        post_entries(
+            [Invoice(invoice_type="BUY", take_amount=10000, taker=self.guest)],
+            {self.guest.id: {"point": 10000}})
+        for _ in range(3):
+            post_entries(
+                [Invoice(invoice_type="GIFT", give_amount=1000, giver=self.guest),
+                 Invoice(invoice_type="GIFT", take_amount=600, taker=self.cast),
+                 Invoice(invoice_type="ADMIN", take_amount=400, taker=self.admin)],
+                {self.guest.id: {"point": -1000}, self.cast.id: {"point": 600}},
+                house=400)
+        TransferApplication.objects.create(user=self.cast, point=500, apply_type=1, status=1)
+        apply_deltas({self.cast.id: {"point": -500}})
+
+    def test_balances_match(self):
+        rows, summary = reconcile_balances(chunk_size=2)
+
+        self.assertEqual(rows, [])
+        self.assertEqual(summary["invoices"], 10)
+        self.assertEqual(summary["members"], 3)
+
+    def test_adjustments(self):
+        set_house_point(5000)
+        self.assertEqual(reconcile_balances()[0], [])
+
+    def test_discrepancies(self):
+        Member.objects.filter(pk=self.cast.id).update(point=2000)
+        Invoice.objects.create(invoice_type="BUY", take_amount=3000, taker=self.guest)
+
+        rows, _ = reconcile_balances(chunk_size=4)
+
+        self.assertEqual(rows, [
+            (self.guest.id, "guest", 7000, 10000, -3000),
+            (self.cast.id, "cast", 2000, 1300, 700),
+        ])
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class SettleOrderTest(TestCase):
+    """
+    orders/<id>/settle settles the lines of every cast in one transaction
+    """
+
+    def setUp(self):
+        self.admin = Member.objects.create(
+            username="admin", email="admin@example.com", role=-1, is_superuser=True)
+        self.guest = Member.objects.create(username="guest", email="guest@example.com", role=1)
+        self.casts = [
+            Member.objects.create(username="cast{}".format(index), email="cast{}@example.com".format(index), role=0)
+            for index in range(10)]
+        self.order = Order.objects.create(user=self.guest, person=10, status=5)
+        Join.objects.bulk_create([Join(order=self.order, user=cast, status=1) for cast in self.casts])
+        self.payment = Invoice.objects.create(
+            invoice_type="CALL", give_amount=100000, giver=self.guest, order=self.order)
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def get_line(self, index, cast):
+        return {
+            "cast_id": cast.id, "join_time": 60, "extend_min": 30 if index == 0 else 0,
+            "total_point": 10000, "cast_point": 7000, "invoice_ids": [self.payment.id],
+        }
+
+    def settle(self, casts=None):
+        lines = [self.get_line(index, cast) for index, cast in enumerate(self.casts if casts is None else casts)]
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(
+                '/api/calls/orders/{}/settle'.format(self.order.id), {"lines": lines}, format='json')
+        return response, len(context.captured_queries)
+
+    def test_settle(self):
+        response, queries = self.settle()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 10)
+        # one insert per detail where bulk_create does not return the ids
+        detail_inserts = 0 if connection.features.can_return_rows_from_bulk_insert else 10
+        self.assertLessEqual(queries - detail_inserts, 21)
+
+        self.assertEqual(refresh_balance(self.casts[0]).point, 7000)
+        self.assertEqual(self.casts[0].expire_times, 1)
+        self.assertEqual(self.casts[0].expire_amount, 30)
+        self.assertEqual(refresh_balance(self.casts[9]).point, 7000)
+        self.assertEqual(self.casts[9].expire_times, 0)
+        self.assertEqual(refresh_balance(self.guest).expire_times, 1)
+        self.assertEqual(get_house_point(), 30000)
+
+        self.assertEqual(Invoice.objects.filter(order=self.order, invoice_type="CALL", taker__isnull=False).count(), 10)
+        self.assertEqual(Invoice.objects.get(order=self.order, invoice_type="ADMIN").take_amount, 30000)
+        for detail in InvoiceDetail.objects.all():
+            self.assertEqual(
+                set(detail.invoices.values_list('invoice_type', 'taker_id')),
+                {("CALL", detail.cast_id), ("CALL", None)})
+
+        self.assertEqual(
+            RankingEntry.objects.filter(period='day', kind='take_call', user=self.casts[0]).get().points, 7000)
+
+    def test_settled_once(self):
+        self.settle()
+        response, _ = self.settle()
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(refresh_balance(self.casts[0]).point, 7000)
+
+    def test_confirmed_casts(self):
+        Join.objects.filter(user=self.casts[9]).update(dropped=True)
+        response, _ = self.settle()
+        self.assertEqual(response.status_code, 400)
+
+        response, _ = self.settle(self.casts[:8])
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(InvoiceDetail.objects.exists())
+
+        response, _ = self.settle(self.casts[:9])
+        self.assertEqual(response.status_code, 200)
+
+    def test_legacy_settled_once(self):
+        line = dict(self.get_line(0, self.casts[0]), order_id=self.order.id)
+        response = self.client.post('/api/calls/detail_invoices', line, format='json')
+        self.assertEqual(response.status_code, 201)
+        response = self.client.post('/api/calls/detail_invoices', line, format='json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(refresh_balance(self.casts[0]).point, 7000)
+
+        response, _ = self.settle()
+        self.assertEqual(response.status_code, 409)
+
+
+class BillingTest(TestCase):
+    """
+    bill_joins computes the base, extension, night and desire points of joins
+    """
+
+    def setUp(self):
+        self.admin = Member.objects.create(
+            username="admin", email="admin@example.com", role=-1, is_superuser=True)
+        self.guest = Member.objects.create(username="guest", email="guest@example.com", role=1)
+        self.casts = [
+            Member.objects.create(username="cast{}".format(index), email="cast{}@example.com".format(index), role=0)
+            for index in range(2)]
+        self.order = Order.objects.create(
+            user=self.guest, period=1, cost_value=5000, cost_extended=6500,
+            night_started_at="00:00", night_ended_at="06:00", night_fund=4000, night_back_ratio=50,
+            desire_cost=2000, desire_back_ratio=50)
+
+        local_zone = pytz.timezone("Asia/Tokyo")
+        Join.objects.create(
+            order=self.order, user=self.casts[0], status=1,
+            started_at=local_zone.localize(datetime(2026, 9, 10, 20, 0)),
+            ended_at=local_zone.localize(datetime(2026, 9, 10, 21, 40)))
+        Join.objects.create(
+            order=self.order, user=self.casts[1], status=1, selection=1,
+            started_at=local_zone.localize(datetime(2026, 9, 10, 23, 30)),
+            ended_at=local_zone.localize(datetime(2026, 9, 11, 0, 30)))
+        Join.objects.create(
+            order=self.order, user=self.casts[1], status=1, dropped=True,
+            started_at=local_zone.localize(datetime(2026, 9, 10, 20, 0)))
+
+    def test_points(self):
+        extended, night = bill_joins(get_billed_joins(order_id=self.order.id))
+
+        self.assertEqual(extended['join_time'], 100)
+        self.assertEqual(extended['extend_min'], 60)
+        self.assertEqual(extended['extend_point'], 13000)
+        self.assertEqual(extended['night_point'], 0)
+        self.assertEqual(extended['total_point'], 23000)
+        self.assertEqual(extended['cast_point'], 17250)
+
+        self.assertEqual(night['night_min'], 30)
+        self.assertEqual(night['extend_point'], 0)
+        self.assertEqual(night['total_point'], 16000)
+        self.assertEqual(night['cast_point'], 10500)
+
+    def test_command_month(self):
+        # the first of october in Asia/Tokyo, still september in UTC
+        now = pytz.timezone("Asia/Tokyo").localize(datetime(2026, 10, 1, 3, 0))
+        output = StringIO()
+        with mock.patch('django.utils.timezone.now', return_value=now):
+            call_command('bill_joins', stdout=output)
+        self.assertIn('0 joins of 2026-10', output.getvalue())
+
+        output = StringIO()
+        call_command('bill_joins', month='2026-09-30', stdout=output)
+        self.assertIn('2 joins of 2026-09', output.getvalue())
+
+    def test_night_over_midnight(self):
+        local_zone = pytz.timezone("Asia/Tokyo")
+        times = [
+            local_zone.localize(datetime(2026, 9, 10, hour)).timestamp()
+            for hour in [21, 23, 4, 6]]
+        times = np.array(times, dtype=np.int64)
+        window_start, window_end = np.full(4, 22 * 3600), np.full(4, 5 * 3600)
+
+        seconds = night_seconds(times, window_start, window_end)
+        self.assertEqual(seconds[1] - seconds[0], 3600)
+        self.assertEqual(seconds[3] - seconds[2], 3600)
+
+    def test_preview_and_audit(self):
+        client = APIClient()
+        client.force_authenticate(self.admin)
+
+        response = client.get('/api/calls/orders/{}/billing'.format(self.order.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['sum']['total_point'], 39000)
+
+        response = client.get('/api/calls/month_billing', {'month': '2026-09-30'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['total'], 2)
+        self.assertEqual(response.data['sum']['cast_point'], 27750)
+
+        response = client.get('/api/calls/month_billing', {'month': '2026-09-30', 'page': 2, 'size': 1})
+        self.assertEqual((response.data['total'], len(response.data['results'])), (2, 1))
+        self.assertEqual(response.data['sum']['cast_point'], 27750)
+
+        # already October in Asia/Tokyo
+        with mock.patch('django.utils.timezone.now', return_value=datetime(2026, 9, 30, 16, tzinfo=pytz.utc)):
+            response = client.get('/api/calls/month_billing')
+        self.assertEqual(response.data['total'], 0)
+
+        rows = bill_joins(get_billed_joins(order_id=self.order.id))
+        settle_order(self.order, [
+            {"cast_id": row['cast_id'], "join_time": row['join_time'], "total_point": row['total_point'],
+             "cast_point": row['cast_point'] - (index * 100)}
+            for index, row in enumerate(rows)])
+
+        differences = audit_rows(rows)
+        self.assertEqual(len(differences), 1)
+        self.assertEqual(differences[0]['cast_id'], self.casts[1].id)
+        self.assertEqual(differences[0]['recorded_cast_point'], 10400)
+
+
+class ExpiredOrderMixin:
+
+    def create_order(self, status, person, call_times):
+        self.guest = Member.objects.create(username="guest", email="guest@example.com", role=1)
+        self.casts = [
+            Member.objects.create(
+                username="cast{}".format(index), email="cast{}@example.com".format(index), role=0, call_times=times)
+            for index, times in enumerate(call_times)]
+        self.order = Order.objects.create(
+            user=self.guest, status=status, person=person, location_other="東京",
+            meet_time_iso=timezone.now() + timedelta(hours=1),
+            collect_ended_at=timezone.now() - timedelta(minutes=1))
+        for cast in self.casts:
+            Join.objects.create(order=self.order, user=cast)
+
+
+@mock.patch('calls.utils.broadcast')
+@mock.patch('calls.utils.broadcast_versions')
+@mock.patch('chat.utils.broadcast_versions')
+@mock.patch('calls.tasks.enqueue')
+class CallControlTest(ExpiredOrderMixin, TestCase):
+    """
+    call_control cancels or matches the expired orders and leaves the socket
+    events to the broadcast queue
+    """
+
+    def setUp(self):
+        Member.objects.create(username="system", email="system@example.com", is_superuser=True)
+
+    def get_enqueued(self, enqueue):
+        return [(call[0][0], call[0][1:], call[1]) for call in enqueue.call_args_list]
+
+    def assert_not_sent(self, *sends):
+        for send in sends:
+            self.assertFalse(send.called)
+
+    def test_cancel(self, enqueue, *sends):
+        self.create_order(0, 3, [0, 0])
+        self.assertEqual(call_control()["cancelled"], 1)
+
+        self.assertEqual(Order.objects.get(pk=self.order.id).status, 8)
+        enqueued = self.get_enqueued(enqueue)
+        self.assertEqual(enqueued[0], (broadcast_call, (self.order.id, "delete"), {}))
+        self.assertEqual(enqueued[1][0], broadcast_super_message)
+        self.assertEqual(sorted(enqueued[1][1][1]), sorted([self.guest.id] + [cast.id for cast in self.casts]))
+        self.assert_not_sent(*sends)
+
+    def test_match(self, enqueue, *sends):
+        self.create_order(1, 2, [5, 1, 3])
+        self.assertEqual(call_control()["matched"], 1)
+
+        # the casts with the fewest calls win
+        winners = [self.casts[1].id, self.casts[2].id]
+        order = Order.objects.get(pk=self.order.id)
+        self.assertEqual(order.status, 3)
+        self.assertEqual(sorted(Join.objects.filter(order=order).values_list('user_id', flat=True)), sorted(winners))
+        self.assertEqual(
+            sorted(order.room.users.values_list('id', flat=True)), sorted([self.guest.id] + winners))
+        self.assertEqual(Message.objects.filter(room=order.room).count(), 1)
+
+        enqueued = self.get_enqueued(enqueue)
+        self.assertIn((broadcast_super_message, ("system", [self.casts[0].id], mock.ANY), {}), enqueued)
+        self.assertIn((broadcast_call, (order.id, "create"), {"receiver_ids": winners}), enqueued)
+        self.assertIn((broadcast_room_created, (order.id, order.room_id, winners), {}), enqueued)
+        self.assertIn((broadcast_applier, (order.id, order.room_id, self.guest.id, True), {}), enqueued)
+        self.assert_not_sent(*sends)
+
+    def test_waiting(self, enqueue, *sends):
+        self.create_order(1, 3, [0, 0])
+        self.assertEqual(call_control()["waiting"], 1)
+        self.assertEqual(Order.objects.get(pk=self.order.id).status, 1)
+        self.assertFalse(enqueue.called)
+
+    def test_handled(self, enqueue, *sends):
+        self.create_order(1, 2, [0, 0])
+        # handled by another worker since the expired ids were read
+        Order.objects.filter(pk=self.order.id).update(status=3)
+        self.assertEqual(control_expired_order(self.order.id), "handled")
+        self.assertFalse(enqueue.called)
+
+
+@mock.patch('calls.tasks.enqueue')
+class CallControlLockTest(ExpiredOrderMixin, TransactionTestCase):
+    """
+    An order locked by another worker is skipped instead of waited for
+    """
+
+    @skipUnlessDBFeature('has_select_for_update_skip_locked')
+    def test_skip_locked(self, enqueue):
+        Member.objects.create(username="system", email="system@example.com", is_superuser=True)
+        self.create_order(1, 2, [0, 0])
+        locked, release = threading.Event(), threading.Event()
+
+        def hold():
+            with transaction.atomic():
+                list(Order.objects.select_for_update().filter(pk=self.order.id))
+                locked.set()
+                release.wait(10)
+            connection.close()
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        locked.wait(10)
+        try:
+            self.assertEqual(control_expired_order(self.order.id), "locked")
+        finally:
+            release.set()
+            thread.join()
+
+        self.assertEqual(control_expired_order(self.order.id), "matched")
+
+
+@mock.patch('chat.utils.broadcast_versions')
+class JoinTimerTest(TestCase):
+    """
+    Started joins get their timers scheduled once per start, and the sweep
+    catches the timers that were lost
+    """
+
+    def setUp(self):
+        Member.objects.create(username="system", email="system@example.com", is_superuser=True)
+        self.cast = Member.objects.create(username="cast", email="cast@example.com", role=0)
+        room = Room.objects.create(title="room", room_type="public", is_group=True)
+        room.users.set([self.cast])
+        self.order = Order.objects.create(status=4, period=2, room=room)
+        self.join = Join.objects.create(
+            order=self.order, user=self.cast, status=1, is_started=True, started_at=timezone.now())
+
+    def schedule(self):
+        with mock.patch('calls.tasks.notify_ten_left.apply_async') as ten_left, \
+                mock.patch('calls.tasks.notify_extended.apply_async') as extended:
+            with self.captureOnCommitCallbacks(execute=True):
+                schedule_join_timers(self.join, self.order.period)
+        self.assertEqual(ten_left.call_args[1]['eta'], self.join.started_at + timedelta(minutes=110))
+        self.assertEqual(extended.call_args[1]['eta'], self.join.started_at + timedelta(hours=2))
+        return ten_left.call_args[1]['task_id'], extended.call_args[1]['task_id']
+
+    def cancel(self):
+        with mock.patch('calls.tasks.current_app.control.revoke') as revoke:
+            with self.captureOnCommitCallbacks(execute=True):
+                cancel_join_timers(self.join.id, self.join.started_at)
+        return [call[0][0] for call in revoke.call_args_list]
+
+    def test_reschedule(self, broadcast_versions):
+        self.assertEqual(self.cancel(), [])
+
+        first = self.schedule()
+        self.assertEqual(self.cancel(), list(first))
+
+        # scheduled again for the same start after an un-end, not under the revoked ids
+        second = self.schedule()
+        self.assertTrue(set(first).isdisjoint(second))
+        self.assertEqual(self.cancel(), list(second))
+
+    def test_sweep(self, broadcast_versions):
+        self.assertEqual(call_notify(), (0, 0))
+
+        Join.objects.filter(pk=self.join.id).update(started_at=timezone.now() - timedelta(minutes=115))
+        self.assertEqual(call_notify(), (1, 0))
+        self.assertTrue(Join.objects.get(pk=self.join.id).is_ten_left)
+        self.assertEqual(Message.objects.filter(room=self.order.room).count(), 1)
+
+        Join.objects.filter(pk=self.join.id).update(started_at=timezone.now() - timedelta(minutes=121))
+        self.assertEqual(call_notify(), (0, 1))
+        self.assertTrue(Join.objects.get(pk=self.join.id).is_extended)
+        self.assertEqual(call_notify(), (0, 0))
+
+
+class StatisticsTest(TestCase):
+    """
+    The dashboard statistics read the rollup of the past days and compute
+    the days without one live
+    """
+
+    def setUp(self):
+        self.guest = Member.objects.create(username="guest", email="guest@example.com", role=1)
+        self.today = timezone.now().date()
+        self.yesterday = self.today - timedelta(days=1)
+        self.old = self.add_invoice(1000, days=2)
+        self.add_invoice(2000, days=1)
+        self.add_invoice(4000, days=0)
+
+    def add_invoice(self, point, days):
+        invoice = Invoice.objects.create(invoice_type="GIFT", give_amount=point, giver=self.guest)
+        Invoice.objects.filter(pk=invoice.id).update(created_at=timezone.now() - timedelta(days=days))
+        return Invoice.objects.get(pk=invoice.id)
+
+    def get_points(self, start_date, end_date):
+        stats = get_daily_statistics(start_date, end_date)
+        return {date: date_stats["GIFT"]["give_sum"] for date, date_stats in stats.items()}
+
+    def test_live_fallback(self):
+        self.assertFalse(DailyStatistic.objects.exists())
+        self.assertEqual(self.get_points(self.today - timedelta(days=2), self.today), {
+            self.today - timedelta(days=2): 1000, self.yesterday: 2000, self.today: 4000})
+        self.assertEqual(get_total_statistics()["GIFT"]["give_sum"], 7000)
+
+        # future days are not computed
+        self.assertEqual(self.get_points(self.today, self.today + timedelta(days=30)), {self.today: 4000})
+        self.assertEqual(get_daily_statistics(self.today + timedelta(days=1), self.today + timedelta(days=30)), {})
+
+    def test_rollup(self):
+        self.assertEqual(rollup_statistics(), 0)
+        self.assertTrue(DailyStatistic.objects.filter(date=self.yesterday, category=ROLLUP_CATEGORY).exists())
+        # stored rows, without counting them twice
+        Invoice.objects.filter(created_at__date=self.yesterday).update(give_amount=0)
+        self.assertEqual(self.get_points(self.yesterday, self.today), {self.yesterday: 2000, self.today: 4000})
+        Invoice.objects.filter(created_at__date=self.yesterday).update(give_amount=2000)
+
+        # a past invoice changed is computed live until rolled up again
+        self.old.give_amount = 1500
+        self.old.save()
+        self.assertEqual(self.get_points(self.old.created_at.date(), self.old.created_at.date()), {
+            self.old.created_at.date(): 1500})
+        self.assertEqual(get_total_statistics()["GIFT"]["give_sum"], 7500)
+        self.assertEqual(rollup_statistics(days=1), 1)
+        self.assertEqual(get_total_statistics()["GIFT"]["give_sum"], 7500)
+
+        self.old.delete()
+        self.assertEqual(get_total_statistics()["GIFT"]["give_sum"], 6000)
+
+    def test_migration(self):
+        rollup_day(self.yesterday)
+        rollup_history = import_module('calls.migrations.0008_rollup_statistics').rollup_history
+        rollup_history(django_apps, None)
+
+        self.assertEqual(
+            DailyStatistic.objects.filter(category=ROLLUP_CATEGORY).count(), 2)
+        self.assertEqual(DailyStatistic.objects.get(date=self.yesterday, category="GIFT").give_sum, 2000)
+        self.assertFalse(DailyStatistic.objects.filter(date=self.today).exists())
+
+        client = APIClient()
+        client.force_authenticate(Member.objects.create(
+            username="admin", email="admin@example.com", is_superuser=True))
+        response = client.get('/api/calls/admin_invoices')
+        self.assertEqual(response.data["use"], 7000)
+
+
+@override_settings(DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage')
+class RankingTest(TestCase):
+    """
+    get_ranking serves the leaderboards kept by the invoices
+    """
+
+    def setUp(self):
+        self.guests = [
+            Member.objects.create(
+                username="guest{}".format(index), email="guest{}@example.com".format(index), role=1,
+                call_times=index)
+            for index in range(4)]
+        for guest, point in zip(self.guests, [3000, 1000, 2000]):
+            Invoice.objects.create(invoice_type="GIFT", give_amount=point, giver=guest)
+        Invoice.objects.create(invoice_type="GIFT", give_amount=500, giver=self.guests[1])
+        Invoice.objects.create(invoice_type="CALL", give_amount=9000, giver=self.guests[1])
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.guests[2])
+
+    def get_ranking(self, **params):
+        response = self.client.get('/api/calls/ranking', dict({'isCast': 'false', 'isGift': 'true'}, **params))
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_ranking(self):
+        for range_index in range(len(PERIODS)):
+            data = self.get_ranking(range=range_index, mine='true')
+            self.assertEqual(
+                [(user['id'], user['overall_points']) for user in data['results']],
+                [(self.guests[0].id, 3000), (self.guests[2].id, 2000), (self.guests[1].id, 1500),
+                 (self.guests[3].id, None)])
+            self.assertEqual(data['mine'], {"rank": 2, "points": 2000})
+
+        data = self.get_ranking(isGift='false', range=0)
+        self.assertEqual(data[0]['id'], self.guests[1].id)
+        self.assertEqual(data[0]['overall_points'], 9000)
+
+    def test_user_rank(self):
+        self.assertEqual(get_user_rank('day', False, True, self.guests[3]), {"rank": 4, "points": 0})
+
+        # hidden users are not ranked nor counted
+        setting = self.guests[0].setting
+        setting.ranking_display = False
+        setting.save()
+        self.assertEqual(get_user_rank('day', False, True, self.guests[0]), {"rank": None, "points": 0})
+        self.assertEqual(get_user_rank('day', False, True, self.guests[2]), {"rank": 1, "points": 2000})
+
+    def test_rebuild(self):
+        bucket = get_bucket('month')
+        self.assertEqual(check_bucket('month', bucket), [])
+
+        RankingEntry.objects.filter(period='month', user=self.guests[0]).update(points=10)
+        self.assertEqual(check_bucket('month', bucket), [('give_gift', self.guests[0].id, 10, 3000)])
+
+        self.assertEqual(rebuild_bucket('month', bucket), 4)
+        self.assertEqual(check_bucket('month', bucket), [])
+        self.assertEqual(self.get_ranking(range=2)[0]['overall_points'], 3000)
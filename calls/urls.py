@@ -50,10 +50,13 @@ urlpatterns = [
         'orders/<int:id>/complete',
         complete_payment,
         name="complete_payment"),
+    path('orders/<int:id>/settle', settle_payment, name="settle_payment"),
+    path('orders/<int:id>/billing', get_order_billing, name="order_billing"),
     path('orders/<int:id>/fail', fail_payment, name="fail_payment"),
     path('orders/counts', get_order_counts, name="admin_order_counts"),
     path('orders/cancel', cancel_order_apply, name="cast_cancel_order"),
     path('month_data', get_month_data, name="admin_month_data"),
+    path('month_billing', get_month_billing, name="admin_month_billing"),
 
     # private call request
     path('orders/request', request_call, name="request_call"),
@@ -1,49 +1,81 @@
 from .serializers import OrderSerializer
+from accounts.models import Member
 import pytz
 from dateutil.parser import parse
-from datetime import timedelta
+from datetime import datetime, timedelta
 
-# use channel
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from chat.broadcast import COMPACT_VERSION, broadcast, broadcast_versions
+from chat.compact import compact_order
 
 
 def send_call(order, receiver_ids, call_event):
-    channel_layer = get_channel_layer()
-    for receiver_id in receiver_ids:
-        async_to_sync(channel_layer.group_send)(
-            "chat_{}".format(receiver_id),
-            {"type": "call.send", "content": OrderSerializer(order).data, "event": call_event}
-        )
+    def build(version, version_ids):
+        if version == COMPACT_VERSION:
+            message = {"type": "call.send", "compact": compact_order(order, call_event), "event": call_event}
+        else:
+            message = {"type": "call.send", "content": OrderSerializer(order).data, "event": call_event}
+        return [(receiver_id, message) for receiver_id in version_ids]
+
+    return broadcast_versions(receiver_ids, build)
 
 
 def send_call_type(mode, receiver_ids):
-    channel_layer = get_channel_layer()
-    for receiver_id in receiver_ids:
-        async_to_sync(channel_layer.group_send)(
-            "chat_{}".format(receiver_id),
-            {"type": "call_type.send", "content": mode}
-        )
+    return broadcast(
+        receiver_ids,
+        {"type": "call_type.send", "content": mode}
+    )
 
 
 def send_room_event(event, room):
-    channel_layer = get_channel_layer()
-    for user in room.users.all():
-        async_to_sync(channel_layer.group_send)(
-            "chat_{}".format(user.id),
-            {"type": "room_event.send", "content": event}
-        )
+    return broadcast(
+        room.users.values_list('id', flat=True),
+        {"type": "room_event.send", "content": event}
+    )
 
 
 def send_applier(order_id, room_id, guest_id, is_exceed=False):
-    channel_layer = get_channel_layer()
-    async_to_sync(
-        channel_layer.group_send)(
-        "chat_{}".format(guest_id), {
+    return broadcast(
+        [guest_id], {
             "type": "applier.send", "content": {
                 "order": order_id, "room": room_id, "exceed": is_exceed}})
 
 
+def get_plan_cast_ids(order):
+    class_ids = list(order.cost_plan.classes.values_list('id', flat=True))
+    return list(
+        Member.objects.filter(
+            role=0,
+            cast_class__id__in=class_ids).values_list(
+            'id', flat=True))
+
+
+def get_location_cast_ids(order):
+    return list(
+        Member.objects.filter(
+            role=0,
+            location=order.parent_location).values_list(
+            'id', flat=True))
+
+
+def get_join_user_ids(order):
+    return list(order.joins.values_list('user_id', flat=True))
+
+
+def get_order_user_ids(order):
+    return [order.user_id] + get_join_user_ids(order)
+
+
+def get_call_type(order):
+    today_date = datetime.now().astimezone(pytz.timezone("Asia/Tokyo")).date()
+    meet_date = order.meet_time_iso.astimezone(
+        pytz.timezone("Asia/Tokyo")).date()
+    if meet_date == today_date:
+        return "today"
+    if meet_date > today_date:
+        return "tomorrow"
+    return None
+
+
 def get_edge_time(cur_date_str, cur_type):
     if cur_type == "from":
         cur_date = parse(cur_date_str)
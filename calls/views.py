@@ -1,11 +1,12 @@
 from django.core.validators import MinLengthValidator
-from accounts.serializers.member import UserSerializer
+from accounts.serializers.member import UserSerializer, MainInfoSerializer
+from accounts.cards import get_cards
 from inspect import formatargvalues
 import json
 import pytz
 from datetime import datetime, timedelta
 
-from django.db.models import Sum, Q, Count, F
+from django.db.models import Sum, Q, Count, F, Prefetch, prefetch_related_objects
 from django.core.paginator import Paginator, EmptyPage
 from django.utils import timezone
 from dateutil.parser import parse
@@ -20,9 +21,15 @@ from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 
 from .serializers import *
-from .utils import get_edge_time, send_call, send_applier, send_call_type, send_room_event
-from chat.utils import create_room, send_notice_to_room, send_super_message, send_room_to_users, send_message_to_user
-from chat.models import Room, Message
+from .utils import get_edge_time, send_call, send_applier, send_room_event, get_plan_cast_ids
+from chat.utils import create_room, send_notice_to_room, send_super_message, send_room_to_users, create_message
+from chat.tasks import enqueue, broadcast_call, broadcast_room_event, broadcast_super_message
+from .tasks import schedule_join_timers, cancel_join_timers
+from .statistics import get_daily_statistics, get_total_statistics, ORDER_CATEGORY
+from .ranking import PERIODS, get_top_users, get_user_rank
+from .settlement import AlreadySettled, SettlementError, settle_order
+from .billing import bill_joins, compute_bills, get_billed_joins, get_local_date, get_month_range, sum_points, sum_rows, to_rows
+from chat.models import Room
 from chat.serializers import MessageSerializer
 
 # Create your views here.
@@ -155,33 +162,26 @@ class DetailInvoiceView(mixins.CreateModelMixin, generics.GenericAPIView):
     serializer_class = InvoiceDetailSerializer
 
     def post(self, request, *args, **kwargs):
-        return self.create(request, *args, **kwargs)
+        try:
+            return self.create(request, *args, **kwargs)
+        except AlreadySettled as e:
+            return Response({"detail": str(e)}, status=status.HTTP_409_CONFLICT)
 
 
 @api_view(['GET'])
 @permission_classes([IsSuperuserPermission])
 def get_invoice_total(request):
-    buy_point = Invoice.objects.exclude(invoice_type="ADMIN").filter(
-        Q(invoice_type='BUY') | Q(invoice_type='CHARGE') | Q(invoice_type='AURO CHARGE')
-    ).aggregate(Sum('take_amount'))['take_amount__sum']
-    normal_invoices = Invoice.objects.exclude(
-        invoice_type='ADMIN').exclude(
-        invoice_type='CHARGE').exclude(
-            invoice_type='BUY').exclude(
-                invoice_type='AUTO')
-    use_point = normal_invoices.aggregate(
-        Sum('give_amount'))['give_amount__sum']
-    pay_point = normal_invoices.aggregate(
-        Sum('take_amount'))['take_amount__sum']
-
-    if buy_point is None:
-        buy_point = 0
-
-    if use_point is None:
-        use_point = 0
-
-    if pay_point is None:
-        pay_point = 0
+    totals = get_total_statistics()
+
+    buy_point = 0
+    use_point = 0
+    pay_point = 0
+    for category, stats in totals.items():
+        if category in ['BUY', 'CHARGE', 'AURO CHARGE']:
+            buy_point += stats["take_sum"]
+        if category not in ['ADMIN', 'CHARGE', 'BUY', 'AUTO', ORDER_CATEGORY]:
+            use_point += stats["give_sum"]
+            pay_point += stats["take_sum"]
 
     profit_point = use_point - pay_point
 
@@ -259,95 +259,40 @@ def get_rank_users(request):
             'overall_points',
             flat=True).distinct())
 
+    # all metrics of the page in one query
+    metrics = get_rank_metrics(
+        [user.id for user in rank_users],
+        user_type == "guest",
+        get_edge_time(date_from, "from") if date_from != "" else None,
+        get_edge_time(date_to, "to") if date_to != "" else None)
+
     return Response({"total": total, "results": RankUserSerializer(
-        rank_users, many=True, context={
-            'from': parse(date_from).strftime("%Y-%m-%d") if date_from != "" else "",
-            'to': parse(date_to).strftime("%Y-%m-%d") if date_to != "" else ""}
+        rank_users, many=True, context={'metrics': metrics}
     ).data, "values": points_values}, status=status.HTTP_200_OK)
 
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_ranking(request):
-    from dateutil.relativedelta import relativedelta
-
     user_type = request.GET.get('isCast', 'false')
     is_gift = request.GET.get('isGift', 'false')
     range = int(request.GET.get('range', '3'))
 
-    # user type
-    query_set = Member.objects.filter(setting__ranking_display=True)
-    if user_type == "false":
-        query_set = query_set.filter(role=1, is_active=True)
-    else:
-        query_set = query_set.filter(role=0, is_active=True)
-        if is_gift == "false":
-            query_set = query_set.filter(is_present=True)
+    # day, week, month or year
+    period = PERIODS[range] if 0 <= range < len(PERIODS) else 'year'
+    is_cast = user_type != "false"
+    is_gift = is_gift == "true"
 
-    # query
-    time_filter = Q()
+    top_users = get_top_users(period, is_cast, is_gift)
+    results = get_cards("main", top_users)
 
-    start_time = None
-    end_time = None
-    today = datetime.now().astimezone(pytz.timezone("Asia/Tokyo"))
-
-    if range == 0:
-        start_time = today.replace(hour=0, minute=0, second=0, microsecond=0)
-        end_time = start_time + timedelta(days=1)
-    elif range == 1:
-        week_day = (today.weekday() + 1) % 7
-        start_time = today.replace(hour=0, minute=0, second=0, microsecond=0)
-        start_time = start_time - timedelta(days=week_day)
-        end_time = start_time + timedelta(days=7)
-    elif range == 2:
-        start_time = today.replace(
-            day=1, hour=0, minute=0, second=0, microsecond=0)
-        end_time = start_time + relativedelta(months=1)
-    else:
-        start_time = today.replace(
-            month=1,
-            day=1,
-            hour=0,
-            minute=0,
-            second=0,
-            microsecond=0)
-        end_time = start_time + relativedelta(years=1)
-
-    start_time.astimezone(pytz.timezone("UTC"))
-    end_time.astimezone(pytz.timezone("UTC"))
-
-    if user_type == "false":
-        time_filter = Q(
-            gave__created_at__gte=start_time) & Q(
-            gave__created_at__lt=end_time)
-
-        if is_gift == "true":
-            time_filter &= Q(gave__invoice_type="GIFT")
-            query_set = query_set.annotate(
-                overall_points=Sum('gave__give_amount', filter=time_filter)
-            ).order_by('-overall_points', '-call_times')
-        else:
-            time_filter &= Q(gave__invoice_type="CALL")
-            query_set = query_set.annotate(
-                overall_points=Sum('gave__give_amount', filter=time_filter)
-            ).order_by('-overall_points', '-call_times')
-    else:
-        time_filter = Q(
-            took__created_at__gte=start_time) & Q(
-            took__created_at__lt=end_time)
-
-        if is_gift == "true":
-            time_filter &= Q(took__invoice_type="GIFT")
-            query_set = query_set.annotate(
-                overall_points=Sum('took__take_amount', filter=time_filter)
-            ).order_by('-overall_points', '-call_times')
-        else:
-            time_filter &= Q(took__invoice_type="CALL")
-            query_set = query_set.annotate(
-                overall_points=Sum('took__take_amount', filter=time_filter)
-            ).order_by('-overall_points', '-call_times')
+    if request.GET.get('mine', 'false') == 'true':
+        return Response({
+            "results": results,
+            "mine": get_user_rank(period, is_cast, is_gift, request.user)
+        })
 
-    return Response(MainInfoSerializer(query_set[:10], many=True).data)
+    return Response(results)
 
 
 @api_view(['POST'])
@@ -379,44 +324,19 @@ def create_order(request):
         if notify_cast > 0:
             cast_ids = []
             if notify_cast == 1:
-                cast_class_ids = list(
-                    order.cost_plan.classes.values_list(
-                        'id', flat=True))
-                cast_ids = list(
-                    Member.objects.filter(
-                        role=0,
-                        cast_class__id__in=cast_class_ids).values_list(
-                        'id',
-                        flat=True))
+                cast_ids = get_plan_cast_ids(order)
             else:
                 cast_ids = list(
                     Member.objects.filter(
                         role=0, is_present=True).values_list(
                         'id', flat=True))
-            for cast_id in cast_ids:
-                send_super_message("system", cast_id, message_content)
+            enqueue(broadcast_super_message, "system", cast_ids, message_content)
 
         if notify_guest > 0:
-            send_super_message("system", order.user_id, message_content)
+            enqueue(broadcast_super_message, "system", [order.user_id], message_content)
 
-        today_date = datetime.now().astimezone(pytz.timezone("Asia/Tokyo")).date()
-        meet_date = order.meet_time_iso.astimezone(
-            pytz.timezone("Asia/Tokyo")).date()
-
-        # send order create
-        cast_ids = list(
-            Member.objects.filter(
-                role=0,
-                location=order.parent_location).values_list(
-                'id',
-                flat=True))
-        send_call(order, cast_ids, "create")
-
-        # call type send
-        if meet_date == today_date:
-            send_call_type("today", cast_ids)
-        if meet_date > today_date:
-            send_call_type("tomorrow", cast_ids)
+        # send order create and call type
+        enqueue(broadcast_call, order.id, "create", audience="location", with_type=True)
 
         return Response(OrderSerializer(order).data, status=status.HTTP_200_OK)
     else:
@@ -511,30 +431,10 @@ class OrderView(generics.GenericAPIView):
                 時間 : {1} ~ {2} \n \
                 人数 : {3}人".format(location_str, start_time_str, end_time_str, new_order.person)
 
-            today_date = datetime.now().astimezone(pytz.timezone("Asia/Tokyo")).date()
-            meet_date = new_order.meet_time_iso.astimezone(
-                pytz.timezone("Asia/Tokyo")).date()
-
-            # call send
-            class_ids = list(
-                new_order.cost_plan.classes.values_list(
-                    'id', flat=True))
-            cast_ids = list(
-                Member.objects.filter(
-                    role=0,
-                    cast_class__id__in=class_ids).values_list(
-                    'id',
-                    flat=True))
-            # cast_ids = list(Member.objects.filter(location = new_order.parent_location).values_list('id', flat = True).distinct())
-            send_call(new_order, cast_ids, "create")
-
-            # call type send
-            if meet_date == today_date:
-                send_call_type("today", cast_ids)
-            if meet_date > today_date:
-                send_call_type("tomorrow", cast_ids)
+            # call send and call type send
+            enqueue(broadcast_call, new_order.id, "create", with_type=True)
 
-            send_super_message("system", request.user.id, message_content)
+            enqueue(broadcast_super_message, "system", [request.user.id], message_content)
             return Response(
                 OrderSerializer(new_order).data,
                 status=status.HTTP_200_OK)
@@ -575,6 +475,7 @@ class OrderDetailView(
                         ongoingJoin.is_ended = True
                         ongoingJoin.ended_at = timezone.now()
                         ongoingJoin.save()
+                        cancel_join_timers(ongoingJoin.id, ongoingJoin.started_at)
 
                         message = "{}の合流は終了されました。".format(
                             ongoingJoin.user.nickname)
@@ -582,24 +483,16 @@ class OrderDetailView(
 
                     if new_order.room is not None:
                         # send room event
-                        send_room_event("update", new_order.room)
+                        enqueue(broadcast_room_event, "update", new_order.room_id)
 
                 if new_order.status == 8:
                     message = "管理画面よりオーダーがキャスト不足でキャンセルされました。"
 
                     # remove the order from application list of cast page
-                    class_ids = list(
-                        new_order.cost_plan.classes.values_list(
-                            'id', flat=True))
-                    cast_ids = list(
-                        Member.objects.filter(
-                            role=0, cast_class__id__in=class_ids).values_list(
-                            'id', flat=True))
-                    # user_ids = list(Member.objects.filter(location = new_order.parent_location, role = 0).values_list('id', flat = True))
-                    send_call(new_order, cast_ids, "delete")
+                    enqueue(broadcast_call, new_order.id, "delete")
 
                     # send super message to guest
-                    send_super_message("system", new_order.user.id, message)
+                    enqueue(broadcast_super_message, "system", [new_order.user_id], message)
 
                     if new_order.room is not None:
                         new_order.room.status = "end"
@@ -628,6 +521,7 @@ def cancel_order(request, id):
             ongoingJoin.is_ended = True
             ongoingJoin.ended_at = timezone.now()
             ongoingJoin.save()
+            cancel_join_timers(ongoingJoin.id, ongoingJoin.started_at)
 
         # update room and send event
         message = "管理画面よりオーダーがキャンセルされました。\n お問い合わせは運営局へご連絡ください。"
@@ -641,25 +535,12 @@ def cancel_order(request, id):
             send_notice_to_room(cur_order.room, message, False)
 
             # send room event
-            send_room_event("ended", cur_order.room)
+            enqueue(broadcast_room_event, "ended", cur_order.room_id)
         else:
-            send_super_message("system", cur_order.user.id, message)
-
-        class_ids = list(
-            cur_order.cost_plan.classes.values_list(
-                'id', flat=True))
-        cast_ids = list(
-            Member.objects.filter(
-                role=0,
-                cast_class__id__in=class_ids).values_list(
-                'id',
-                flat=True))
-        # print("Cast ids")
-        # print(cast_ids)
-        send_call(cur_order, cast_ids, "delete")
+            enqueue(broadcast_super_message, "system", [cur_order.user_id], message)
 
-        join_ids = list(cur_order.joins.values_list('user_id', flat=True))
-        send_call(cur_order, join_ids, "mine")
+        enqueue(broadcast_call, cur_order.id, "delete")
+        enqueue(broadcast_call, cur_order.id, "mine", audience="joins")
 
         return Response(
             OrderSerializer(cur_order).data,
@@ -765,9 +646,19 @@ def daterange(start_date, end_date):
 @permission_classes([IsSuperuserPermission])
 def get_month_data(request):
     end_date = timezone.now().date()
-    start_date = datetime.strptime(
-        end_date.strftime("%Y-%m-01"),
-        "%Y-%m-%d").date()
+    start_date = end_date.replace(day=1)
+    try:
+        if request.GET.get('from', '') != '':
+            start_date = parse(request.GET.get('from')).date()
+        if request.GET.get('to', '') != '':
+            end_date = parse(request.GET.get('to')).date()
+    except (ValueError, OverflowError):
+        return Response(status=status.HTTP_400_BAD_REQUEST)
+
+    location_id = int(request.GET.get('location_id', '0'))
+    daily_stats = get_daily_statistics(
+        start_date, end_date, location_id if location_id > 0 else None)
+
     result_data = []
     weekday_str = ["月", "火", "水", "木", "金", "土", "日"]
     sum_data = {
@@ -779,37 +670,27 @@ def get_month_data(request):
         "buy_points": 0
     }
 
-    for single_date in daterange(start_date, end_date):
-        temp_data = {}
-
-        # get invoice data of current date
-        temp_data["date_str"] = "{0}({1})".format(
-            single_date.strftime("%Y-%m-%d"), weekday_str[single_date.weekday()])
-        temp_data["order_counts"] = Order.objects.filter(
-            created_at__date=single_date).count()
-        sum_data["order_counts"] += temp_data["order_counts"]
-
-        temp_data["order_points"] = Invoice.objects.filter(
-            created_at__date=single_date, invoice_type="CALL"
-        ).aggregate(Sum('give_amount'))['give_amount__sum']
-        if temp_data["order_points"] is not None:
-            sum_data["order_points"] += temp_data["order_points"]
-
-        temp_data['gift_counts'] = Invoice.objects.filter(
-            created_at__date=single_date, invoice_type="GIFT").count()
-        sum_data['gift_counts'] += temp_data['gift_counts']
-
-        temp_data['gift_points'] = Invoice.objects.filter(
-            created_at__date=single_date, invoice_type="GIFT"
-        ).aggregate(Sum('give_amount'))['give_amount__sum']
-        if temp_data['gift_points'] is not None:
-            sum_data['gift_points'] += temp_data['gift_points']
-
-        temp_data['buy_points'] = Invoice.objects.filter(
-            created_at__date=single_date, invoice_type="BUY"
-        ).aggregate(Sum('take_amount'))['take_amount__sum']
-        if temp_data['buy_points'] is not None:
-            sum_data['buy_points'] += temp_data['buy_points']
+    empty_stats = {"count": 0, "give_sum": None, "take_sum": None}
+    for single_date in daterange(start_date, end_date + timedelta(days=1)):
+        date_stats = daily_stats.get(single_date, {})
+        order_stats = date_stats.get(ORDER_CATEGORY, empty_stats)
+        call_stats = date_stats.get("CALL", empty_stats)
+        gift_stats = date_stats.get("GIFT", empty_stats)
+        buy_stats = date_stats.get("BUY", empty_stats)
+
+        temp_data = {
+            "date_str": "{0}({1})".format(
+                single_date.strftime("%Y-%m-%d"), weekday_str[single_date.weekday()]),
+            "order_counts": order_stats["count"],
+            "order_points": call_stats["give_sum"],
+            "gift_counts": gift_stats["count"],
+            "gift_points": gift_stats["give_sum"],
+            "buy_points": buy_stats["take_sum"]
+        }
+
+        for key in ["order_counts", "order_points", "gift_counts", "gift_points", "buy_points"]:
+            if temp_data[key] is not None:
+                sum_data[key] += temp_data[key]
 
         result_data.append(temp_data)
 
@@ -843,6 +724,8 @@ class JoinView(mixins.CreateModelMixin, generics.GenericAPIView):
                     new_obj.is_started = True
                     new_obj.save()
                     send_notice_to_room(cur_room, message)
+                if ex_started_at is not None and new_obj.started_at != ex_started_at:
+                    cancel_join_timers(new_obj.id, ex_started_at)
                 if ex_started_at is not None and new_obj.started_at is None:
                     message = "{0}の合流は管理者によりキャンセルされました。".format(
                         new_obj.user.nickname)
@@ -854,6 +737,7 @@ class JoinView(mixins.CreateModelMixin, generics.GenericAPIView):
                     new_obj.is_ended = True
                     new_obj.save()
                     send_notice_to_room(cur_room, message)
+                    cancel_join_timers(new_obj.id, new_obj.started_at)
                 if ex_ended_at is not None and new_obj.ended_at is None:
                     message = "{0}の解散は管理者によりキャンセルされました。".format(
                         new_obj.user.nickname)
@@ -892,6 +776,11 @@ class JoinView(mixins.CreateModelMixin, generics.GenericAPIView):
                             cur_order.status = 4
                     cur_order.save()
 
+                # ten minutes left and extension timers
+                if new_obj.is_started and not new_obj.is_ended and new_obj.started_at is not None and (
+                        new_obj.started_at != ex_started_at or ex_ended):
+                    schedule_join_timers(new_obj, cur_order.period)
+
                 send_room_event("update", cur_room)
             return Response(JoinSerializer(new_obj).data)
         else:
@@ -1440,6 +1329,7 @@ def start_joins(request, id):
                 cur_join.is_started = True
                 cur_join.started_at = timezone.now()
                 cur_join.save()
+                schedule_join_timers(cur_join, cur_order.period)
 
                 # cast update call times
                 cur_join.user.call_times += 1
@@ -1486,6 +1376,7 @@ def end_joins(request, id):
                 cur_join.is_ended = True
                 cur_join.ended_at = timezone.now()
                 cur_join.save()
+                cancel_join_timers(cur_join.id, cur_join.started_at)
 
                 # send system message
                 message = "{0}は解散しました。".format(request.user.nickname)
@@ -1577,13 +1468,6 @@ def request_call(request):
                 order.location.name, period_start_str, period_end_str, order.id, order.room.id
             )
 
-        self_message = Message.objects.create(
-            content=message,
-            room=order.room,
-            sender=request.user,
-            receiver=request.user,
-            is_read=True)
-
         order.room.last_message = message
         order.room.save()
 
@@ -1599,16 +1483,8 @@ def request_call(request):
 
         order.save()
 
-        target_message = Message.objects.create(
-            content=message,
-            room=order.room,
-            sender=request.user,
-            receiver=Member.objects.get(
-                pk=partner.id),
-            is_read=False,
-            follower=self_message)
-
-        send_message_to_user(target_message, partner.id)
+        self_message = create_message(
+            order.room, request.user, [partner], message)
 
         return Response(MessageSerializer(self_message).data)
     else:
@@ -1807,6 +1683,73 @@ def complete_payment(request, id):
         return Response(status=status.HTTP_400_BAD_REQUEST)
 
 
+@api_view(["POST"])
+@permission_classes([IsAdminPermission])
+def settle_payment(request, id):
+    """
+    Settle the order with the lines of all its casts at once, in place of a
+    detail_invoices post per cast.
+    """
+    try:
+        order = Order.objects.select_related('user', 'target').get(pk=id)
+    except Order.DoesNotExist:
+        return Response(status=status.HTTP_400_BAD_REQUEST)
+
+    serializer = SettleOrderSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        details = settle_order(order, serializer.validated_data['lines'])
+    except AlreadySettled as e:
+        return Response({"detail": str(e)}, status=status.HTTP_409_CONFLICT)
+    except SettlementError as e:
+        return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    enqueue(broadcast_call, order.id, "settle", audience="order")
+    return Response(
+        InvoiceDetailSerializer(details, many=True).data,
+        status=status.HTTP_200_OK)
+
+
+@api_view(["GET"])
+@permission_classes([IsAdminPermission])
+def get_order_billing(request, id):
+    """
+    Points of the joins of the order computed from their times, to review
+    before settling it.
+    """
+    if not Order.objects.filter(pk=id).exists():
+        return Response(status=status.HTTP_400_BAD_REQUEST)
+
+    rows = bill_joins(get_billed_joins(order_id=id))
+    return Response({"sum": sum_rows(rows), "results": rows}, status=status.HTTP_200_OK)
+
+
+@api_view(["GET"])
+@permission_classes([IsSuperuserPermission])
+def get_month_billing(request):
+    """
+    Points of the joins started in a month, for re-billing and audits.
+    """
+    page = int(request.GET.get('page', "1"))
+    size = int(request.GET.get('size', "100"))
+    month = get_local_date()
+    try:
+        if request.GET.get('month', '') != '':
+            month = parse(request.GET.get('month')).date()
+    except (ValueError, OverflowError):
+        return Response(status=status.HTTP_400_BAD_REQUEST)
+
+    started_from, started_to = get_month_range(month)
+    # rows are built for the page only, the sums come from the arrays
+    columns, points = compute_bills(get_billed_joins(started_from=started_from, started_to=started_to))
+    return Response({
+        "total": len(columns['id']),
+        "sum": sum_points(points),
+        "results": to_rows(columns, points, (page - 1) * size, page * size)}, status=status.HTTP_200_OK)
+
+
 @api_view(["GET"])
 @permission_classes([IsAdminPermission])
 def fail_payment(request, id):
@@ -1855,30 +1798,34 @@ def get_schedule_data(request):
             memberQuery = memberQuery.filter(is_present=True)
 
         total = memberQuery.count()
-        users = memberQuery.all()[(page - 1) * size:page * size]
+        users = list(memberQuery.all()[(page - 1) * size:page * size])
 
         if start_time is None:
             start_time = timezone.now()
 
+        join_query = Join.objects.all()
+
+        if type_val == "confirm":
+            join_query = join_query.filter(status=1)
+        elif type_val == "select":
+            join_query = join_query.filter(selection=1)
+        elif type_val == "applying":
+            join_query = join_query.filter(status=0, selection=0)
+
+        # the joins of the whole page in one query, their cards cached at once
+        prefetch_related_objects(users, Prefetch(
+            'joins',
+            queryset=join_query.filter(
+                ended_at__gt=start_time,
+                started_at__lt=end_time).order_by("started_at"),
+            to_attr='schedule_joins'))
+        get_cards("general", users)
+
         return_array = []
-        for user in users:
+        for user, card in zip(users, get_cards("main", users)):
             cur_obj = {}
-            cur_obj["user"] = MainInfoSerializer(user).data
-            cur_obj["schedules"] = []
-
-            join_query = user.joins
-
-            if type_val == "confirm":
-                join_query = join_query.filter(status=1)
-            elif type_val == "select":
-                join_query = join_query.filter(selection=1)
-            elif type_val == "applying":
-                join_query = join_query.filter(status=0, selection=0)
-
-            for join in join_query.filter(
-                    ended_at__gt=start_time,
-                    started_at__lt=end_time).order_by("started_at"):
-                cur_obj["schedules"].append(JoinSerializer(join).data)
+            cur_obj["user"] = card
+            cur_obj["schedules"] = JoinSerializer(user.schedule_joins, many=True).data
 
             return_array.append(cur_obj)
 
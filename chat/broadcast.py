@@ -0,0 +1,113 @@
+"""
+Batched websocket broadcast for Chat
+"""
+import asyncio
+import logging
+import time
+
+from django.conf import settings
+
+# use channel
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
+
+from .presence import VERSIONS as WIRE_VERSIONS, get_presence
+
+logger = logging.getLogger(__name__)
+
+# wire formats of the connections, see chat.compact
+VERBOSE_VERSION = 1
+COMPACT_VERSION = 2
+
+
+def get_group_name(user_id, version=None):
+    """
+    Group of every connection of the user, or of its connections of one wire
+    format for the events that have several.
+    """
+    if version is None:
+        return "chat_{}".format(user_id)
+    return "chat_{0}_v{1}".format(user_id, version)
+
+
+def broadcast(receiver_ids, message, batch_size=None):
+    """
+    Send one already serialized message to the chat group of every receiver.
+
+    The sends are pipelined in batches inside a single event loop instead of
+    one blocking round-trip per receiver. Returns the timing of every batch.
+    """
+    # keep the first occurrence of every receiver
+    receiver_ids = list(dict.fromkeys(receiver_ids))
+    return broadcast_each(
+        [(receiver_id, message) for receiver_id in receiver_ids], batch_size)
+
+
+def broadcast_each(items, batch_size=None):
+    """
+    Same as broadcast, but every item is a (receiver_id, message) pair so
+    each receiver can get its own payload.
+    """
+    return send_groups(
+        [(get_group_name(receiver_id), message) for receiver_id, message in items], batch_size)
+
+
+def broadcast_versions(receiver_ids, build, batch_size=None):
+    """
+    Send an event in the wire format the connections of every receiver asked
+    for. build(version, receiver_ids) returns the (receiver_id, message)
+    items of one format; it is only called for the formats some receiver is
+    connected with, so no payload is serialized for nobody. A receiver with
+    no presence state yet gets the verbose format only, which is what a
+    connection without the version parameter joins.
+    """
+    receiver_ids = list(dict.fromkeys(receiver_ids))
+    versions = get_presence().get_versions(receiver_ids)
+
+    items = []
+    for version in WIRE_VERSIONS:
+        version_ids = [
+            receiver_id for receiver_id in receiver_ids
+            if version in versions.get(receiver_id, {VERBOSE_VERSION})]
+        if len(version_ids) > 0:
+            items += [
+                (get_group_name(receiver_id, version), message)
+                for receiver_id, message in build(version, version_ids)]
+    return send_groups(items, batch_size)
+
+
+def send_groups(items, batch_size=None):
+    items = list(items)
+    if len(items) == 0:
+        return []
+
+    if batch_size is None:
+        batch_size = getattr(settings, 'BROADCAST_BATCH_SIZE', 500)
+
+    channel_layer = get_channel_layer()
+    return async_to_sync(_broadcast)(channel_layer, items, batch_size)
+
+
+async def _broadcast(channel_layer, items, batch_size):
+    timings = []
+    for start_index in range(0, len(items), batch_size):
+        batch_items = items[start_index:start_index + batch_size]
+        message_type = batch_items[0][1].get("type")
+        started_at = time.perf_counter()
+        await asyncio.gather(*[
+            channel_layer.group_send(group_name, message)
+            for group_name, message in batch_items
+        ])
+        elapsed = (time.perf_counter() - started_at) * 1000
+        timings.append({
+            "type": message_type,
+            "receivers": len(batch_items),
+            "elapsed_ms": round(elapsed, 2)
+        })
+        logger.debug(
+            "broadcast %s batch %d: %d receivers in %.2f ms",
+            message_type,
+            start_index // batch_size,
+            len(batch_items),
+            elapsed)
+    return timings
@@ -0,0 +1,162 @@
+"""
+Compact websocket wire format
+
+Version 2 events carry ids instead of nested objects. The users they refer
+to are listed beside the data, and the consumer sends each of them only once
+per connection, so clients keep them by id.
+"""
+from django.db.models import prefetch_related_objects
+from rest_framework import serializers
+
+from accounts.serializers.auth import MediaImageSerializer
+from accounts.cards import get_cards
+from calls.models import Join, Order
+from .models import Message, Room
+from .serializers import get_room_prefetches
+
+
+class CompactMessageSerializer(serializers.ModelSerializer):
+    medias = MediaImageSerializer(read_only=True, many=True)
+
+    class Meta:
+        model = Message
+        fields = (
+            'id',
+            'content',
+            'medias',
+            'gift',
+            'room',
+            'sender',
+            'is_like',
+            'created_at'
+        )
+
+
+class CompactRoomSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Room
+        fields = (
+            'id',
+            'is_group',
+            'last_message',
+            'users',
+            'last_sender',
+            'room_type',
+            'title',
+            'status',
+            'created_at',
+            'updated_at'
+        )
+
+
+class CompactJoinSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Join
+        fields = (
+            'id',
+            'user',
+            'started_at',
+            'is_extended',
+            'is_started',
+            'is_ended',
+            'ended_at',
+            'status',
+            'selection',
+            'dropped'
+        )
+
+
+class CompactOrderSerializer(serializers.ModelSerializer):
+    """
+    Ids and the state that changes over the life of an order, the rest is
+    fetched once by the client with the order itself.
+    """
+    joins = CompactJoinSerializer(read_only=True, many=True)
+    applying = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Order
+        fields = (
+            'id',
+            'status',
+            'user',
+            'target',
+            'room',
+            'parent_location',
+            'location',
+            'meet_time_iso',
+            'person',
+            'period',
+            'is_private',
+            'collect_ended_at',
+            'ended_predict',
+            'ended_at',
+            'joins',
+            'applying',
+            'updated_at'
+        )
+
+    def get_applying(self, obj):
+        return len(obj.joins.all())
+
+
+def get_user_cards(users):
+    unique_users = {}
+    for user in users:
+        if user is not None:
+            unique_users.setdefault(user.id, user)
+    return get_cards("main", unique_users.values())
+
+
+def compact_message(message):
+    return {
+        "data": CompactMessageSerializer(message).data,
+        "users": get_user_cards([message.sender])
+    }
+
+
+def compact_receipt(compact, receipt):
+    """
+    Message event of one receiver, from the shared compact message.
+    """
+    return {
+        "data": dict(
+            compact["data"],
+            receiver=receipt.user_id,
+            is_read=receipt.is_read,
+            is_notice=receipt.is_notice),
+        "users": compact["users"] + get_user_cards([receipt.user])
+    }
+
+
+def compact_room(room):
+    prefetch_related_objects([room], *get_room_prefetches())
+    return {
+        "data": CompactRoomSerializer(room).data,
+        "users": get_user_cards(list(room.users.all()) + [room.last_sender])
+    }
+
+
+def compact_order(order, event=None):
+    # a removed order is only its id to the client
+    if event == "delete":
+        return {"data": {"id": order.id}, "users": []}
+
+    prefetch_related_objects([order], 'joins__user__avatars', 'joins__user__location')
+    return {
+        "data": CompactOrderSerializer(order).data,
+        "users": get_user_cards(
+            [order.user, order.target] + [join.user for join in order.joins.all()])
+    }
+
+
+def pick_new_users(known_users, users):
+    """
+    Users of an event the connection has not sent yet, or that changed since.
+    """
+    new_users = []
+    for user in users:
+        if known_users.get(user['id']) != user['updated_at']:
+            known_users[user['id']] = user['updated_at']
+            new_users.append(user)
+    return new_users
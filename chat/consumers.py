@@ -1,35 +1,47 @@
 import json
+from urllib.parse import parse_qs
 from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
-from accounts.models import Member
 from django.utils import timezone
+from .broadcast import COMPACT_VERSION, VERBOSE_VERSION, get_group_name
+from .compact import pick_new_users
+from .presence import get_presence
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.room_name = self.scope['url_route']['kwargs']['room_name']
-        self.room_group_name = 'chat_%s' % self.room_name
+        self.room_group_name = get_group_name(self.room_name)
 
-        # Join room group
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+        # wire format, ws/chat/<user_id>/?v=2 asks for the compact one
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        self.version = COMPACT_VERSION if query.get(
+            'v', [''])[0] == str(COMPACT_VERSION) else VERBOSE_VERSION
+        self.version_group_name = get_group_name(self.room_name, self.version)
+        self.known_users = {}
 
-        # status save
-        await on_status(int(self.room_name))
+        # status save, with the format the broadcasts have to build for us
+        await on_status(int(self.room_name), self.version)
+
+        # Join room group, and the group of our format
+        for group_name in (self.room_group_name, self.version_group_name):
+            await self.channel_layer.group_add(
+                group_name,
+                self.channel_name
+            )
 
         await self.accept()
 
     async def disconnect(self, close_code):
         # Leave room group
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
+        for group_name in (self.room_group_name, self.version_group_name):
+            await self.channel_layer.group_discard(
+                group_name,
+                self.channel_name
+            )
 
         # status save
-        await off_status(int(self.room_name))
+        await off_status(int(self.room_name), self.version)
 
     # Receive message from WebSocket
     async def receive(self, text_data):
@@ -56,8 +68,25 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'channel': self.channel_name
         }))
 
+    # Send compact event, with the users this connection has not got yet
+    async def send_compact(self, message_type, message, **extra):
+        compact = message['compact']
+        await self.send(text_data=json.dumps(dict(
+            extra,
+            v=COMPACT_VERSION,
+            type=message_type,
+            data=compact['data'],
+            users=pick_new_users(self.known_users, compact['users']))))
+
+    def is_compact(self, event):
+        return 'compact' in event
+
     # Send Room
     async def room_send(self, event):
+        if self.is_compact(event):
+            await self.send_compact("ROOM", event, event=event['event'])
+            return
+
         await self.send(text_data=json.dumps({
             "type": "ROOM",
             "event": event['event'],
@@ -66,6 +95,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     # Send Call
     async def call_send(self, event):
+        if self.is_compact(event):
+            await self.send_compact("CALL", event, event=event['event'])
+            return
+
         await self.send(text_data=json.dumps({
             "type": "CALL",
             "event": event['event'],
@@ -109,6 +142,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     # Send Message
     async def message_send(self, event):
+        if self.is_compact(event):
+            await self.send_compact("MESSAGE", event)
+            return
+
         content = event['content']
 
         # Send message to WebSocket
@@ -120,24 +157,11 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
 # user status on
 @sync_to_async
-def on_status(user_id):
-    # status save
-    try:
-        member = Member.objects.get(pk=user_id)
-        member.status = True
-        member.save()
-    except Member.DoesNotExist:
-        pass
-
-# user status off
+def on_status(user_id, version):
+    get_presence().connect(user_id, timezone.now(), version)
 
 
+# user status off
 @sync_to_async
-def off_status(user_id):
-    try:
-        member = Member.objects.get(pk=user_id)
-        member.status = False
-        member.left_at = timezone.now()
-        member.save()
-    except Member.DoesNotExist:
-        return
+def off_status(user_id, version):
+    get_presence().disconnect(user_id, timezone.now(), version)
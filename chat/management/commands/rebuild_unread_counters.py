@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from chat.utils import rebuild_unread_counters
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the per user and room unread counters from the message receipts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        total = rebuild_unread_counters(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            'Rebuilt {} unread counters'.format(total)))
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.13 on 2026-10-18 07:44
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Receipt',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('is_read', models.BooleanField(default=False, verbose_name='読み済み')),
+                ('is_notice', models.BooleanField(default=False, verbose_name='通知')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='作成日時')),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='receipts', to='chat.message', verbose_name='メッセージ')),
+                ('room', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='receipts', to='chat.room', verbose_name='ルーム')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='receipts', to=settings.AUTH_USER_MODEL, verbose_name='受信者')),
+            ],
+            options={
+                'verbose_name': '受信状態',
+                'verbose_name_plural': '受信状態',
+                'unique_together': {('message', 'user')},
+                'index_together': {('user', 'room', 'is_read')},
+            },
+        ),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 3.2.13 on 2026-10-18 07:44
+
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+
+def create_receipts(apps, schema_editor):
+    """
+    Turn every per-receiver message copy into a receipt of its shared message
+    """
+    Message = apps.get_model('chat', 'Message')
+    Receipt = apps.get_model('chat', 'Receipt')
+
+    rows = Message.objects.exclude(receiver_id=None).order_by('id').values_list(
+        'id', 'follower_id', 'receiver_id', 'room_id', 'is_read', 'is_notice', 'created_at')
+
+    receipts = []
+    for message_id, follower_id, receiver_id, room_id, is_read, is_notice, created_at in rows.iterator():
+        # copies point to the shared message, the rest keep their own row
+        receipts.append(Receipt(
+            message_id=follower_id if follower_id is not None else message_id,
+            user_id=receiver_id,
+            room_id=room_id,
+            is_read=is_read,
+            is_notice=is_notice,
+            created_at=created_at))
+
+        if len(receipts) >= BATCH_SIZE:
+            Receipt.objects.bulk_create(receipts, ignore_conflicts=True)
+            receipts = []
+    Receipt.objects.bulk_create(receipts, ignore_conflicts=True)
+
+    # remove the copies
+    while True:
+        copy_ids = list(Message.objects.exclude(
+            follower_id=None).values_list('id', flat=True)[:BATCH_SIZE])
+        if len(copy_ids) == 0:
+            break
+        Message.objects.filter(id__in=copy_ids).delete()
+
+
+def create_copies(apps, schema_editor):
+    """
+    Recreate the per-receiver message copies from the receipts
+    """
+    Message = apps.get_model('chat', 'Message')
+    Receipt = apps.get_model('chat', 'Receipt')
+
+    for receipt in Receipt.objects.select_related('message').iterator():
+        message = receipt.message
+        if receipt.user_id == message.receiver_id:
+            continue
+
+        copy = Message.objects.create(
+            content=message.content,
+            gift_id=message.gift_id,
+            is_read=receipt.is_read,
+            room_id=message.room_id,
+            sender_id=message.sender_id,
+            receiver_id=receipt.user_id,
+            is_notice=receipt.is_notice,
+            is_like=message.is_like,
+            follower=message)
+        copy.medias.set(message.medias.all())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_receipt'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_receipts, create_copies),
+    ]
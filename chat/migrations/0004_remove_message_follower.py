@@ -0,0 +1,17 @@
+# Generated by Django 3.2.13 on 2026-10-18 07:44
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_message_receipts'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='message',
+            name='follower',
+        ),
+    ]
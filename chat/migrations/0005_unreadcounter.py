@@ -0,0 +1,43 @@
+# Generated by Django 3.2.13 on 2026-10-18 07:47
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def count_unread(apps, schema_editor):
+    Receipt = apps.get_model('chat', 'Receipt')
+    UnreadCounter = apps.get_model('chat', 'UnreadCounter')
+
+    rows = Receipt.objects.filter(is_read=False).exclude(room_id=None).values(
+        'user_id', 'room_id').annotate(unread=models.Count('id')).order_by()
+    UnreadCounter.objects.bulk_create([
+        UnreadCounter(user_id=row['user_id'], room_id=row['room_id'], count=row['unread'])
+        for row in rows.iterator()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0004_remove_message_follower'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnreadCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField(default=0, verbose_name='未読数')),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='unread_counters', to='chat.room', verbose_name='ルーム')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='unread_counters', to=settings.AUTH_USER_MODEL, verbose_name='ユーザー')),
+            ],
+            options={
+                'verbose_name': '未読数',
+                'verbose_name_plural': '未読数',
+                'unique_together': {('user', 'room')},
+            },
+        ),
+        migrations.RunPython(count_unread, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.2.13 on 2026-10-18 08:07
+
+from django.conf import settings
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0005_unreadcounter'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='message',
+            index_together={('room', 'created_at', 'id')},
+        ),
+        migrations.AlterIndexTogether(
+            name='notice',
+            index_together={('user', 'notice_type', 'created_at', 'id')},
+        ),
+        migrations.AlterIndexTogether(
+            name='room',
+            index_together={('updated_at', 'id')},
+        ),
+    ]
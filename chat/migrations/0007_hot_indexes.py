@@ -0,0 +1,23 @@
+# Generated by Django 3.2.13 on 2026-10-18 08:14
+
+from django.conf import settings
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0006_timeline_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='message',
+            index_together={('receiver', 'is_read'), ('room', 'created_at', 'id'), ('room', 'receiver', 'created_at')},
+        ),
+        migrations.AlterIndexTogether(
+            name='room',
+            index_together={('updated_at', 'id'), ('room_type', 'updated_at')},
+        ),
+    ]
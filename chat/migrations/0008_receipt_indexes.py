@@ -0,0 +1,23 @@
+# Generated by Django 3.2.13 on 2026-10-18 09:25
+
+from django.conf import settings
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0007_hot_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='message',
+            index_together={('room', 'created_at', 'id')},
+        ),
+        migrations.AlterIndexTogether(
+            name='receipt',
+            index_together={('user', 'is_read'), ('user', 'room', 'is_read')},
+        ),
+    ]
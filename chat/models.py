@@ -2,6 +2,7 @@
 Models for Chat
 """
 from django.db import models
+from django.utils import timezone
 from django.db.models.fields import related
 from accounts.models import Member, Media
 from basics.models import Gift, Location
@@ -35,6 +36,10 @@ class Room(models.Model):
     created_at = models.DateTimeField('作成日時', auto_now_add=True)
     updated_at = models.DateTimeField('更新日時', auto_now=True)
 
+    class Meta:
+        # room timeline cursor and rooms by type
+        index_together = [('updated_at', 'id'), ('room_type', 'updated_at')]
+
 
 class Message(models.Model):
     """
@@ -58,15 +63,54 @@ class Message(models.Model):
         Member, related_name="received", on_delete=models.SET_NULL, null=True)
     is_notice = models.BooleanField('通知', default=False)
     is_like = models.BooleanField('イイネ', default=False)
-    follower = models.ForeignKey(
-        'self',
-        on_delete=models.CASCADE,
-        null=True,
-        verbose_name="新メッセージ")
 
     created_at = models.DateTimeField('作成日時', auto_now_add=True)
     updated_at = models.DateTimeField('更新日時', auto_now=True)
 
+    class Meta:
+        # room message timeline cursor, the receivers are read from Receipt
+        index_together = [
+            ('room', 'created_at', 'id')
+        ]
+
+
+class Receipt(models.Model):
+    """
+    Receipt Model
+
+    One row per participant of a message, the message itself is stored once
+    """
+    message = models.ForeignKey(
+        Message,
+        related_name="receipts",
+        on_delete=models.CASCADE,
+        verbose_name='メッセージ')
+    user = models.ForeignKey(
+        Member,
+        related_name="receipts",
+        on_delete=models.CASCADE,
+        verbose_name='受信者')
+    room = models.ForeignKey(
+        Room,
+        related_name="receipts",
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        verbose_name='ルーム')
+    is_read = models.BooleanField('読み済み', default=False)
+    is_notice = models.BooleanField('通知', default=False)
+    created_at = models.DateTimeField('作成日時', default=timezone.now)
+
+    class Meta:
+        verbose_name = '受信状態'
+        verbose_name_plural = '受信状態'
+        unique_together = ('message', 'user')
+        # unread receipts of a room, and of the admins in their inbox
+        index_together = [
+            ('user', 'room', 'is_read'),
+            ('user', 'is_read')
+        ]
+
 # class Suggestion(models.Model):
 #     """
 #     Suggestion Model
@@ -102,6 +146,10 @@ class Notice(models.Model):
     created_at = models.DateTimeField('作成日時', auto_now_add=True)
     updated_at = models.DateTimeField('更新日時', auto_now=True)
 
+    class Meta:
+        # notice timeline cursor
+        index_together = ('user', 'notice_type', 'created_at', 'id')
+
 
 class AdminNotice(models.Model):
     """
@@ -117,3 +165,27 @@ class AdminNotice(models.Model):
         verbose_name='支店')
     created_at = models.DateTimeField('作成日時', auto_now_add=True)
     updated_at = models.DateTimeField('更新日時', auto_now=True)
+
+
+class UnreadCounter(models.Model):
+    """
+    UnreadCounter Model
+
+    Number of unread receipts per user and room
+    """
+    user = models.ForeignKey(
+        Member,
+        related_name="unread_counters",
+        on_delete=models.CASCADE,
+        verbose_name='ユーザー')
+    room = models.ForeignKey(
+        Room,
+        related_name="unread_counters",
+        on_delete=models.CASCADE,
+        verbose_name='ルーム')
+    count = models.IntegerField('未読数', default=0)
+
+    class Meta:
+        verbose_name = '未読数'
+        verbose_name_plural = '未読数'
+        unique_together = ('user', 'room')
@@ -0,0 +1,52 @@
+"""
+Keyset pagination for the chat timelines
+
+Pages are read newest first on (field, id). The cursor is the opaque position
+of the last row of the previous page, so pages neither slow down with depth
+nor shift when new rows arrive.
+"""
+import base64
+import json
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(value, pk):
+    position = json.dumps([value.isoformat(), pk])
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        value = parse_datetime(value)
+        if value is None:
+            raise ValueError(cursor)
+        return value, int(pk)
+    except (ValueError, TypeError):
+        raise InvalidCursor(cursor)
+
+
+def paginate_keyset(queryset, cursor, field="created_at", page_size=10):
+    """
+    One page of the queryset after the cursor, and the cursor of the next
+    page or None on the last one. An empty cursor is the first page.
+    """
+    queryset = queryset.order_by('-{}'.format(field), '-id')
+
+    if cursor:
+        value, pk = decode_cursor(cursor)
+        queryset = queryset.filter(**{"{}__lte".format(field): value}).filter(
+            Q(**{"{}__lt".format(field): value}) | Q(id__lt=pk))
+
+    items = list(queryset[:page_size + 1])
+    if len(items) <= page_size:
+        return items, None
+
+    items = items[:page_size]
+    return items, encode_cursor(getattr(items[-1], field), items[-1].id)
@@ -0,0 +1,244 @@
+"""
+Websocket presence of members
+
+Connections are counted per user, so a user stays online while any of their
+tabs is connected, and per wire format, so the broadcasts only build the
+formats a user is connected with. Changed users are queued and written to
+Member.status and Member.left_at in batches by chat.tasks.flush_presence.
+"""
+import threading
+from datetime import datetime
+
+import pytz
+from django.conf import settings
+from django.db import models
+from django.utils.module_loading import import_string
+from rest_framework import serializers
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# states are dropped a day after the last change, the flushed row stays
+STATE_TIMEOUT = 60 * 60 * 24
+
+# wire formats of the connections, see chat.broadcast
+VERSIONS = (1, 2)
+
+
+def to_timestamp(value):
+    return value.timestamp()
+
+
+def from_timestamp(value):
+    return datetime.fromtimestamp(float(value), tz=pytz.utc)
+
+
+def to_versions(count, version_counts):
+    """
+    Wire formats of the connections, all of them when some connections were
+    counted without their format.
+    """
+    if count > sum(version_counts.values()):
+        return set(version_counts)
+    return {version for version, version_count in version_counts.items() if version_count > 0}
+
+
+class MemoryPresence:
+    """
+    In process stand-in for RedisPresence, for tests and single process runs.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states = {}
+        self.changed = set()
+
+    def get_state(self, user_id):
+        return self.states.setdefault(
+            user_id, {"count": 0, "left_at": None, "versions": {version: 0 for version in VERSIONS}})
+
+    def connect(self, user_id, now, version=1):
+        with self.lock:
+            state = self.get_state(user_id)
+            state["count"] += 1
+            state["versions"][version] += 1
+            self.changed.add(user_id)
+            return state["count"]
+
+    def disconnect(self, user_id, now, version=1):
+        with self.lock:
+            state = self.get_state(user_id)
+            state["count"] -= 1
+            state["versions"][version] = max(state["versions"][version] - 1, 0)
+            if state["count"] <= 0:
+                state["count"] = 0
+                state["left_at"] = now
+            self.changed.add(user_id)
+            return state["count"]
+
+    def get_versions(self, user_ids):
+        with self.lock:
+            return {
+                user_id: to_versions(self.states[user_id]["count"], self.states[user_id]["versions"])
+                for user_id in user_ids if user_id in self.states}
+
+    def get_states(self, user_ids):
+        with self.lock:
+            return {
+                user_id: {"status": self.states[user_id]["count"] > 0, "left_at": self.states[user_id]["left_at"]}
+                for user_id in user_ids if user_id in self.states}
+
+    def pop_changed(self, limit):
+        with self.lock:
+            user_ids = list(self.changed)[:limit]
+            self.changed.difference_update(user_ids)
+            return user_ids
+
+
+class RedisPresence:
+    """
+    Presence shared by every process, one hash per user and a set of the
+    users changed since the last flush.
+    """
+    CHANGED_KEY = "presence:changed"
+
+    # decrement without going below zero, stamping the time of the last leave
+    DISCONNECT_SCRIPT = """
+local count = redis.call('HINCRBY', KEYS[1], 'count', -1)
+if count <= 0 then
+    count = 0
+    redis.call('HSET', KEYS[1], 'count', 0, 'left_at', ARGV[1])
+end
+if redis.call('HINCRBY', KEYS[1], ARGV[4], -1) < 0 then
+    redis.call('HSET', KEYS[1], ARGV[4], 0)
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('SADD', KEYS[2], ARGV[3])
+return count
+"""
+
+    def __init__(self):
+        self.client = redis.Redis.from_url(settings.PRESENCE_REDIS_URL)
+        self.disconnect_script = self.client.register_script(self.DISCONNECT_SCRIPT)
+
+    def get_key(self, user_id):
+        return "presence:{}".format(user_id)
+
+    def get_version_field(self, version):
+        return "v{}".format(version)
+
+    def connect(self, user_id, now, version=1):
+        key = self.get_key(user_id)
+        pipeline = self.client.pipeline()
+        pipeline.hincrby(key, "count", 1)
+        pipeline.hincrby(key, self.get_version_field(version), 1)
+        pipeline.expire(key, STATE_TIMEOUT)
+        pipeline.sadd(self.CHANGED_KEY, user_id)
+        return pipeline.execute()[0]
+
+    def disconnect(self, user_id, now, version=1):
+        return self.disconnect_script(
+            keys=[self.get_key(user_id), self.CHANGED_KEY],
+            args=[to_timestamp(now), STATE_TIMEOUT, user_id, self.get_version_field(version)])
+
+    def get_versions(self, user_ids):
+        user_ids = list(user_ids)
+        fields = [self.get_version_field(version) for version in VERSIONS]
+        pipeline = self.client.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipeline.hmget(self.get_key(user_id), "count", *fields)
+
+        versions = {}
+        for user_id, values in zip(user_ids, pipeline.execute()):
+            if values[0] is not None:
+                versions[user_id] = to_versions(int(values[0]), {
+                    version: int(value or 0) for version, value in zip(VERSIONS, values[1:])})
+        return versions
+
+    def get_states(self, user_ids):
+        user_ids = list(user_ids)
+        pipeline = self.client.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipeline.hmget(self.get_key(user_id), "count", "left_at")
+
+        states = {}
+        for user_id, (count, left_at) in zip(user_ids, pipeline.execute()):
+            if count is not None:
+                states[user_id] = {
+                    "status": int(count) > 0,
+                    "left_at": from_timestamp(left_at) if left_at is not None else None}
+        return states
+
+    def pop_changed(self, limit):
+        return [int(user_id) for user_id in self.client.spop(self.CHANGED_KEY, limit) or []]
+
+
+backends = {}
+
+
+def get_presence():
+    path = getattr(settings, 'PRESENCE_BACKEND', 'chat.presence.MemoryPresence')
+    if path not in backends:
+        backend_class = import_string(path)
+        if backend_class is RedisPresence and redis is None:
+            print("redis is not installed, presence is kept in process")
+            backend_class = MemoryPresence
+        backends[path] = backend_class()
+    return backends[path]
+
+
+def get_statuses(members):
+    """
+    Online status and left_at of the members, from the presence service when
+    it knows them and from their rows otherwise.
+    """
+    members = list(members)
+    states = get_presence().get_states([member.id for member in members])
+
+    statuses = {}
+    for member in members:
+        state = states.get(member.id)
+        if state is None:
+            statuses[member.id] = {"status": member.status, "left_at": member.left_at}
+        else:
+            statuses[member.id] = {"status": state["status"], "left_at": state["left_at"] or member.left_at}
+    return statuses
+
+
+def set_statuses(members):
+    """
+    Read the online status of the members in one round-trip for their
+    PresenceFields.
+    """
+    statuses = get_statuses(members)
+    for member in members:
+        member.presence_status = statuses[member.id]["status"]
+
+
+class PresenceListSerializer(serializers.ListSerializer):
+    """
+    Reads the presence of the whole list before serializing it
+    """
+
+    def to_representation(self, data):
+        members = list(data.all() if isinstance(data, models.Manager) else data)
+        set_statuses(members)
+        return super(PresenceListSerializer, self).to_representation(members)
+
+
+class PresenceField(serializers.BooleanField):
+    """
+    Member.status read from the presence service, batched for lists whose
+    serializer has PresenceListSerializer as list_serializer_class.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super(PresenceField, self).__init__(**kwargs)
+
+    def get_attribute(self, instance):
+        if hasattr(instance, 'presence_status'):
+            return instance.presence_status
+        return get_statuses([instance])[instance.id]["status"]
@@ -1,13 +1,15 @@
 """
 Serializers for Chat
 """
-from django.db.models import Count
+from django.db import models
+from django.db.models import Count, Prefetch, prefetch_related_objects
 from rest_framework import serializers
 from rest_framework.fields import ListField
 
 # accounts app
 from accounts.serializers.auth import MediaImageSerializer
 from accounts.serializers.member import MainInfoSerializer
+from accounts.cards import ProfileCardField, get_card
 from accounts.models import Media, Member
 
 # basics app
@@ -31,8 +33,8 @@ class NoticeSerializer(serializers.ModelSerializer):
     """
     user_id = serializers.IntegerField()
     from_user_id = serializers.IntegerField()
-    user = MainInfoSerializer(read_only=True)
-    from_user = MainInfoSerializer(read_only=True)
+    user = ProfileCardField()
+    from_user = ProfileCardField()
 
     class Meta:
         model = Notice
@@ -64,6 +66,34 @@ class NoticeSerializer(serializers.ModelSerializer):
 #         model = Join
 
 
+def get_room_prefetches():
+    """
+    Prefetch plan of RoomSerializer: the users and the last sender of the
+    rooms with their avatars and locations, in a fixed number of queries.
+    """
+    return [
+        Prefetch(
+            'users',
+            queryset=Member.objects.select_related(
+                'location').prefetch_related('avatars')),
+        Prefetch(
+            'last_sender',
+            queryset=Member.all_objects.select_related(
+                'location').prefetch_related('avatars')),
+    ]
+
+
+class RoomListSerializer(serializers.ListSerializer):
+    """
+    Applies the prefetch plan to the whole page before serializing it
+    """
+
+    def to_representation(self, data):
+        rooms = list(data.all() if isinstance(data, models.Manager) else data)
+        prefetch_related_objects(rooms, *get_room_prefetches())
+        return super(RoomListSerializer, self).to_representation(rooms)
+
+
 class RoomSerializer(serializers.ModelSerializer):
     """
     Room Serializer
@@ -93,6 +123,12 @@ class RoomSerializer(serializers.ModelSerializer):
             'user_ids',
             'last_sender_id'
         )
+        list_serializer_class = RoomListSerializer
+
+    def to_representation(self, instance):
+        # already prefetched rooms are skipped
+        prefetch_related_objects([instance], *get_room_prefetches())
+        return super(RoomSerializer, self).to_representation(instance)
 
     def create(self, validated_data):
         user_ids = validated_data.pop('user_ids')
@@ -188,9 +224,9 @@ class MessageSerializer(serializers.ModelSerializer):
     gift = GiftSerializer(read_only=True)
     room = RoomSerializer(read_only=True)
     room_id = serializers.IntegerField(write_only=True, required=False)
-    sender = MainInfoSerializer(read_only=True)
+    sender = ProfileCardField()
     sender_id = serializers.IntegerField(write_only=True, required=False)
-    receiver = MainInfoSerializer(read_only=True)
+    receiver = ProfileCardField()
 
     class Meta:
         model = Message
@@ -213,6 +249,21 @@ class MessageSerializer(serializers.ModelSerializer):
             'created_at'
         )
 
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+
+        # per receiver fields, annotated from the receipt
+        if hasattr(instance, 'receipt_user_id'):
+            data['is_read'] = instance.receipt_is_read
+            data['is_notice'] = instance.receipt_is_notice
+
+            receivers = self.context.get('receivers', {})
+            if instance.receipt_user_id in receivers:
+                data['receiver'] = get_card(
+                    "main", receivers[instance.receipt_user_id])
+
+        return data
+
 
 class AdminNoticeSerializer(serializers.ModelSerializer):
     location = LocationSerializer(read_only=True)
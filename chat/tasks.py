@@ -0,0 +1,142 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.db import transaction
+from celery import shared_task
+
+from accounts.models import Member
+from accounts.utils import send_present, send_presents, send_user, get_active_guest_ids
+from calls.models import Order
+from calls.utils import send_call, send_call_type, send_room_event, send_applier, \
+    get_plan_cast_ids, get_location_cast_ids, get_join_user_ids, get_order_user_ids, get_call_type
+from .models import Room
+from .presence import get_presence
+from .utils import send_super_message, send_room_created
+
+# receivers of an order event, resolved on the worker
+CALL_AUDIENCES = {
+    "plan": get_plan_cast_ids,
+    "location": get_location_cast_ids,
+    "joins": get_join_user_ids,
+    "order": get_order_user_ids,
+}
+
+
+def enqueue(task, *args, **kwargs):
+    """
+    Queue a broadcast task once the current transaction is committed.
+    """
+    transaction.on_commit(
+        lambda: task.apply_async(args=args, kwargs=kwargs))
+
+
+@shared_task
+def broadcast_call(order_id, call_event, audience="plan", with_type=False, receiver_ids=None):
+    try:
+        order = Order.objects.get(pk=order_id)
+    except Order.DoesNotExist:
+        print("order {} does not exist".format(order_id))
+        return
+
+    if receiver_ids is None:
+        receiver_ids = CALL_AUDIENCES[audience](order)
+    send_call(order, receiver_ids, call_event)
+
+    # call type send
+    if with_type:
+        call_type = get_call_type(order)
+        if call_type is not None:
+            send_call_type(call_type, receiver_ids)
+
+
+@shared_task
+def broadcast_room_event(event, room_id):
+    try:
+        room = Room.objects.get(pk=room_id)
+    except Room.DoesNotExist:
+        print("room {} does not exist".format(room_id))
+        return
+
+    send_room_event(event, room)
+
+
+@shared_task
+def broadcast_room_created(order_id, room_id, cast_ids):
+    try:
+        order = Order.objects.get(pk=order_id)
+        room = Room.objects.get(pk=room_id)
+    except (Order.DoesNotExist, Room.DoesNotExist):
+        print("order {} or room {} does not exist".format(order_id, room_id))
+        return
+
+    send_room_created(room, order, cast_ids)
+
+
+@shared_task
+def broadcast_applier(order_id, room_id, guest_id, is_exceed=False):
+    send_applier(order_id, room_id, guest_id, is_exceed)
+
+
+@shared_task
+def broadcast_present(cast_id, event):
+    try:
+        cast = Member.objects.get(pk=cast_id)
+    except Member.DoesNotExist:
+        print("cast {} does not exist".format(cast_id))
+        return
+
+    send_present(cast, event, get_active_guest_ids())
+
+
+@shared_task
+def broadcast_presents(cast_ids, event):
+    casts = Member.objects.filter(id__in=cast_ids).select_related(
+        'detail', 'guest_level', 'cast_class').prefetch_related('avatars')
+    send_presents(casts, event, get_active_guest_ids())
+
+
+@shared_task
+def broadcast_user(user_id):
+    try:
+        user = Member.objects.get(pk=user_id)
+    except Member.DoesNotExist:
+        print("user {} does not exist".format(user_id))
+        return
+
+    send_user(user)
+
+
+@shared_task
+def broadcast_super_message(
+        room_type,
+        receiver_ids,
+        message_content,
+        media_ids=[]):
+    for receiver_id in receiver_ids:
+        send_super_message(room_type, receiver_id, message_content, media_ids)
+
+
+@shared_task
+def flush_presence(batch_size=1000):
+    """
+    Write the presence of the changed users to their rows.
+    """
+    presence = get_presence()
+    total = 0
+    while True:
+        user_ids = presence.pop_changed(batch_size)
+        if len(user_ids) == 0:
+            break
+
+        # updated_at is left alone, cards read the presence live and keep
+        # their keys
+        states = presence.get_states(user_ids)
+        online_ids = [user_id for user_id, state in states.items() if state["status"]]
+        Member.objects.filter(id__in=online_ids).update(status=True)
+        Member.objects.bulk_update([
+            Member(id=user_id, status=False, left_at=state["left_at"])
+            for user_id, state in states.items() if not state["status"]
+        ], ['status', 'left_at'])
+        total += len(user_ids)
+
+    print("presence flushed {}".format(total))
+    return total
@@ -0,0 +1,456 @@
+from unittest import mock
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from accounts.cards import get_card
+from accounts.models import Media, Member
+from accounts.serializers.member import GeneralInfoSerializer
+from basics.models import Location
+from .broadcast import COMPACT_VERSION, VERBOSE_VERSION, broadcast_versions
+from .compact import compact_order
+from .models import Message, Receipt, Room, UnreadCounter
+from .presence import backends, get_presence
+from .routing import websocket_urlpatterns
+from .serializers import RoomSerializer
+from .tasks import flush_presence
+from .utils import add_unread, clear_unread, create_message, get_received_messages, send_room_to_users, send_super_room
+
+
+@override_settings(DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage')
+class RoomSerializerTest(TestCase):
+    """
+    RoomSerializer loads the nested users in a fixed number of queries
+    """
+
+    def setUp(self):
+        location = Location.objects.create(name="東京")
+        self.user = Member.objects.create(
+            username="owner", email="owner@example.com", location=location)
+        self.user.avatars.add(Media.objects.create(uri="avatars/owner.png"))
+
+        for room_index in range(10):
+            room = Room.objects.create(
+                title="room{}".format(room_index), room_type="private")
+            users = [self.user]
+            for user_index in range(4):
+                user = Member.objects.create(
+                    username="user{}_{}".format(room_index, user_index),
+                    email="user{}_{}@example.com".format(room_index, user_index),
+                    location=location)
+                user.avatars.add(Media.objects.create(
+                    uri="avatars/{}_{}.png".format(room_index, user_index)))
+                users.append(user)
+            room.users.set(users)
+            room.last_sender = users[-1]
+            room.save()
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_room_list_query_count(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/chat/rooms')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 10)
+
+        for room in response.data:
+            self.assertEqual(len(room['users']), 5)
+            self.assertEqual(len(room['last_sender']['avatars']), 1)
+            self.assertEqual(room['last_sender']['location']['name'], "東京")
+
+        # room ids, rooms, unread counts and the prefetch plan
+        self.assertEqual(len(context.captured_queries), 7)
+
+    def test_serializer_query_count(self):
+        rooms = Room.objects.order_by('id')
+
+        # rooms, users, user avatars, last senders, last sender avatars
+        with self.assertNumQueries(5):
+            data = RoomSerializer(rooms, many=True).data
+        self.assertEqual(len(data), 10)
+
+        room = Room.objects.get(title="room0")
+        with self.assertNumQueries(4):
+            RoomSerializer(room).data
+
+
+@override_settings(
+    DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage',
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    PRESENCE_BACKEND='chat.presence.MemoryPresence')
+class CompactFormatTest(TestCase):
+    """
+    Websocket clients get the wire format they asked for on connect
+    """
+
+    def setUp(self):
+        backends.clear()
+        self.user = Member.objects.create(username="owner", email="owner@example.com")
+        self.partner = Member.objects.create(username="partner", email="partner@example.com")
+        self.room = Room.objects.create(title="room", room_type="private", last_sender=self.partner)
+        self.room.users.set([self.user, self.partner])
+
+    def receive_rooms(self, path, count):
+        application = URLRouter(websocket_urlpatterns)
+
+        async def run():
+            communicator = WebsocketCommunicator(application, path)
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+
+            received = []
+            for index in range(count):
+                await sync_to_async(send_room_to_users)(self.room, [self.user.id], "create")
+                received.append(await communicator.receive_json_from())
+            await communicator.disconnect()
+            return received
+
+        return async_to_sync(run)()
+
+    def test_verbose(self):
+        event = self.receive_rooms("ws/chat/{}/".format(self.user.id), 1)[0]
+
+        self.assertEqual(event['type'], "ROOM")
+        self.assertNotIn('v', event)
+        self.assertEqual(len(event['data']['users']), 2)
+        self.assertEqual(event['data']['last_sender']['id'], self.partner.id)
+
+    def test_compact(self):
+        first, second = self.receive_rooms("ws/chat/{}/?v=2".format(self.user.id), 2)
+
+        self.assertEqual(first['v'], 2)
+        self.assertEqual(first['type'], "ROOM")
+        self.assertEqual(first['event'], "create")
+        self.assertEqual(sorted(first['data']['users']), sorted([self.user.id, self.partner.id]))
+        self.assertEqual(first['data']['last_sender'], self.partner.id)
+        self.assertEqual(
+            sorted(user['id'] for user in first['users']), sorted([self.user.id, self.partner.id]))
+
+        # the users are sent once per connection
+        self.assertEqual(second['data'], first['data'])
+        self.assertEqual(second['users'], [])
+
+    def test_subscribed_format_only(self):
+        with mock.patch('chat.utils.RoomSerializer') as room_serializer:
+            event = self.receive_rooms("ws/chat/{}/?v=2".format(self.user.id), 1)[0]
+        self.assertEqual(event['v'], 2)
+        room_serializer.assert_not_called()
+
+        with mock.patch('chat.utils.compact_room') as compact_room:
+            event = self.receive_rooms("ws/chat/{}/".format(self.user.id), 1)[0]
+        self.assertNotIn('v', event)
+        compact_room.assert_not_called()
+
+    def test_compact_order_delete(self):
+        order = mock.Mock(id=7)
+        self.assertEqual(compact_order(order, "delete"), {"data": {"id": 7}, "users": []})
+
+
+@override_settings(PRESENCE_BACKEND='chat.presence.MemoryPresence')
+class PresenceTest(TestCase):
+    """
+    Presence counts connections per user and is flushed in batches
+    """
+
+    def setUp(self):
+        backends.clear()
+        self.user = Member.objects.create(username="owner", email="owner@example.com")
+        self.presence = get_presence()
+
+    def get_status(self):
+        user = Member.objects.get(pk=self.user.id)
+        return user.status, user.left_at
+
+    def test_tabs(self):
+        now = timezone.now()
+        self.presence.connect(self.user.id, now)
+        self.presence.connect(self.user.id, now)
+        self.presence.disconnect(self.user.id, now)
+
+        # read before any flush
+        self.assertTrue(GeneralInfoSerializer(self.user).data['status'])
+        self.assertEqual(self.get_status(), (False, None))
+
+        self.assertEqual(flush_presence(), 1)
+        self.assertEqual(self.get_status(), (True, None))
+
+        left_at = timezone.now()
+        self.presence.disconnect(self.user.id, left_at)
+        self.assertFalse(get_card("general", self.user)['status'])
+
+        self.assertEqual(flush_presence(), 1)
+        self.assertEqual(self.get_status(), (False, left_at))
+        self.assertEqual(flush_presence(), 0)
+
+    def test_flush_keeps_updated_at(self):
+        updated_at = Member.objects.get(pk=self.user.id).updated_at
+        self.presence.connect(self.user.id, timezone.now())
+        flush_presence()
+        self.assertEqual(Member.objects.get(pk=self.user.id).updated_at, updated_at)
+
+    def test_list_batched(self):
+        members = [self.user] + [
+            Member.objects.create(username="user{}".format(index), email="user{}@example.com".format(index))
+            for index in range(3)]
+        self.presence.connect(members[1].id, timezone.now())
+
+        with mock.patch.object(self.presence, 'get_states', wraps=self.presence.get_states) as get_states:
+            data = GeneralInfoSerializer(Member.objects.filter(
+                id__in=[member.id for member in members]).order_by('id'), many=True).data
+        self.assertEqual(get_states.call_count, 1)
+        self.assertEqual([item['status'] for item in data], [False, True, False, False])
+
+    def test_versions(self):
+        now = timezone.now()
+        self.presence.connect(self.user.id, now, 2)
+        self.assertEqual(self.presence.get_versions([self.user.id, 0]), {self.user.id: {2}})
+
+        self.presence.connect(self.user.id, now)
+        self.presence.disconnect(self.user.id, now, 2)
+        self.assertEqual(self.presence.get_versions([self.user.id]), {self.user.id: {1}})
+
+        self.presence.disconnect(self.user.id, now)
+        self.assertEqual(self.presence.get_versions([self.user.id]), {self.user.id: set()})
+
+    @mock.patch('chat.broadcast.send_groups')
+    def test_broadcast_versions(self, send_groups):
+        self.presence.connect(self.user.id, timezone.now(), COMPACT_VERSION)
+        build = mock.Mock(side_effect=lambda version, receiver_ids: [
+            (receiver_id, {"v": version}) for receiver_id in receiver_ids])
+        broadcast_versions([self.user.id, 0], build)
+
+        # the receiver without presence state only gets the verbose format
+        self.assertEqual(
+            [call[0] for call in build.call_args_list], [(VERBOSE_VERSION, [0]), (COMPACT_VERSION, [self.user.id])])
+
+
+class CursorPaginationTest(TestCase):
+    """
+    Timelines can be walked with a cursor without gaps or repeats
+    """
+
+    def setUp(self):
+        self.user = Member.objects.create(username="owner", email="owner@example.com")
+        self.room = Room.objects.create(title="room", room_type="private")
+        self.room.users.set([self.user])
+
+        for index in range(25):
+            self.add_message(index)
+        # ties on created_at are broken by id
+        Message.objects.filter(id__in=Message.objects.order_by('id').values('id')[5:15]).update(
+            created_at=Message.objects.order_by('id')[5].created_at)
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def add_message(self, index):
+        message = Message.objects.create(room=self.room, sender=self.user, content=str(index))
+        Receipt.objects.create(message=message, user=self.user, room=self.room)
+        return message
+
+    def test_walk(self):
+        url = '/api/chat/rooms/{}/messages'.format(self.room.id)
+        expected = list(Message.objects.order_by('-created_at', '-id').values_list('id', flat=True))
+
+        ids = []
+        cursor = ""
+        while cursor is not None:
+            response = self.client.get(url, {'cursor': cursor})
+            self.assertEqual(response.status_code, 200)
+            ids += [message['id'] for message in response.data['results']]
+            cursor = response.data['next']
+
+            # new rows do not shift the next pages
+            if len(ids) == 10:
+                self.add_message(100)
+
+        self.assertEqual(ids, expected)
+
+        # page mode is unchanged
+        response = self.client.get(url, {'page': 1})
+        self.assertEqual(len(response.data), 10)
+
+        response = self.client.get(url, {'cursor': "broken"})
+        self.assertEqual(response.status_code, 400)
+
+
+@mock.patch('chat.utils.broadcast_versions')
+class CreateMessageTest(TestCase):
+    """
+    A message is stored once with a receipt per participant
+    """
+
+    def setUp(self):
+        self.sender = Member.objects.create(username="sender", email="sender@example.com")
+        self.receivers = [
+            Member.objects.create(username="receiver{}".format(index), email="receiver{}@example.com".format(index))
+            for index in range(3)]
+        self.room = Room.objects.create(title="room", room_type="public", is_group=True)
+        self.room.users.set([self.sender] + self.receivers)
+
+    def get_sent_ids(self, broadcast_versions):
+        return sorted(broadcast_versions.call_args[0][0])
+
+    def test_create(self, broadcast_versions):
+        message = create_message(self.room, self.sender, [self.sender] + self.receivers, "hello")
+
+        self.assertEqual(Message.objects.count(), 1)
+        self.assertEqual(message.receiver_id, self.sender.id)
+        receipts = dict(message.receipts.values_list('user_id', 'is_read'))
+        self.assertEqual(receipts, dict(
+            [(self.sender.id, True)] + [(receiver.id, False) for receiver in self.receivers]))
+
+        # the sender is not counted nor notified
+        self.assertEqual(
+            dict(UnreadCounter.objects.values_list('user_id', 'count')),
+            {receiver.id: 1 for receiver in self.receivers})
+        self.assertEqual(self.get_sent_ids(broadcast_versions), sorted(receiver.id for receiver in self.receivers))
+
+    def test_read_notice(self, broadcast_versions):
+        message = create_message(
+            self.room, self.sender, self.receivers[:1], "notice", is_read=True, is_notice=True, notify_sender=True)
+
+        self.assertEqual(UnreadCounter.objects.count(), 0)
+        self.assertTrue(message.receipts.get(user=self.receivers[0]).is_notice)
+        self.assertFalse(message.receipts.get(user=self.sender).is_notice)
+        self.assertEqual(self.get_sent_ids(broadcast_versions), sorted([self.sender.id, self.receivers[0].id]))
+
+    def test_received_messages(self, broadcast_versions):
+        first = create_message(self.room, self.sender, self.receivers, "first")
+        second = create_message(self.room, self.receivers[0], [self.sender], "second")
+        Receipt.objects.filter(message=first, user=self.receivers[1]).update(is_read=True)
+
+        messages = get_received_messages(user=self.receivers[1]).order_by('id')
+        self.assertEqual([message.id for message in messages], [first.id])
+        self.assertEqual(messages[0].receipt_user_id, self.receivers[1].id)
+        self.assertTrue(messages[0].receipt_is_read)
+
+        unread = get_received_messages(room=self.room, is_read=False).order_by('id')
+        self.assertEqual(
+            sorted((message.id, message.receipt_user_id) for message in unread),
+            sorted([(first.id, self.receivers[0].id), (first.id, self.receivers[2].id), (second.id, self.sender.id)]))
+
+    def test_super_room(self, broadcast_versions):
+        admin = Member.objects.create(username="system", email="system@example.com", is_superuser=True)
+        self.room.users.add(admin)
+
+        message = send_super_room(self.room.id, admin.id, "from admin")
+        self.assertFalse(message.receipts.filter(user=admin, is_read=False).exists())
+        self.assertEqual(
+            self.get_sent_ids(broadcast_versions), sorted(user.id for user in [self.sender] + self.receivers))
+
+        # written as a member of the room, its own sockets get it too
+        send_super_room(self.room.id, self.sender.id, "as member")
+        self.assertEqual(
+            self.get_sent_ids(broadcast_versions), sorted(user.id for user in [self.sender] + self.receivers))
+
+
+@mock.patch('chat.utils.broadcast_versions')
+class UnreadCounterTest(TestCase):
+    """
+    The unread counters follow the receipts
+    """
+
+    def setUp(self):
+        backends.clear()
+        self.user = Member.objects.create(username="owner", email="owner@example.com")
+        self.partner = Member.objects.create(username="partner", email="partner@example.com")
+        self.room = Room.objects.create(title="room", room_type="private")
+        self.room.users.set([self.user, self.partner])
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get_count(self):
+        return UnreadCounter.objects.get(user=self.user, room=self.room).count
+
+    def test_add(self, broadcast_versions):
+        add_unread(self.room, [self.user.id, self.partner.id])
+        add_unread(self.room, [self.user.id])
+        add_unread(None, [self.user.id])
+
+        self.assertEqual(self.get_count(), 2)
+        self.assertEqual(UnreadCounter.objects.get(user=self.partner).count, 1)
+
+    def test_clear(self, broadcast_versions):
+        for index in range(3):
+            create_message(self.room, self.partner, [self.user], str(index))
+        self.assertEqual(self.client.get('/api/chat/unread').data, 3)
+
+        # a message counted but whose receipt is not committed yet
+        UnreadCounter.objects.filter(user=self.user).update(count=4)
+        self.assertEqual(clear_unread(self.room, self.user), 3)
+        self.assertEqual(self.get_count(), 1)
+        self.assertEqual(clear_unread(self.room, self.user), 0)
+        self.assertEqual(self.get_count(), 1)
+
+    def test_read(self, broadcast_versions):
+        for index in range(2):
+            create_message(self.room, self.partner, [self.user], str(index))
+        response = self.client.put('/api/chat/rooms/{}/messages'.format(self.room.id))
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self.get_count(), 0)
+        self.assertFalse(Receipt.objects.filter(user=self.user, is_read=False).exists())
+        self.assertEqual(self.client.get('/api/chat/unread').data, 0)
+
+
+class ReceiptMigrationTest(TransactionTestCase):
+    """
+    The per-receiver message copies become receipts of one message
+    """
+
+    before = [('chat', '0002_receipt')]
+    after = [('chat', '0003_message_receipts')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_migrate(self):
+        sender = Member.objects.create(username="sender", email="sender@example.com")
+        receivers = [
+            Member.objects.create(username="receiver{}".format(index), email="receiver{}@example.com".format(index))
+            for index in range(2)]
+
+        apps = self.migrate(self.before)
+        OldRoom = apps.get_model('chat', 'Room')
+        OldMessage = apps.get_model('chat', 'Message')
+        room = OldRoom.objects.create(title="room")
+        shared = OldMessage.objects.create(
+            content="hello", room=room, sender_id=sender.id, receiver_id=sender.id, is_read=True)
+        OldMessage.objects.create(
+            content="hello", room=room, sender_id=sender.id, receiver_id=receivers[0].id,
+            follower=shared, is_read=True)
+        OldMessage.objects.create(
+            content="hello", room=room, sender_id=sender.id, receiver_id=receivers[1].id,
+            follower=shared, is_notice=True)
+        single = OldMessage.objects.create(
+            content="single", room=room, sender_id=receivers[0].id, receiver_id=sender.id)
+
+        apps = self.migrate(self.after)
+        NewMessage = apps.get_model('chat', 'Message')
+        NewReceipt = apps.get_model('chat', 'Receipt')
+
+        self.assertEqual(sorted(NewMessage.objects.values_list('id', flat=True)), [shared.id, single.id])
+        self.assertEqual(
+            sorted(NewReceipt.objects.values_list('message_id', 'user_id', 'is_read', 'is_notice')),
+            sorted([
+                (shared.id, sender.id, True, False),
+                (shared.id, receivers[0].id, True, False),
+                (shared.id, receivers[1].id, False, True),
+                (single.id, sender.id, False, False)]))
@@ -1,14 +1,147 @@
 from django.dispatch.dispatcher import receiver
+from django.db import transaction
+from django.db.models import F, Count, Value
+from django.db.models.functions import Greatest
 from accounts.models import Member
-from .models import Room, Message
+from accounts.cards import get_card
+from .models import Room, Message, Receipt, UnreadCounter
 from .serializers import RoomSerializer, MessageSerializer
+from .compact import compact_message, compact_receipt, compact_room
 import pytz
 
-# use channel
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
-
 from calls.utils import send_call
+from .broadcast import COMPACT_VERSION, broadcast_versions
+
+
+def create_message(
+        room,
+        sender,
+        receivers,
+        content=None,
+        media_ids=[],
+        gift_id=None,
+        is_read=False,
+        is_notice=False,
+        is_like=False,
+        notify_sender=False,
+        send=True):
+    """
+    Store the message once with a receipt for the sender and every receiver,
+    then send it to the receivers via socket unless send is False.
+    """
+    with transaction.atomic():
+        message = Message.objects.create(
+            content=content,
+            room=room,
+            sender=sender,
+            receiver=sender,
+            gift_id=gift_id,
+            is_read=True,
+            is_like=is_like)
+        if len(media_ids) > 0:
+            message.medias.set(media_ids)
+
+        sender_receipt = Receipt(
+            message=message,
+            user=sender,
+            room=room,
+            is_read=True,
+            created_at=message.created_at)
+        receiver_receipts = [
+            Receipt(
+                message=message,
+                user=cur_receiver,
+                room=room,
+                is_read=is_read,
+                is_notice=is_notice,
+                created_at=message.created_at)
+            for cur_receiver in receivers if cur_receiver.id != sender.id]
+        Receipt.objects.bulk_create([sender_receipt] + receiver_receipts)
+
+        if not is_read:
+            add_unread(room, [receipt.user.id for receipt in receiver_receipts])
+
+    # message send via socket
+    if send and notify_sender:
+        send_message_to_receipts(message, [sender_receipt] + receiver_receipts)
+    elif send:
+        send_message_to_receipts(message, receiver_receipts)
+
+    return message
+
+
+def add_unread(room, user_ids):
+    """
+    Count one more unread message in the room for every user.
+    """
+    user_ids = list(user_ids)
+    if room is None or len(user_ids) == 0:
+        return
+
+    UnreadCounter.objects.bulk_create(
+        [UnreadCounter(user_id=user_id, room=room) for user_id in user_ids],
+        ignore_conflicts=True)
+    UnreadCounter.objects.filter(
+        room=room, user_id__in=user_ids).update(count=F('count') + 1)
+
+
+def remove_unread(receipts):
+    """
+    Take the unread receipts off the counters of their users and rooms.
+    """
+    room_users = {}
+    for room_id, user_id in receipts.filter(
+            is_read=False).values_list('room_id', 'user_id'):
+        room_users.setdefault(room_id, []).append(user_id)
+
+    for room_id, user_ids in room_users.items():
+        UnreadCounter.objects.filter(
+            room_id=room_id,
+            user_id__in=user_ids,
+            count__gt=0).update(count=F('count') - 1)
+
+
+def clear_unread(room, user):
+    """
+    Mark the unread receipts of the user in the room read and take as many
+    off its counter, so messages arriving meanwhile stay counted.
+    """
+    with transaction.atomic():
+        count = Receipt.objects.filter(
+            user=user, room=room, is_read=False).update(is_read=True)
+        if count > 0:
+            UnreadCounter.objects.filter(room=room, user=user).update(
+                count=Greatest(F('count') - count, Value(0)))
+    return count
+
+
+def rebuild_unread_counters(batch_size=1000):
+    """
+    Recount the unread counters of every user and room from the receipts.
+    """
+    rows = Receipt.objects.filter(is_read=False).exclude(room=None).values(
+        'user_id', 'room_id').annotate(unread=Count('id')).order_by()
+
+    with transaction.atomic():
+        UnreadCounter.objects.all().delete()
+        counters = [
+            UnreadCounter(user_id=row['user_id'], room_id=row['room_id'], count=row['unread'])
+            for row in rows.iterator()]
+        UnreadCounter.objects.bulk_create(counters, batch_size=batch_size)
+
+    return len(counters)
+
+
+def get_received_messages(**receipt_filter):
+    """
+    Messages of the receipts matching the filter, annotated with the receipt.
+    """
+    return Message.objects.filter(**{
+        "receipts__{}".format(key): value for key, value in receipt_filter.items()
+    }).annotate(
+        receipt_user_id=F('receipts__user_id'),
+        receipt_is_read=F('receipts__is_read'),
+        receipt_is_notice=F('receipts__is_notice'))
 
 
 def send_super_message(room_type, receiver_id, message_content, media_ids=[]):
@@ -21,9 +154,6 @@ def send_super_message(room_type, receiver_id, message_content, media_ids=[]):
         print(e)
         return
 
-    # get channel layer
-    channel_layer = get_channel_layer()
-
     if Room.objects.filter(
             users__id=receiver_id,
             room_type=room_type).count() == 0:
@@ -37,10 +167,7 @@ def send_super_message(room_type, receiver_id, message_content, media_ids=[]):
         room.users.set([sender, receiver])
 
         # room send via socket
-        async_to_sync(channel_layer.group_send)(
-            "chat_{}".format(receiver_id),
-            {"type": "room.send", "content": RoomSerializer(room).data, "event": "create"}
-        )
+        send_room_to_users(room, [receiver_id], "create")
     else:
         room = Room.objects.filter(
             users__id=receiver_id,
@@ -54,26 +181,7 @@ def send_super_message(room_type, receiver_id, message_content, media_ids=[]):
     room.save()
 
     # send message
-    self_message = Message.objects.create(
-        content=message_content,
-        sender=sender,
-        receiver=sender,
-        is_read=True,
-        room=room)
-    cur_message = Message.objects.create(
-        content=message_content, sender=sender,
-        receiver=receiver, room=room,
-        follower=self_message
-    )
-    if len(media_ids) > 0:
-        self_message.medias.set(media_ids)
-        cur_message.medias.set(media_ids)
-
-    # message send via socket
-    async_to_sync(channel_layer.group_send)(
-        "chat_{}".format(receiver_id),
-        {"type": "message.send", "content": MessageSerializer(cur_message).data}
-    )
+    create_message(room, sender, [receiver], message_content, media_ids)
 
 
 def send_super_room(
@@ -84,14 +192,6 @@ def send_super_room(
         is_read=False):
     room = Room.objects.get(pk=room_id)
     sender = Member.objects.get(pk=sender_id)
-    channel_layer = get_channel_layer()
-    self_message = Message.objects.create(
-        content=message_content,
-        room=room,
-        sender=sender,
-        receiver=sender,
-        is_read=True)
-    self_message.medias.set(media_ids)
 
     # set room last message
     if message_content != "":
@@ -100,69 +200,72 @@ def send_super_room(
         room.last_message = "『画像』"
     room.save()
 
-    for room_member in room.users.all():
-        if not room_member.is_superuser:
-            # message create
-            cur_message = Message.objects.create(
-                content=message_content,
-                room=room,
-                sender=sender,
-                receiver=room_member,
-                follower=self_message,
-                is_read=is_read)
-
-            # send via websocket
-            async_to_sync(channel_layer.group_send)(
-                "chat_{}".format(room_member.id),
-                {"type": "message.send", "content": MessageSerializer(cur_message).data}
-            )
-            cur_message.medias.set(media_ids)
-
-    return self_message
+    # a member the admin writes as gets the message on its own sockets too
+    receivers = room.users.filter(is_superuser=False)
+    return create_message(
+        room,
+        sender,
+        receivers,
+        message_content,
+        media_ids,
+        is_read=is_read,
+        notify_sender=receivers.filter(pk=sender.id).exists())
 
 
 def send_room_to_users(room, receiver_ids, event_str):
-    channel_layer = get_channel_layer()
-    for user_id in receiver_ids:
-        async_to_sync(channel_layer.group_send)(
-            "chat_{}".format(user_id),
-            {"type": "room.send", "content": RoomSerializer(room).data, "event": event_str}
-        )
+    def build(version, version_ids):
+        if version == COMPACT_VERSION:
+            message = {"type": "room.send", "compact": compact_room(room), "event": event_str}
+        else:
+            message = {"type": "room.send", "content": RoomSerializer(room).data, "event": event_str}
+        return [(receiver_id, message) for receiver_id in version_ids]
+
+    return broadcast_versions(receiver_ids, build)
 
 
 def send_message_to_user(message, receiver_id):
-    channel_layer = get_channel_layer()
-    async_to_sync(channel_layer.group_send)(
-        "chat_{}".format(receiver_id),
-        {"type": "message.send", "content": MessageSerializer(message).data}
-    )
+    return send_message_to_receipts(
+        message, message.receipts.filter(user_id=receiver_id).select_related('user'))
+
+
+def send_message_to_receipts(message, receipts):
+    receipts = {receipt.user_id: receipt for receipt in receipts}
 
+    def build(version, version_ids):
+        if version == COMPACT_VERSION:
+            compact = compact_message(message)
+            return [
+                (user_id, {"type": "message.send", "compact": compact_receipt(compact, receipts[user_id])})
+                for user_id in version_ids]
 
-def send_notice_to_room(room, message, is_notice=True, cast_id=0):
+        content = MessageSerializer(message).data
+        return [
+            (user_id, {"type": "message.send", "content": dict(
+                content,
+                receiver=get_card("main", receipts[user_id].user),
+                is_read=receipts[user_id].is_read,
+                is_notice=receipts[user_id].is_notice)})
+            for user_id in version_ids]
+
+    return broadcast_versions(receipts.keys(), build)
+
+
+def send_notice_to_room(room, message, is_notice=True, cast_id=0, send=True):
     system_user = Member.objects.get(username="system", is_superuser=True)
-    self_message = Message.objects.create(
-        content=message,
-        room=room,
-        sender=system_user,
-        receiver=system_user,
-        is_read=True)
     room.last_message = message
     room.save()
 
-    for receiver in room.users.all():
-        if cast_id == 0 or (cast_id > 0 and receiver.id == cast_id):
-            new_message = Message.objects.create(
-                content=message,
-                room=room,
-                sender=system_user,
-                receiver=receiver,
-                is_read=False,
-                is_notice=is_notice,
-                follower=self_message)
-            send_message_to_user(new_message, receiver.id)
+    receivers = room.users.all()
+    if cast_id > 0:
+        receivers = receivers.filter(id=cast_id)
+    return create_message(room, system_user, receivers, message, is_notice=is_notice, send=send)
 
 
-def create_room(order, cast_ids):
+def create_room(order, cast_ids, send=True):
+    """
+    Create the group room of the matched order. The socket events are sent
+    by send_room_created, left to the caller when send is False.
+    """
     # create new room and message
     user_ids = [order.user.id]
     user_ids = user_ids + cast_ids
@@ -186,12 +289,10 @@ def create_room(order, cast_ids):
             username="system"),
         status=2)
     new_room.users.set(user_ids)
-
-    send_room_to_users(new_room, user_ids, "create")
     room_id = new_room.id
 
-    # send notice to room members
-    send_notice_to_room(new_room, new_message, False)
+    # notice to room members
+    send_notice_to_room(new_room, new_message, False, send=False)
 
     # change order status into confirm state
     if order.status < 3:
@@ -199,8 +300,23 @@ def create_room(order, cast_ids):
     order.room = new_room
     order.save()
 
-    # send order remove to casts
-    user_ids.remove(order.user.id)
-    send_call(order, user_ids, "delete")
+    if send:
+        send_room_created(new_room, order, cast_ids)
 
     return room_id
+
+
+def send_room_created(room, order, cast_ids):
+    """
+    Send the new room and its notice to the members, and remove the order
+    from the application list of the casts.
+    """
+    send_room_to_users(room, [order.user_id] + list(cast_ids), "create")
+
+    notice = room.messages.order_by('id').first()
+    if notice is not None:
+        send_message_to_receipts(notice, notice.receipts.exclude(
+            user_id=notice.sender_id).select_related('user'))
+
+    # send order remove to casts
+    send_call(order, cast_ids, "delete")
@@ -3,7 +3,8 @@ APIs for Chat
 """
 import json
 from django.core.paginator import Paginator, EmptyPage
-from django.db.models import Q, Count, F
+from django.db import transaction
+from django.db.models import Q, F, Sum
 
 # from django.shortcuts import render
 from rest_framework import generics, mixins, status
@@ -13,16 +14,20 @@ from rest_framework.response import Response
 from rest_framework.serializers import Serializer
 from rest_framework.views import APIView
 
-from .models import Notice, Room, Message, AdminNotice
+from .models import Notice, Room, Message, AdminNotice, Receipt, UnreadCounter
+from .pagination import InvalidCursor, paginate_keyset
 from calls.models import Invoice
+from calls.ledger import post_entries, refresh_balance
 from basics.models import Gift
 from .serializers import AdminMessageSerializer, NoticeSerializer, RoomSerializer, AdminNoticeSerializer, MessageSerializer, FileListSerializer
 
 from accounts.models import Member
+from accounts.search import search_members
 from accounts.serializers.member import UserSerializer
 from accounts.views.member import IsAdminPermission, IsSuperuserPermission
 
-from .utils import send_super_message, send_super_room, send_message_to_user, send_room_to_users, send_notice_to_room
+from .utils import send_super_message, send_super_room, send_room_to_users, send_notice_to_room, \
+    create_message, get_received_messages, clear_unread, remove_unread
 
 # def index(request):
 #     return render(request, 'chat/index.html', {})
@@ -46,6 +51,19 @@ def notices_list(request):
             user=request.user,
             notice_type=request.GET.get('notice_type', 'foot')
         )
+
+        # cursor mode
+        cursor = request.GET.get('cursor')
+        if cursor is not None:
+            try:
+                notices, next_cursor = paginate_keyset(notices, cursor)
+            except InvalidCursor:
+                return Response(status=status.HTTP_400_BAD_REQUEST)
+            return Response(
+                data={"next": next_cursor, "results": NoticeSerializer(notices, many=True).data},
+                status=status.HTTP_200_OK
+            )
+
         paginator = Paginator(notices.order_by('-created_at'), 10)
         try:
             paginated_notices = paginator.page(request.GET.get('page', 1))
@@ -102,15 +120,30 @@ def room_list(request):
 
         # nickname search
         if keyword != "":
-            rooms = rooms.filter(users__nickname__icontains=keyword)
+            rooms = search_members(rooms, "nickname", keyword, "users__")
 
-        # order by created at and pagination
-        rooms = rooms.order_by(
-            '-updated_at').all()[start_index:start_index + page_size]
-        rooms = rooms.annotate(unread=Count('messages', filter=Q(
-            messages__receiver=request.user) & Q(messages__is_read=False)))
+        # order by updated at and pagination
+        cursor = request.GET.get('cursor')
+        if cursor is not None:
+            try:
+                rooms, next_cursor = paginate_keyset(rooms, cursor, "updated_at", page_size)
+            except InvalidCursor:
+                return Response(status=status.HTTP_400_BAD_REQUEST)
+        else:
+            rooms = list(rooms.order_by(
+                '-updated_at').all()[start_index:start_index + page_size])
+
+        # unread counts
+        unread_counts = dict(UnreadCounter.objects.filter(
+            user=request.user, room__in=rooms).values_list('room_id', 'count'))
+        for room in rooms:
+            room.unread = unread_counts.get(room.id, 0)
+
+        data = RoomSerializer(rooms, many=True).data
+        if cursor is not None:
+            data = {"next": next_cursor, "results": data}
         return Response(
-            data=RoomSerializer(rooms, many=True).data,
+            data=data,
             status=status.HTTP_200_OK
         )
 
@@ -159,10 +192,26 @@ def message_list(request, room_id):
         offset = int(request.GET.get('offset', '0'))
         page_size = 10
         start_index = offset + (page - 1) * page_size
-        messages = room.messages.filter(receiver=request.user).order_by(
+        messages = get_received_messages(user=request.user, room=room).filter(room=room)
+        context = {"receivers": {request.user.id: request.user}}
+
+        # cursor mode
+        cursor = request.GET.get('cursor')
+        if cursor is not None:
+            try:
+                messages, next_cursor = paginate_keyset(messages, cursor, "created_at", page_size)
+            except InvalidCursor:
+                return Response(status=status.HTTP_400_BAD_REQUEST)
+            return Response(
+                data={"next": next_cursor, "results": MessageSerializer(messages, many=True, context=context).data},
+                status=status.HTTP_200_OK
+            )
+
+        messages = messages.order_by(
             '-created_at').all()[start_index:start_index + page_size]
         return Response(
-            data=MessageSerializer(messages, many=True).data,
+            data=MessageSerializer(
+                messages, many=True, context=context).data,
             status=status.HTTP_200_OK
         )
 
@@ -174,60 +223,39 @@ def message_list(request, room_id):
             media_ids = input_data.get('media_ids', [])
             gift_id = input_data.get('gift_id', 0)
 
-            # create self message
-            self_message = Message.objects.create(
-                content=input_data.get('content'),
-                sender=request.user,
-                receiver=request.user,
-                room=room,
-                is_read=True
-            )
-            self_message.medias.set(media_ids)
             if not room.is_group and room.room_type == "private":
                 if gift_id > 0:
                     try:
                         gift = Gift.objects.get(pk=gift_id)
 
-                        self_message.gift_id = gift_id
-                        self_message.save()
-
                         # give and take gift point
-                        Invoice.objects.create(
+                        invoices = [Invoice(
                             invoice_type="GIFT",
                             give_amount=gift.point,
                             giver=request.user,
                             gift=gift,
-                            room=room)
-                        request.user.point -= gift.point
-                        request.user.point_used += gift.point
-                        request.user.save()
+                            room=room)]
+                        deltas = {request.user.id: {"point": -gift.point, "point_used": gift.point}}
 
                         for user in room.users.all():
                             if user.id != request.user.id:
-                                Invoice.objects.create(
-                                    invoice_type="GIFT", take_amount=gift.back, taker=user, gift=gift, room=room)
-                                user.point += gift.back
-                                user.save()
+                                invoices.append(Invoice(
+                                    invoice_type="GIFT", take_amount=gift.back, taker=user, gift=gift, room=room))
+                                deltas[user.id] = {"point": gift.back}
+
+                        post_entries(invoices, deltas)
+                        refresh_balance(request.user)
                     except BaseException:
                         pass
 
-            # create others message
-            for user in room.users.all():
-                if user.id != request.user.id:
-                    message = Message.objects.create(
-                        content=input_data.get('content'),
-                        sender=request.user,
-                        receiver=user,
-                        room=room,
-                        is_read=False,
-                        follower=self_message
-                    )
-                    message.medias.set(media_ids)
-                    if gift_id > 0:
-                        message.gift_id = gift_id
-                        message.save()
-
-                    send_message_to_user(message, user.id)
+            # create message for room members
+            create_message(
+                room,
+                request.user,
+                room.users.all(),
+                input_data.get('content'),
+                media_ids,
+                gift_id if gift_id > 0 else None)
 
             room.last_sender = request.user
             if len(media_ids) > 0:
@@ -247,8 +275,7 @@ def message_list(request, room_id):
             )
 
     if request.method == 'PUT':
-        room.messages.filter(
-            receiver=request.user).update(is_read=True)
+        clear_unread(room, request.user)
         return Response(
             status=status.HTTP_200_OK
         )
@@ -263,8 +290,8 @@ def unread_count(request):
 
     if request.method == 'GET':
         return Response(
-            data=Message.objects.filter(
-                receiver=request.user, is_read=False).count(),
+            data=UnreadCounter.objects.filter(
+                user=request.user).aggregate(total=Sum('count'))['total'] or 0,
             status=status.HTTP_200_OK
         )
 
@@ -417,6 +444,10 @@ class MessageUserView(generics.GenericAPIView):
                 query_set = query_set.filter(
                     cast_class_id__in=query_obj.get('cast_class', []))
 
+            nickname = query_obj.get('nickname', "")
+            if nickname != "":
+                query_set = search_members(query_set, "nickname", nickname)
+
         # sort order
         sort_field = request.GET.get("sortField", "")
         sort_order = request.GET.get("sortOrder", "")
@@ -502,8 +533,8 @@ class MessageView(generics.GenericAPIView):
                 query_set = query_set.filter(content__icontains=content)
 
             if nickname != "":
-                query_set = query_set.filter(
-                    sender__nickname__icontains=nickname)
+                query_set = search_members(
+                    query_set, "nickname", nickname, "sender__")
 
         # sort order
         sort_field = request.GET.get("sortField", "")
@@ -554,7 +585,9 @@ class MessageView(generics.GenericAPIView):
 def delete_message(request, id):
     try:
         message = Message.objects.get(pk=id)
-        message.delete()
+        with transaction.atomic():
+            remove_unread(message.receipts.all())
+            message.delete()
         return Response(status=status.HTTP_200_OK)
     except Message.DoesNotExist:
         return Response(status=status.HTTP_400_BAD_REQUEST)
@@ -566,14 +599,10 @@ def get_unread_admin_messages(request):
     page = int(request.GET.get('page', "1"))
     size = int(request.GET.get('size', "10"))
 
-    query_set = Message.objects
-    superuser_ids = list(
-        Member.objects.filter(
-            is_superuser=True).values_list(
-            'id',
-            flat=True))
-    query_set = query_set.filter(
-        receiver_id__in=superuser_ids, is_read=False
+    superusers = {
+        superuser.id: superuser for superuser in Member.objects.filter(is_superuser=True)}
+    query_set = get_received_messages(
+        user_id__in=list(superusers.keys()), is_read=False
     ).order_by('-created_at')
 
     total = query_set.count()
@@ -581,23 +610,14 @@ def get_unread_admin_messages(request):
     messages = paginator.page(page)
 
     return Response({"total": total, "results": MessageSerializer(
-        messages, many=True).data}, status=status.HTTP_200_OK)
+        messages, many=True, context={"receivers": superusers}).data}, status=status.HTTP_200_OK)
 
 
 @api_view(['GET'])
 @permission_classes([IsSuperuserPermission])
 def get_unread_admin_messages_count(request):
-    query_set = Message.objects
-    superuser_ids = list(
-        Member.objects.filter(
-            is_superuser=True).values_list(
-            'id',
-            flat=True))
-    query_set = query_set.filter(
-        receiver_id__in=superuser_ids, is_read=False
-    ).order_by('-created_at')
-
-    total = query_set.count()
+    total = UnreadCounter.objects.filter(
+        user__is_superuser=True).aggregate(total=Sum('count'))['total'] or 0
 
     return Response({"total": total}, status=status.HTTP_200_OK)
 
@@ -616,7 +636,11 @@ def get_all_rooms(request):
 @api_view(['GET'])
 @permission_classes([IsSuperuserPermission])
 def change_message_state(request, id):
-    Message.objects.filter(pk=id).update(is_read=True)
+    receipts = Receipt.objects.filter(
+        message_id=id, user__is_superuser=True, is_read=False)
+    with transaction.atomic():
+        remove_unread(receipts)
+        receipts.update(is_read=True)
     return Response({"success": True}, status=status.HTTP_200_OK)
 
 
@@ -648,8 +672,8 @@ class RoomView(mixins.CreateModelMixin, generics.GenericAPIView):
                 query_set = query_set.filter(title__icontains=roomname)
 
             if nickname != "":
-                query_set = query_set.filter(
-                    users__nickname__icontains=nickname)
+                query_set = search_members(
+                    query_set, "nickname", nickname, "users__")
 
             if roomtype != "":
                 query_set = query_set.filter(room_type=roomtype)
@@ -779,6 +803,17 @@ class RoomMessageView(APIView):
 
         query_set = room.messages.filter(
             receiver_id=F('sender_id')).order_by('-created_at')
+
+        # cursor mode
+        cursor = request.GET.get('cursor')
+        if cursor is not None:
+            try:
+                messages, next_cursor = paginate_keyset(query_set, cursor, "created_at", size)
+            except InvalidCursor:
+                return Response(status=status.HTTP_400_BAD_REQUEST)
+            return Response({"next": next_cursor, "results": MessageSerializer(
+                messages, many=True).data}, status=status.HTTP_200_OK)
+
         total = query_set.count()
         paginator = Paginator(query_set, size)
         messages = paginator.page(page)
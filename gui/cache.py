@@ -0,0 +1,132 @@
+"""
+Redis cache backend shared by every process
+
+Django 3.2 has no Redis cache, this is the subset of the cache API the apps
+use. Integers are stored as they are so incr works on the server, anything
+else is pickled.
+"""
+import pickle
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache, InvalidCacheBackendError
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class RedisCache(BaseCache):
+
+    def __init__(self, server, params):
+        if redis is None:
+            raise InvalidCacheBackendError("redis is not installed")
+        super(RedisCache, self).__init__(params)
+        self.server = server
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = redis.Redis.from_url(self.server)
+        return self._client
+
+    def dumps(self, value):
+        if type(value) is int:
+            return value
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, value):
+        try:
+            return int(value)
+        except ValueError:
+            return pickle.loads(value)
+
+    def get_expire(self, timeout):
+        # milliseconds, None for no expiry
+        if timeout == DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        if timeout is None:
+            return None
+        return max(int(timeout * 1000), 0)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        expire = self.get_expire(timeout)
+        if expire == 0:
+            return False
+        return bool(self.client.set(key, self.dumps(value), px=expire, nx=True))
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        value = self.client.get(key)
+        return default if value is None else self.loads(value)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        expire = self.get_expire(timeout)
+        if expire == 0:
+            self.client.delete(key)
+        else:
+            self.client.set(key, self.dumps(value), px=expire)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        expire = self.get_expire(timeout)
+        if expire is None:
+            return bool(self.client.persist(key))
+        return bool(self.client.pexpire(key, expire))
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return bool(self.client.delete(key))
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return bool(self.client.exists(key))
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        if not self.client.exists(key):
+            raise ValueError("Key '%s' not found" % key)
+        return self.client.incr(key, delta)
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        if len(keys) == 0:
+            return {}
+
+        made_keys = [self.make_key(key, version=version) for key in keys]
+        for made_key in made_keys:
+            self.validate_key(made_key)
+        return {
+            key: self.loads(value)
+            for key, value in zip(keys, self.client.mget(made_keys)) if value is not None}
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        expire = self.get_expire(timeout)
+        pipeline = self.client.pipeline()
+        for key, value in data.items():
+            key = self.make_key(key, version=version)
+            self.validate_key(key)
+            if expire == 0:
+                pipeline.delete(key)
+            else:
+                pipeline.set(key, self.dumps(value), px=expire)
+        pipeline.execute()
+        return []
+
+    def delete_many(self, keys, version=None):
+        keys = [self.make_key(key, version=version) for key in keys]
+        if len(keys) > 0:
+            self.client.delete(*keys)
+
+    def clear(self):
+        # the database of LOCATION belongs to this cache
+        self.client.flushdb()
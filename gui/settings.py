@@ -199,6 +199,39 @@ CHANNEL_LAYERS = {
     },
 }
 
+# number of chat groups sent per batch by chat.broadcast
+BROADCAST_BATCH_SIZE = 500
+
+# caches every process reads, the default one stays in process
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': 'gui.cache.RedisCache',
+        'LOCATION': 'redis://{}:6379/2'.format(ENV("REDIS_HOST")),
+    },
+}
+
+# reference data of basics.cache, with the version every process reads
+BASICS_CACHE = 'shared'
+
+# serialized member cards of accounts.cards, they embed presigned avatar urls
+# so accounts.cards keeps them for less than AWS_QUERYSTRING_EXPIRE
+PROFILE_CARD_CACHE = 'shared'
+PROFILE_CARD_TIMEOUT = 60 * 50
+
+# websocket presence of chat.presence, flushed to Member by chat.tasks.flush_presence
+PRESENCE_BACKEND = 'chat.presence.RedisPresence'
+PRESENCE_REDIS_URL = 'redis://{}:6379/1'.format(ENV("REDIS_HOST"))
+
+# bitmaps of the cast search facets of accounts.facets
+FACET_BACKEND = 'accounts.facets.RedisFacets'
+FACET_REDIS_URL = 'redis://{}:6379/1'.format(ENV("REDIS_HOST"))
+
+# sub-accounts the house points are spread over by calls.ledger
+HOUSE_SHARDS = 16
+
 # Celery settings
 BROKER_URL = 'redis://{}:6379/0'.format(ENV("REDIS_HOST"))  # our redis address
 # use json format for everything
@@ -206,6 +239,14 @@ CELERY_RESULT_BACKEND = 'redis://{}:6379/0'.format(ENV("REDIS_HOST"))
 CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
+# join timers are scheduled hours ahead, keep them from being redelivered early
+BROKER_TRANSPORT_OPTIONS = {'visibility_timeout': 60 * 60 * 12}
+
+# websocket fan-out runs on its own queue, consumed by the single worker
+# process of the broadcast entry of the Procfile to keep per-receiver order
+CELERY_ROUTES = {
+    'chat.tasks.broadcast_*': {'queue': 'broadcast'},
+}
 
 # Django resized
 DJANGORESIZED_DEFAULT_QUALITY = 75
@@ -242,6 +283,7 @@ DJANGO_REST_MULTITOKENAUTH_REQUIRE_USABLE_PASSWORD = False
 AWS_ACCESS_KEY_ID = ENV('AWS_ACCESS_KEY_ID')
 AWS_SECRET_ACCESS_KEY = ENV('AWS_SECRET_ACCESS_KEY')
 AWS_STORAGE_BUCKET_NAME = ENV('AWS_STORAGE_BUCKET_NAME')
+AWS_QUERYSTRING_EXPIRE = 60 * 60
 DEFAULT_FILE_STORAGE = 'storages.backends.s3boto3.S3Boto3Storage'
 
 # simpleui setting